@@ -7,14 +7,16 @@ EXPERIMENTS=(eurlex_lightxml wiki10_lightxml amazoncat_lightxml amazon_lightxml
 #EXPERIMENTS=(eurlex_lightxml_true_as_pred wiki10_lightxml_true_as_pred amazoncat_lightxml_true_as_pred amazon_1000_lightxml_true_as_pred wiki500_1000_lightxml_true_as_pred)
 
 SEEDS=(13 26 42 1993 2023)
-KS=(1 3 5 10)
+JOBS=$(nproc)
+
+SEED_ARGS=()
+for seed in "${SEEDS[@]}"; do
+    SEED_ARGS+=(-s $seed)
+done
+
+# Each experiment is loaded once and all seeds, methods and k are run on a pool of JOBS processes
 for e in "${EXPERIMENTS[@]}"; do
-    for seed in "${SEEDS[@]}"; do
-        for k in "${KS[@]}"; do
-            echo "Running python3 src/main.py $e -k $k -s $seed"
-            python3 src/main.py $e -k $k -s $seed &
-        done
-        wait
-    done
+    echo "Running python3 src/main_bca.py $e ${SEED_ARGS[@]} -j $JOBS"
+    python3 src/main_bca.py $e "${SEED_ARGS[@]}" -j $JOBS
 done
 
@@ -1,3 +1,4 @@
+import time
 import numpy as np
 from scipy.sparse import csr_matrix, load_npz, save_npz
 from tqdm import tqdm, trange
@@ -5,7 +6,7 @@ from utils_sparse import *
 from utils_misc import *
 from utils_dense import *
 from typing import Union
-
+from numba import njit, prange, set_num_threads
 
 # Enable slow (without use of specialized numba functions) but still memory efficient implementation
 SLOW = False
@@ -21,8 +22,41 @@ def bca_with_0approx_np(
     max_iter: int = 100,
     shuffle_order: bool = True,
     seed: int = None,
+    gain_func: callable = None,
+    alpha: float = 0,
+    return_top_k: bool = False,
+    init_y_pred: Union[np.ndarray, csr_matrix] = None,
     **kwargs,
 ):
+    """
+    Block coordinate ascent for dense probability estimates.
+    If gain_func (see bca_with_0approx_csr) is given, passes run in numba_bca_0approx_np_sweep,
+    which keeps predictions as (ni, k) array of labels and does not allocate per instance.
+    With return_top_k (requires gain_func), the predictions are returned as (ni, k) array of labels instead of a matrix.
+    init_y_pred (requires gain_func) warm starts the optimization from the given predictions, see as_top_k.
+    """
+    if gain_func is not None and not SLOW:
+        return bca_with_0approx_np_fast(
+            y_proba,
+            k,
+            utility_func,
+            gain_func,
+            greedy_start=greedy_start,
+            tolerance=tolerance,
+            max_iter=max_iter,
+            shuffle_order=shuffle_order,
+            seed=seed,
+            alpha=alpha,
+            return_top_k=return_top_k,
+            init_y_pred=init_y_pred,
+        )
+    if return_top_k or init_y_pred is not None:
+        raise ValueError("return_top_k and init_y_pred require gain_func")
+
+    if seed is not None:
+        print(f"  Using seed: {seed}")
+        np.random.seed(seed)
+
     ni, nl = y_proba.shape
 
     # Initialize the prediction variable with some feasible value
@@ -99,6 +133,87 @@ def bca_with_0approx_np(
     return y_pred, meta
 
 
+def bca_with_0approx_np_fast(
+    y_proba: np.ndarray,
+    k: int,
+    utility_func: callable,
+    gain_func: callable,
+    greedy_start=False,
+    tolerance: float = 1e-6,
+    max_iter: int = 100,
+    shuffle_order: bool = True,
+    seed: int = None,
+    alpha: float = 0,
+    return_top_k: bool = False,
+    init_y_pred: Union[np.ndarray, csr_matrix] = None,
+    **kwargs,
+):
+    """
+    Numba variant of bca_with_0approx_np, see numba_bca_0approx_np_sweep.
+    Etp, Efp and column sums of y_proba are kept as float64 and recalculated at the beginning of each pass.
+    Random initialization and order of instances are the same as in bca_with_0approx_np for the same seed.
+    """
+    if seed is not None:
+        print(f"  Using seed: {seed}")
+        np.random.seed(seed)
+
+    ni, nl = y_proba.shape
+
+    # Initialize the prediction variable with some feasible value or warm start from the given one
+    if init_y_pred is not None:
+        y_pred_top_k = as_top_k(init_y_pred, k)
+    else:
+        y_pred_top_k = as_top_k(random_at_k(y_proba, k), k)
+
+    meta = {"utilities": [], "times": []}
+
+    for j in range(max_iter):
+        start_time = time.time()
+        order = np.arange(ni)
+        if shuffle_order:
+            np.random.shuffle(order)
+
+        if greedy_start and j == 0:
+            Etp = np.zeros(nl, np.float64)
+            Efp = np.zeros(nl, np.float64)
+            Esum = np.zeros(nl, np.float64)
+        else:
+            # Recalculate expected conf matrices to prevent numerical errors from accumulating too much
+            Etp, Efp, Esum = numba_calculate_0approx_stats_np(y_proba, y_pred_top_k)
+
+        old_utility = np.mean(utility_func(Etp / ni, Efp / ni, (Esum - Etp) / ni))
+
+        numba_bca_0approx_np_sweep(
+            y_proba,
+            y_pred_top_k,
+            Etp,
+            Efp,
+            Esum,
+            order,
+            k,
+            gain_func,
+            alpha,
+            not (greedy_start and j == 0),
+        )
+
+        new_utility = np.mean(utility_func(Etp / ni, Efp / ni, (Esum - Etp) / ni))
+        meta["utilities"].append(new_utility)
+        meta["times"].append(time.time() - start_time)
+        print(
+            f"  Iteration {j + 1} finished in {meta['times'][-1]:.2f}s, expected score: {old_utility} -> {new_utility}"
+        )
+        if new_utility <= old_utility + tolerance:
+            break
+
+    meta["iters"] = j
+    if return_top_k:
+        return y_pred_top_k, meta
+
+    y_pred = np.zeros((ni, nl), y_proba.dtype)
+    np.put_along_axis(y_pred, y_pred_top_k, 1.0, axis=1)
+    return y_pred, meta
+
+
 def bca_coverage_np(
     y_proba: csr_matrix,
     k: int,
@@ -114,6 +229,10 @@ def bca_coverage_np(
     """
     An efficient implementation of the block coordinate-descent for coverage
     """
+    if kwargs.get("return_top_k") or kwargs.get("init_y_pred") is not None:
+        raise ValueError(
+            "return_top_k and init_y_pred are not supported for dense y_proba"
+        )
     ni, nl = y_proba.shape
 
     # initialize the prediction variable with some feasible value
@@ -131,10 +250,13 @@ def bca_coverage_np(
             f = np.ones(nl, np.float32)
         else:
             f = np.product(1 - y_pred * y_proba, axis=0)
-        
+
         old_cov = 1 - np.mean(f)
-        if(alpha < 1):
-            old_cov = alpha * old_cov + (1 - alpha) * (np.sum(y_pred * y_proba, axis=0) / ni / k).mean()
+        if alpha < 1:
+            old_cov = (
+                alpha * old_cov
+                + (1 - alpha) * (np.sum(y_pred * y_proba, axis=0) / ni / k).mean()
+            )
 
         for i in order:
             # adjust f locally
@@ -154,8 +276,11 @@ def bca_coverage_np(
             f *= 1 - y_pred[i] * y_proba[i]
 
         new_cov = 1 - np.mean(f)
-        if(alpha < 1):
-            new_cov = alpha * new_cov + (1 - alpha) * (np.sum(y_pred * y_proba, axis=0) / ni / k).mean()
+        if alpha < 1:
+            new_cov = (
+                alpha * new_cov
+                + (1 - alpha) * (np.sum(y_pred * y_proba, axis=0) / ni / k).mean()
+            )
 
         meta["utilities"].append(new_cov)
         print(
@@ -168,163 +293,1322 @@ def bca_coverage_np(
     return y_pred, meta
 
 
-def bca_with_0approx_csr(
+@njit
+def numba_select_top_k(
+    gains: np.ndarray, p_indices: np.ndarray, k: int, out: np.ndarray
+):
+    """
+    Writes sorted labels with the k highest gains into out.
+    If there are fewer than k candidates, the remaining places are filled with the lowest labels not present in p_indices.
+    """
+    n = p_indices.size
+    if n > k:
+        out[:] = p_indices[np.argpartition(-gains, k)[:k]]
+    else:
+        out[:n] = p_indices
+        l = j = 0
+        m = n
+        while m < k:
+            if j < n and p_indices[j] == l:
+                j += 1
+            else:
+                out[m] = l
+                m += 1
+            l += 1
+    out.sort()
+
+
+@njit
+def numba_calculate_0approx_stats_np(y_proba: np.ndarray, y_pred_top_k: np.ndarray):
+    """
+    Calculates expected true positives and false positives for dense probabilities
+    and predictions stored as (ni, k) array of labels, together with the column sums of y_proba.
+    Expected false negatives are equal to the column sums minus expected true positives.
+    """
+    ni, nl = y_proba.shape
+    k = y_pred_top_k.shape[1]
+    Etp = np.zeros(nl, dtype=np.float64)
+    Efp = np.zeros(nl, dtype=np.float64)
+    Esum = np.zeros(nl, dtype=np.float64)
+    for i in range(ni):
+        for l in range(nl):
+            Esum[l] += y_proba[i, l]
+        for j in range(k):
+            l = y_pred_top_k[i, j]
+            Etp[l] += y_proba[i, l]
+            Efp[l] += 1 - y_proba[i, l]
+    return Etp, Efp, Esum
+
+
+@njit
+def numba_bca_0approx_np_sweep(
+    y_proba: np.ndarray,
+    y_pred_top_k: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Esum: np.ndarray,
+    order: np.ndarray,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Performs a single pass of block coordinate ascent over dense y_proba.
+    Efn is not stored, but derived as Esum - Etp, so removing and adding the contribution of an instance
+    only touches its k predicted labels, the only full-width operation per instance is the calculation of gains.
+    If not adjust_stats (greedy start), instances are added to Esum when visited.
+    """
+    ni, nl = y_proba.shape
+    gains = np.zeros(nl, dtype=np.float64)
+    labels = np.arange(nl)
+    for i in order:
+        eta = y_proba[i]
+        row_pred = y_pred_top_k[i]
+
+        if adjust_stats:
+            for l in row_pred:
+                Etp[l] -= eta[l]
+                Efp[l] -= 1 - eta[l]
+        else:
+            for l in range(nl):
+                Esum[l] += eta[l]
+
+        for l in range(nl):
+            gains[l] = gain_func(
+                Etp[l], Efp[l], Esum[l] - eta[l] - Etp[l], eta[l], ni, k, alpha
+            )
+        numba_select_top_k(gains, labels, k, row_pred)
+
+        for l in row_pred:
+            Etp[l] += eta[l]
+            Efp[l] += 1 - eta[l]
+
+
+@njit
+def numba_max_row_size(indptr: np.ndarray):
+    max_row_size = 0
+    for i in range(indptr.size - 1):
+        max_row_size = max(max_row_size, indptr[i + 1] - indptr[i])
+    return max_row_size
+
+
+@njit
+def numba_bca_0approx_csr_step(
+    i: int,
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    gains: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Updates the prediction of instance i and the expected confusion matrices.
+    gains is a work buffer of at least the size of the largest row of p.
+    """
+    p_start, p_end = p_indptr[i], p_indptr[i + 1]
+    row_data = p_data[p_start:p_end]
+    row_indices = p_indices[p_start:p_end]
+    row_pred = y_pred_indices[i * k : (i + 1) * k]
+
+    if adjust_stats:
+        numba_update_0approx_stats(row_data, row_indices, row_pred, Etp, Efp, Efn, -1.0)
+
+    row_gains = gains[: row_data.size]
+    for j in range(row_data.size):
+        l = row_indices[j]
+        row_gains[j] = gain_func(Etp[l], Efp[l], Efn[l], row_data[j], ni, k, alpha)
+    numba_select_top_k(row_gains, row_indices, k, row_pred)
+
+    numba_update_0approx_stats(row_data, row_indices, row_pred, Etp, Efp, Efn, 1.0)
+
+
+@njit
+def numba_bca_0approx_csr_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    order: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Performs a single pass of the block coordinate ascent over instances in the given order.
+    y_pred_indices holds exactly k sorted labels per instance and is updated in place together with Etp, Efp, Efn.
+    """
+    gains = np.zeros(numba_max_row_size(p_indptr), dtype=np.float64)
+    for i in order:
+        numba_bca_0approx_csr_step(
+            i,
+            p_data,
+            p_indices,
+            p_indptr,
+            y_pred_indices,
+            Etp,
+            Efp,
+            Efn,
+            gains,
+            ni,
+            k,
+            gain_func,
+            alpha,
+            adjust_stats,
+        )
+
+
+@njit
+def numba_bca_0approx_csr_compensated_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    Ctp: np.ndarray,
+    Cfp: np.ndarray,
+    Cfn: np.ndarray,
+    order: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Variant of numba_bca_0approx_csr_sweep that updates Etp, Efp, Efn using Kahan summation
+    with compensations Ctp, Cfp, Cfn, gains are calculated from the uncompensated (float32) values.
+    """
+    gains = np.zeros(numba_max_row_size(p_indptr), dtype=Etp.dtype)
+    for i in order:
+        p_start, p_end = p_indptr[i], p_indptr[i + 1]
+        row_data = p_data[p_start:p_end]
+        row_indices = p_indices[p_start:p_end]
+        row_pred = y_pred_indices[i * k : (i + 1) * k]
+
+        if adjust_stats:
+            numba_update_0approx_stats_compensated(
+                row_data, row_indices, row_pred, Etp, Efp, Efn, Ctp, Cfp, Cfn, -1.0
+            )
+
+        row_gains = gains[: row_data.size]
+        for j in range(row_data.size):
+            l = row_indices[j]
+            row_gains[j] = gain_func(Etp[l], Efp[l], Efn[l], row_data[j], ni, k, alpha)
+        numba_select_top_k(row_gains, row_indices, k, row_pred)
+
+        numba_update_0approx_stats_compensated(
+            row_data, row_indices, row_pred, Etp, Efp, Efn, Ctp, Cfp, Cfn, 1.0
+        )
+
+
+@njit(parallel=True)
+def numba_bca_0approx_csr_parallel_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    order: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+    n_blocks: int,
+):
+    """
+    Parallel (Hogwild-style) variant of numba_bca_0approx_csr_sweep.
+    The order is split into n_blocks contiguous blocks that are processed concurrently.
+    All blocks update shared Etp, Efp, Efn without locks, so some updates may be lost,
+    the caller is responsible for recalculating them after the pass.
+    """
+    max_row_size = numba_max_row_size(p_indptr)
+    block_size = (order.size + n_blocks - 1) // n_blocks
+    for b in prange(n_blocks):
+        gains = np.zeros(max_row_size, dtype=np.float64)
+        for i in order[b * block_size : (b + 1) * block_size]:
+            numba_bca_0approx_csr_step(
+                i,
+                p_data,
+                p_indices,
+                p_indptr,
+                y_pred_indices,
+                Etp,
+                Efp,
+                Efn,
+                gains,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                adjust_stats,
+            )
+
+
+@njit
+def numba_failure_prob(log_failure: np.ndarray, n_certain: np.ndarray, l: int):
+    """
+    Returns the probability of not covering label l.
+    """
+    if n_certain[l] > 0:
+        return 0.0
+    return np.exp(log_failure[l])
+
+
+@njit
+def numba_failure_prob_without(
+    log_failure: np.ndarray, n_certain: np.ndarray, l: int, eta: float
+):
+    """
+    Returns the probability of not covering label l without the factor 1 - eta of a single instance.
+    """
+    if eta >= 1:
+        return 0.0 if n_certain[l] > 1 else np.exp(log_failure[l])
+    return 0.0 if n_certain[l] > 0 else np.exp(log_failure[l] - np.log1p(-eta))
+
+
+@njit
+def numba_failure_prob_with(
+    log_failure: np.ndarray, n_certain: np.ndarray, l: int, eta: float
+):
+    """
+    Returns the probability of not covering label l with an additional factor 1 - eta of a single instance.
+    """
+    if eta >= 1 or n_certain[l] > 0:
+        return 0.0
+    return np.exp(log_failure[l] + np.log1p(-eta))
+
+
+@njit
+def numba_bca_coverage_csr_step(
+    i: int,
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    gains: np.ndarray,
+    k: int,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Updates the prediction of instance i and the probability of not covering each label,
+    kept in log domain (see numba_calculate_log_failure_prob).
+    gains is a work buffer of at least the size of the largest row of p.
+    """
+    p_start, p_end = p_indptr[i], p_indptr[i + 1]
+    row_data = p_data[p_start:p_end]
+    row_indices = p_indices[p_start:p_end]
+    row_pred = y_pred_indices[i * k : (i + 1) * k]
+
+    if adjust_stats:
+        numba_update_log_failure_prob(
+            row_data, row_indices, row_pred, log_failure, n_certain, -1
+        )
+
+    row_gains = gains[: row_data.size]
+    for j in range(row_data.size):
+        l = row_indices[j]
+        row_gains[j] = numba_failure_prob(log_failure, n_certain, l) * row_data[j]
+        if alpha < 1:
+            row_gains[j] = alpha * row_gains[j] + (1 - alpha) * row_data[j] / k
+    numba_select_top_k(row_gains, row_indices, k, row_pred)
+
+    numba_update_log_failure_prob(
+        row_data, row_indices, row_pred, log_failure, n_certain, 1
+    )
+
+
+@njit
+def numba_bca_coverage_csr_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    order: np.ndarray,
+    k: int,
+    alpha: float,
+    adjust_stats: bool,
+):
+    """
+    Performs a single pass of the block coordinate ascent for coverage over instances in the given order.
+    """
+    gains = np.zeros(numba_max_row_size(p_indptr), dtype=np.float64)
+    for i in order:
+        numba_bca_coverage_csr_step(
+            i,
+            p_data,
+            p_indices,
+            p_indptr,
+            y_pred_indices,
+            log_failure,
+            n_certain,
+            gains,
+            k,
+            alpha,
+            adjust_stats,
+        )
+
+
+@njit(parallel=True)
+def numba_bca_coverage_csr_parallel_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    order: np.ndarray,
+    k: int,
+    alpha: float,
+    adjust_stats: bool,
+    n_blocks: int,
+):
+    """
+    Parallel (Hogwild-style) variant of numba_bca_coverage_csr_sweep, see numba_bca_0approx_csr_parallel_sweep.
+    """
+    max_row_size = numba_max_row_size(p_indptr)
+    block_size = (order.size + n_blocks - 1) // n_blocks
+    for b in prange(n_blocks):
+        gains = np.zeros(max_row_size, dtype=np.float64)
+        for i in order[b * block_size : (b + 1) * block_size]:
+            numba_bca_coverage_csr_step(
+                i,
+                p_data,
+                p_indices,
+                p_indptr,
+                y_pred_indices,
+                log_failure,
+                n_certain,
+                gains,
+                k,
+                alpha,
+                adjust_stats,
+            )
+
+
+@njit(parallel=True)
+def numba_bca_0approx_csr_batch_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    order: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+    batch_size: int,
+):
+    """
+    Variant of numba_bca_0approx_csr_sweep that updates batches of batch_size instances at once.
+    Gains of all instances in a batch are calculated (in parallel) against Etp, Efp, Efn frozen at the beginning of the batch,
+    with only the instance's own contribution excluded, then the statistics are updated once for the whole batch.
+    """
+    old_pred = np.zeros((batch_size, k), dtype=y_pred_indices.dtype)
+    for start in range(0, order.size, batch_size):
+        batch = order[start : start + batch_size]
+
+        for b in prange(batch.size):
+            i = batch[b]
+            p_start, p_end = p_indptr[i], p_indptr[i + 1]
+            row_data = p_data[p_start:p_end]
+            row_indices = p_indices[p_start:p_end]
+            row_pred = y_pred_indices[i * k : (i + 1) * k]
+            old_pred[b] = row_pred
+
+            row_gains = np.zeros(row_data.size, dtype=np.float64)
+            r = 0
+            for j in range(row_data.size):
+                l, eta = row_indices[j], row_data[j]
+                tp, fp, fn = Etp[l], Efp[l], Efn[l]
+                if adjust_stats:
+                    while r < k and row_pred[r] < l:
+                        r += 1
+                    if r < k and row_pred[r] == l:
+                        tp -= eta
+                        fp -= 1 - eta
+                    else:
+                        fn -= eta
+                row_gains[j] = gain_func(tp, fp, fn, eta, ni, k, alpha)
+            numba_select_top_k(row_gains, row_indices, k, row_pred)
+
+        for b in range(batch.size):
+            i = batch[b]
+            p_start, p_end = p_indptr[i], p_indptr[i + 1]
+            row_data = p_data[p_start:p_end]
+            row_indices = p_indices[p_start:p_end]
+            if adjust_stats:
+                numba_update_0approx_stats(
+                    row_data, row_indices, old_pred[b], Etp, Efp, Efn, -1.0
+                )
+            numba_update_0approx_stats(
+                row_data,
+                row_indices,
+                y_pred_indices[i * k : (i + 1) * k],
+                Etp,
+                Efp,
+                Efn,
+                1.0,
+            )
+
+
+@njit(parallel=True)
+def numba_bca_coverage_csr_batch_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    order: np.ndarray,
+    k: int,
+    alpha: float,
+    adjust_stats: bool,
+    batch_size: int,
+):
+    """
+    Variant of numba_bca_coverage_csr_sweep that updates batches of batch_size instances at once,
+    see numba_bca_0approx_csr_batch_sweep.
+    """
+    old_pred = np.zeros((batch_size, k), dtype=y_pred_indices.dtype)
+    for start in range(0, order.size, batch_size):
+        batch = order[start : start + batch_size]
+
+        for b in prange(batch.size):
+            i = batch[b]
+            p_start, p_end = p_indptr[i], p_indptr[i + 1]
+            row_data = p_data[p_start:p_end]
+            row_indices = p_indices[p_start:p_end]
+            row_pred = y_pred_indices[i * k : (i + 1) * k]
+            old_pred[b] = row_pred
+
+            row_gains = np.zeros(row_data.size, dtype=np.float64)
+            r = 0
+            for j in range(row_data.size):
+                l, eta = row_indices[j], row_data[j]
+                f = numba_failure_prob(log_failure, n_certain, l)
+                if adjust_stats:
+                    while r < k and row_pred[r] < l:
+                        r += 1
+                    if r < k and row_pred[r] == l:
+                        f = numba_failure_prob_without(log_failure, n_certain, l, eta)
+                row_gains[j] = f * eta
+                if alpha < 1:
+                    row_gains[j] = alpha * row_gains[j] + (1 - alpha) * eta / k
+            numba_select_top_k(row_gains, row_indices, k, row_pred)
+
+        for b in range(batch.size):
+            i = batch[b]
+            p_start, p_end = p_indptr[i], p_indptr[i + 1]
+            row_data = p_data[p_start:p_end]
+            row_indices = p_indices[p_start:p_end]
+            if adjust_stats:
+                numba_update_log_failure_prob(
+                    row_data, row_indices, old_pred[b], log_failure, n_certain, -1
+                )
+            numba_update_log_failure_prob(
+                row_data,
+                row_indices,
+                y_pred_indices[i * k : (i + 1) * k],
+                log_failure,
+                n_certain,
+                1,
+            )
+
+
+@njit
+def numba_row_changed(row_indices: np.ndarray, label_version: np.ndarray, version: int):
+    """
+    Returns True if the statistics of any of the labels of the row have changed after the given version.
+    """
+    for l in row_indices:
+        if label_version[l] > version:
+            return True
+    return False
+
+
+@njit
+def numba_mark_changed_labels(
+    old_pred: np.ndarray, row_pred: np.ndarray, label_version: np.ndarray, version: int
+):
+    """
+    Sets the version of labels that were added to or removed from the (sorted) prediction,
+    the only labels whose statistics have changed.
+    """
+    k = old_pred.size
+    a = b = 0
+    while a < k or b < k:
+        if b >= k or (a < k and old_pred[a] < row_pred[b]):
+            label_version[old_pred[a]] = version
+            a += 1
+        elif a >= k or row_pred[b] < old_pred[a]:
+            label_version[row_pred[b]] = version
+            b += 1
+        else:
+            a += 1
+            b += 1
+
+
+@njit
+def numba_is_top_k(
+    row_gains: np.ndarray,
+    row_indices: np.ndarray,
+    row_pred: np.ndarray,
+    is_pred: np.ndarray,
+    k: int,
+):
+    """
+    Returns True if all k labels of the (sorted) prediction are in the row
+    and have strictly higher gains than the other labels of the row.
+    is_pred is a work buffer of at least the size of the row.
+    """
+    n_pred = 0
+    b = 0
+    for j in range(row_indices.size):
+        while b < k and row_pred[b] < row_indices[j]:
+            b += 1
+        is_pred[j] = b < k and row_pred[b] == row_indices[j]
+        n_pred += is_pred[j]
+    if n_pred < k:
+        return False
+
+    min_pred = np.inf
+    max_other = -np.inf
+    for j in range(row_indices.size):
+        if is_pred[j]:
+            min_pred = min(min_pred, row_gains[j])
+        else:
+            max_other = max(max_other, row_gains[j])
+    return min_pred > max_other
+
+
+@njit
+def numba_bca_0approx_csr_active_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    order: np.ndarray,
+    ni: int,
+    k: int,
+    gain_func: callable,
+    alpha: float,
+    adjust_stats: bool,
+    label_version: np.ndarray,
+    row_version: np.ndarray,
+):
+    """
+    Variant of numba_bca_0approx_csr_sweep that only updates instances whose top-k can change.
+    label_version keeps for each label the number of the update that last changed its statistics,
+    row_version the number of the update at the last visit of each instance (-1 if it was never visited).
+    An instance is skipped if the statistics of none of its labels have changed since its last visit,
+    or if its prediction still has strictly the highest gains calculated at its own probabilities
+    (the same as numba_bca_0approx_csr_step would calculate), so the result is the same as of the full sweep.
+    Returns the number of updated instances.
+    """
+    max_row_size = numba_max_row_size(p_indptr)
+    gains = np.zeros(max_row_size, dtype=np.float64)
+    is_pred = np.zeros(max_row_size, dtype=np.bool_)
+    old_pred = np.zeros(k, dtype=y_pred_indices.dtype)
+    version = max(label_version.max(), row_version.max())
+    visited = 0
+    for i in order:
+        p_start, p_end = p_indptr[i], p_indptr[i + 1]
+        row_data = p_data[p_start:p_end]
+        row_indices = p_indices[p_start:p_end]
+        row_pred = y_pred_indices[i * k : (i + 1) * k]
+        if row_version[i] >= 0:
+            if not numba_row_changed(row_indices, label_version, row_version[i]):
+                continue
+
+            # Gains of the step, with the contribution of the instance removed from the statistics
+            row_gains = gains[: row_data.size]
+            b = 0
+            for j in range(row_data.size):
+                l, eta = row_indices[j], row_data[j]
+                while b < k and row_pred[b] < l:
+                    b += 1
+                tp, fp, fn = Etp[l], Efp[l], Efn[l]
+                if adjust_stats and b < k and row_pred[b] == l:
+                    tp, fp = tp - eta, fp - (1 - eta)
+                elif adjust_stats:
+                    fn = fn - eta
+                row_gains[j] = gain_func(tp, fp, fn, eta, ni, k, alpha)
+            if numba_is_top_k(row_gains, row_indices, row_pred, is_pred, k):
+                row_version[i] = version
+                continue
+
+        visited += 1
+        old_pred[:] = row_pred
+        numba_bca_0approx_csr_step(
+            i,
+            p_data,
+            p_indices,
+            p_indptr,
+            y_pred_indices,
+            Etp,
+            Efp,
+            Efn,
+            gains,
+            ni,
+            k,
+            gain_func,
+            alpha,
+            adjust_stats,
+        )
+        version += 1
+        numba_mark_changed_labels(old_pred, row_pred, label_version, version)
+        row_version[i] = version
+
+    return visited
+
+
+@njit
+def numba_bca_coverage_csr_active_sweep(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    order: np.ndarray,
+    k: int,
+    alpha: float,
+    adjust_stats: bool,
+    label_version: np.ndarray,
+    row_version: np.ndarray,
+):
+    """
+    Variant of numba_bca_coverage_csr_sweep that only updates instances whose top-k can change,
+    see numba_bca_0approx_csr_active_sweep. Returns the number of updated instances.
+    """
+    max_row_size = numba_max_row_size(p_indptr)
+    gains = np.zeros(max_row_size, dtype=np.float64)
+    is_pred = np.zeros(max_row_size, dtype=np.bool_)
+    old_pred = np.zeros(k, dtype=y_pred_indices.dtype)
+    version = max(label_version.max(), row_version.max())
+    visited = 0
+    for i in order:
+        p_start, p_end = p_indptr[i], p_indptr[i + 1]
+        row_data = p_data[p_start:p_end]
+        row_indices = p_indices[p_start:p_end]
+        row_pred = y_pred_indices[i * k : (i + 1) * k]
+        if row_version[i] >= 0:
+            if not numba_row_changed(row_indices, label_version, row_version[i]):
+                continue
+
+            # Gains of the step, with the factor of the instance removed from the probability of failure
+            row_gains = gains[: row_data.size]
+            b = 0
+            for j in range(row_data.size):
+                l, eta = row_indices[j], row_data[j]
+                while b < k and row_pred[b] < l:
+                    b += 1
+                if adjust_stats and b < k and row_pred[b] == l:
+                    failure_prob = numba_failure_prob_without(
+                        log_failure, n_certain, l, eta
+                    )
+                else:
+                    failure_prob = numba_failure_prob(log_failure, n_certain, l)
+                row_gains[j] = failure_prob * eta
+                if alpha < 1:
+                    row_gains[j] = alpha * row_gains[j] + (1 - alpha) * eta / k
+            if numba_is_top_k(row_gains, row_indices, row_pred, is_pred, k):
+                row_version[i] = version
+                continue
+
+        visited += 1
+        old_pred[:] = row_pred
+        numba_bca_coverage_csr_step(
+            i,
+            p_data,
+            p_indices,
+            p_indptr,
+            y_pred_indices,
+            log_failure,
+            n_certain,
+            gains,
+            k,
+            alpha,
+            adjust_stats,
+        )
+        version += 1
+        numba_mark_changed_labels(old_pred, row_pred, label_version, version)
+        row_version[i] = version
+
+    return visited
+
+
+def stats_drift(stats: tuple, compensations: tuple, exact_stats: tuple, ni: int):
+    """
+    Returns the largest absolute difference between normalized running (minus their Kahan compensations)
+    and exact confusion matrices.
+    """
+    return (
+        max(
+            np.abs(np.asarray(s, np.float64) - c - e).max()
+            for s, c, e in zip(stats, compensations, exact_stats)
+        )
+        / ni
+    )
+
+
+def csr_rows_chunk(y_proba: csr_matrix, start: int, end: int):
+    """
+    Reads rows [start, end) of the (possibly memory-mapped) sparse matrix into memory.
+    """
+    p_start, p_end = y_proba.indptr[start], y_proba.indptr[end]
+    data = np.array(y_proba.data[p_start:p_end])
+    indices = np.array(y_proba.indices[p_start:p_end])
+    indptr = np.array(y_proba.indptr[start : end + 1]) - p_start
+    return data, indices, indptr
+
+
+def bca_with_0approx_csr_chunked(
     y_proba: csr_matrix,
     k: int,
     utility_func: callable,
+    gain_func: callable,
+    chunk_size: int,
     greedy_start=False,
     tolerance: float = 1e-6,
     max_iter: int = 100,
     shuffle_order: bool = True,
     seed: int = None,
-    filename: str = None,
+    alpha: float = 0,
+    resync_every: int = 1,
+    return_top_k: bool = False,
+    init_y_pred: Union[np.ndarray, csr_matrix] = None,
     **kwargs,
 ):
+    """
+    Out-of-core variant of bca_with_0approx_csr for y_proba backed by memory-mapped arrays (see load_npy_csr).
+    Instances are processed in chunks of chunk_size rows (in shuffled order of chunks and of rows within a chunk),
+    only one chunk of y_proba, Etp, Efp, Efn and the k labels predicted for each instance are kept in memory.
+    Etp, Efp, Efn are float64 running sums recalculated from scratch every resync_every passes.
+    """
     if seed is not None:
         print(f"  Using seed: {seed}")
         np.random.seed(seed)
 
-    # Initialize the prediction variable with some feasible value
     ni, nl = y_proba.shape
-    y_pred_data, y_pred_indices, y_pred_indptr = numba_random_at_k(
-        y_proba.indices, y_proba.indptr, ni, nl, k, seed=seed
-    )
+    chunks = [
+        (start, min(start + chunk_size, ni)) for start in range(0, ni, chunk_size)
+    ]
 
-    # For debug set it to first k labels
-    # y_pred_data, y_pred_indices, y_pred_indptr = numba_first_k(y_proba.data, y_proba.indices, y_proba.indptr, ni, nl, k)
+    # Initialize the prediction variable with some feasible value or warm start from the given one
+    if init_y_pred is not None:
+        y_pred_indices = as_top_k(init_y_pred, k).ravel()
+    else:
+        y_pred_indices = np.zeros(ni * k, dtype=INT_TYPE)
+        for c, (start, end) in enumerate(chunks):
+            _, indices, indptr = csr_rows_chunk(y_proba, start, end)
+            _, y_pred_indices[start * k : end * k], _ = numba_random_at_k(
+                indices, indptr, end - start, nl, k, seed=seed if c == 0 else None
+            )
+        y_pred_indices.reshape(ni, k).sort(axis=1)
 
-    y_pred = construct_csr_matrix(
-        y_pred_data, y_pred_indices, y_pred_indptr, shape=(ni, nl), sort_indices=True
-    )
+    meta = {"utilities": [], "times": []}
 
-    meta = {"utilities": []}
+    for j in range(max_iter):
+        start_time = time.time()
+        chunks_order = np.arange(len(chunks))
+        if shuffle_order:
+            np.random.shuffle(chunks_order)
+
+        if greedy_start and j == 0:
+            Etp = np.zeros(nl, np.float64)
+            Efp = np.zeros(nl, np.float64)
+            Efn = np.zeros(nl, np.float64)
+            old_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
+        elif j % resync_every == 0:
+            Etp = np.zeros(nl, np.float64)
+            Efp = np.zeros(nl, np.float64)
+            Efn = np.zeros(nl, np.float64)
+            for start, end in chunks:
+                chunk_stats = numba_calculate_0approx_stats(
+                    *csr_rows_chunk(y_proba, start, end),
+                    y_pred_indices[start * k : end * k],
+                    end - start,
+                    nl,
+                    k,
+                    np.float64,
+                )
+                Etp += chunk_stats[0]
+                Efp += chunk_stats[1]
+                Efn += chunk_stats[2]
+            old_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
+        else:
+            old_utility = new_utility
+
+        for c in tqdm(chunks_order):
+            start, end = chunks[c]
+            order = np.arange(end - start)
+            if shuffle_order:
+                np.random.shuffle(order)
+
+            numba_bca_0approx_csr_sweep(
+                *csr_rows_chunk(y_proba, start, end),
+                y_pred_indices[start * k : end * k],
+                Etp,
+                Efp,
+                Efn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+            )
+
+        new_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
+        meta["utilities"].append(new_utility)
+        meta["times"].append(time.time() - start_time)
+        print(
+            f"  Iteration {j + 1} finished in {meta['times'][-1]:.2f}s, expected score: {old_utility} -> {new_utility}"
+        )
+        if new_utility <= old_utility + tolerance:
+            break
+
+    meta["iters"] = j
+    y_pred_top_k = y_pred_indices.reshape(ni, k)
+    if return_top_k:
+        return y_pred_top_k, meta
+    return top_k_to_csr(y_pred_top_k, nl), meta
+
+
+@restores_num_threads
+def bca_with_0approx_csr(
+    y_proba: csr_matrix,
+    k: int,
+    utility_func: callable,
+    greedy_start=False,
+    tolerance: float = 1e-6,
+    max_iter: int = 100,
+    shuffle_order: bool = True,
+    seed: int = None,
+    filename: str = None,
+    gain_func: callable = None,
+    alpha: float = 0,
+    n_threads: int = 1,
+    resync_every: int = 1,
+    resync_tolerance: float = 1e-6,
+    precision: str = None,
+    check_drift: bool = False,
+    active_set: bool = False,
+    batch_size: int = 1,
+    chunk_size: int = None,
+    return_top_k: bool = False,
+    init_y_pred: Union[np.ndarray, csr_matrix] = None,
+    **kwargs,
+):
+    """
+    Block coordinate ascent for sparse probability estimates.
+    If gain_func (a numba compiled gain of a single label, see numba_macro_precision_gain)
+    is given, the whole pass over instances runs in numba, otherwise utility_func is called for each instance.
+    With n_threads > 1 (requires gain_func), blocks of instances are processed in parallel,
+    trading some of the final expected utility for speed, see meta["times"] and meta["utilities"].
+    With resync_every > 1, Etp, Efp, Efn are kept as running sums and recalculated from scratch
+    only every resync_every passes or when the bound on their accumulated rounding error exceeds resync_tolerance.
+    The measured drift (against float64 recalculation) at each recalculation is reported in meta["drifts"],
+    with check_drift it is measured after every pass instead (at the cost of an additional recalculation).
+    precision selects the dtype of the running sums Etp, Efp, Efn: "float32", "float64" (the default if resync_every > 1)
+    or "float32-kahan" (float32 with Kahan compensation, requires the sequential compiled sweep).
+    It does not select the precision of gains, gain_func evaluates them from the values of the sums in all modes
+    (its arithmetic is promoted to float64 by numba).
+    With active_set (requires gain_func), instances whose top-k cannot change since their last visit are skipped,
+    see numba_bca_0approx_csr_active_sweep, the number of updated instances is reported in meta["active"].
+    With batch_size > 1 (requires gain_func), batches of instances are updated at once against frozen statistics,
+    see numba_bca_0approx_csr_batch_sweep, gains within a batch are calculated using n_threads.
+    With chunk_size (requires gain_func), the out-of-core bca_with_0approx_csr_chunked is used.
+    With return_top_k, the predictions are returned as (ni, k) array of labels instead of a sparse matrix.
+    init_y_pred warm starts the optimization from the given predictions instead of random ones, see as_top_k.
+    """
+    if chunk_size is not None:
+        if gain_func is None:
+            raise ValueError("chunk_size requires gain_func")
+        return bca_with_0approx_csr_chunked(
+            y_proba,
+            k,
+            utility_func,
+            gain_func,
+            chunk_size,
+            greedy_start=greedy_start,
+            tolerance=tolerance,
+            max_iter=max_iter,
+            shuffle_order=shuffle_order,
+            seed=seed,
+            alpha=alpha,
+            resync_every=resync_every,
+            return_top_k=return_top_k,
+            init_y_pred=init_y_pred,
+        )
+
+    if seed is not None:
+        print(f"  Using seed: {seed}")
+        np.random.seed(seed)
+
+    # Initialize the prediction variable with some feasible value or warm start from the given one
+    ni, nl = y_proba.shape
+    if init_y_pred is not None:
+        y_pred_top_k = as_top_k(init_y_pred, k)
+    else:
+        _, y_pred_indices, _ = numba_random_at_k(
+            y_proba.indices, y_proba.indptr, ni, nl, k, seed=seed
+        )
+
+        # For debug set it to first k labels
+        # y_pred_data, y_pred_indices, y_pred_indptr = numba_first_k(y_proba.data, y_proba.indices, y_proba.indptr, ni, nl, k)
+
+        y_pred_top_k = np.sort(y_pred_indices.reshape(ni, k), axis=1)
+
+    # Predictions are kept as (ni, k) array of sorted labels,
+    # y_pred is a sparse view of it (sharing the indices) used only by the slow path and for saving
+    y_pred = top_k_to_csr(y_pred_top_k, nl)
+
+    meta = {"utilities": [], "times": [], "drifts": [], "n_threads": n_threads}
+    if n_threads > 1:
+        if gain_func is None or SLOW:
+            raise ValueError("n_threads > 1 requires gain_func")
+        set_num_threads(min(n_threads, max_num_threads()))
+
+    if batch_size > 1:
+        if gain_func is None or SLOW or active_set:
+            raise ValueError("batch_size > 1 requires gain_func and no active_set")
+        set_num_threads(min(n_threads, max_num_threads()))
+
+    if active_set:
+        if gain_func is None or SLOW or n_threads > 1:
+            raise ValueError("active_set requires gain_func and n_threads = 1")
+        meta["active"] = []
+        label_version = np.zeros(nl, dtype=np.int64)
+        row_version = np.full(ni, -1, dtype=np.int64)
+
+    # Float64 or compensated running sums are accurate enough to skip some of the recalculations
+    if precision is None:
+        precision = "float32" if resync_every <= 1 else "float64"
+    if precision not in ("float32", "float64", "float32-kahan"):
+        raise ValueError(f"Unknown precision: {precision}")
+    compensated = precision == "float32-kahan"
+    if compensated and (
+        gain_func is None or SLOW or n_threads > 1 or batch_size > 1 or active_set
+    ):
+        raise ValueError(
+            "precision float32-kahan requires gain_func and the sequential sweep"
+        )
+    stats_dtype = np.float64 if precision == "float64" else FLOAT_TYPE
+    meta["precision"] = precision
+    stats_exact = False
+    drift_bound = 0
 
     for j in range(max_iter):
+        start_time = time.time()
         order = np.arange(ni)
         if shuffle_order:
             np.random.shuffle(order)
 
         # Recalculate expected conf matrices to prevent numerical errors from accumulating too much
         # In this variant they will be all np.matrix with shape (1, nl)
+        recalculated = True
         if greedy_start and j == 0:
-            Etp = np.zeros(nl, FLOAT_TYPE)
-            Efp = np.zeros(nl, FLOAT_TYPE)
-            Efn = np.zeros(nl, FLOAT_TYPE)
-        else:
+            Etp = np.zeros(nl, stats_dtype)
+            Efp = np.zeros(nl, stats_dtype)
+            Efn = np.zeros(nl, stats_dtype)
+            Ctp, Cfp, Cfn = np.zeros((3, nl), stats_dtype)
+        elif stats_exact:
+            pass
+        elif j % resync_every == 0 or drift_bound > resync_tolerance:
             if SLOW:
                 Etp = calculate_tp_csr_slow(y_proba, y_pred)
                 Efp = calculate_fp_csr_slow(y_proba, y_pred)
                 Efn = calculate_fn_csr_slow(y_proba, y_pred)
             else:
-                Etp = calculate_tp_csr(y_proba, y_pred)
-                Efp = calculate_fp_csr(y_proba, y_pred)
-                Efn = calculate_fn_csr(y_proba, y_pred)
+                exact_stats = numba_calculate_0approx_stats(
+                    y_proba.data,
+                    y_proba.indices,
+                    y_proba.indptr,
+                    y_pred_top_k.ravel(),
+                    ni,
+                    nl,
+                    k,
+                    np.float64,
+                )
+                if j > 0 and not check_drift:
+                    meta["drifts"].append(
+                        stats_drift((Etp, Efp, Efn), (Ctp, Cfp, Cfn), exact_stats, ni)
+                    )
+                Etp, Efp, Efn = (s.astype(stats_dtype) for s in exact_stats)
+            Ctp, Cfp, Cfn = np.zeros((3, nl), stats_dtype)
+            drift_bound = 0
+        else:
+            recalculated = False
 
-        old_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
+        if recalculated:
+            old_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
+        else:
+            old_utility = new_utility
 
         # Check expected conf matrices
         # print("Etp:", Etp.shape, type(Etp), Etp)
         # print("Efp:", Efp.shape, type(Efp), Efp)
         # print("Efn:", Efn.shape, type(Efn), Efn)
 
-        for i in tqdm(order):
-            # for i in order:
-
-            if SLOW:
-                eta = y_proba[i]
-                dense_ones = np.ones(nl, dtype=FLOAT_TYPE)
-
-                if not (greedy_start and j == 0):
-                    # Adjust local Etp, Efp, Efn
-                    Etp -= y_pred[i].multiply(eta)
-                    Efp -= y_pred[i].multiply(dense_ones - eta)
-                    Efn -= eta.multiply(dense_ones - y_pred[i])
-
-                Etpp = Etp + eta
-                Efpp = Efp + (dense_ones - eta)
-                Efnn = Efn + eta
-
-                # Calculate gain and selection
-                p_utility = utility_func(Etpp / ni, Efpp / ni, Efn / ni)
-                n_utility = utility_func(Etp / ni, Efp / ni, Efnn / ni)
-                gains = p_utility - n_utility
-                gains = np.asarray(gains).ravel()
-                top_k = np.argpartition(-gains, k)[:k]
-
-                # Update y_proba
-                y_pred.indices[y_pred.indptr[i] : y_pred.indptr[i + 1]] = sorted(top_k)
-
-                # Update Etp, Efp, Efn
-                Etp += y_pred[i].multiply(eta)
-                Efp += y_pred[i].multiply(dense_ones - eta)
-                Efn += eta.multiply(dense_ones - y_pred[i])
-
-            else:
-                r_start, r_end = y_pred.indptr[i], y_pred.indptr[i + 1]
-                p_start, p_end = y_proba.indptr[i], y_proba.indptr[i + 1]
+        if batch_size > 1:
+            numba_bca_0approx_csr_batch_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                Etp,
+                Efp,
+                Efn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+                batch_size,
+            )
+        elif n_threads > 1:
+            numba_bca_0approx_csr_parallel_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                Etp,
+                Efp,
+                Efn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+                n_threads,
+            )
+            # Concurrent updates of Etp, Efp, Efn may be lost, so recalculate them
+            Etp, Efp, Efn = numba_calculate_0approx_stats(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                ni,
+                nl,
+                k,
+                stats_dtype,
+            )
+        elif active_set:
+            visited = numba_bca_0approx_csr_active_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                Etp,
+                Efp,
+                Efn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+                label_version,
+                row_version,
+            )
+            meta["active"].append(visited)
+            print(f"  Updated {visited} / {ni} instances")
+        elif compensated:
+            numba_bca_0approx_csr_compensated_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                Etp,
+                Efp,
+                Efn,
+                Ctp,
+                Cfp,
+                Cfn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+            )
+        elif gain_func is not None and not SLOW:
+            numba_bca_0approx_csr_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                Etp,
+                Efp,
+                Efn,
+                order,
+                ni,
+                k,
+                gain_func,
+                alpha,
+                not (greedy_start and j == 0),
+            )
+        else:
+            for i in tqdm(order):
+                # for i in order:
+
+                if SLOW:
+                    eta = y_proba[i]
+                    dense_ones = np.ones(nl, dtype=FLOAT_TYPE)
+
+                    if not (greedy_start and j == 0):
+                        # Adjust local Etp, Efp, Efn
+                        Etp -= y_pred[i].multiply(eta)
+                        Efp -= y_pred[i].multiply(dense_ones - eta)
+                        Efn -= eta.multiply(dense_ones - y_pred[i])
+
+                    Etpp = Etp + eta
+                    Efpp = Efp + (dense_ones - eta)
+                    Efnn = Efn + eta
+
+                    # Calculate gain and selection
+                    p_utility = utility_func(Etpp / ni, Efpp / ni, Efn / ni)
+                    n_utility = utility_func(Etp / ni, Efp / ni, Efnn / ni)
+                    gains = p_utility - n_utility
+                    gains = np.asarray(gains).ravel()
+                    top_k = np.argpartition(-gains, k)[:k]
 
-                r_data = y_pred.data[r_start:r_end]
-                r_indices = y_pred.indices[r_start:r_end]
+                    # Update y_proba
+                    y_pred_top_k[i] = np.sort(top_k)
 
-                p_data = y_proba.data[p_start:p_end]
-                p_indices = y_proba.indices[p_start:p_end]
+                    # Update Etp, Efp, Efn
+                    Etp += y_pred[i].multiply(eta)
+                    Efp += y_pred[i].multiply(dense_ones - eta)
+                    Efn += eta.multiply(dense_ones - y_pred[i])
 
-                if not (greedy_start and j == 0):
-                    # Adjust local Etp, Efp, Efn
+                else:
+                    p_start, p_end = y_proba.indptr[i], y_proba.indptr[i + 1]
+
+                    r_data = np.ones(k, dtype=FLOAT_TYPE)
+                    r_indices = y_pred_top_k[i]
+
+                    p_data = y_proba.data[p_start:p_end]
+                    p_indices = y_proba.indices[p_start:p_end]
+
+                    if not (greedy_start and j == 0):
+                        # Adjust local Etp, Efp, Efn
+                        data, indices = numba_sparse_vec_mul_vec(
+                            r_data, r_indices, p_data, p_indices
+                        )
+                        Etp[indices] -= data
+                        data, indices = numba_sparse_vec_mul_ones_minus_vec(
+                            r_data, r_indices, p_data, p_indices
+                        )
+                        Efp[indices] -= data
+                        data, indices = numba_sparse_vec_mul_ones_minus_vec(
+                            p_data, p_indices, r_data, r_indices
+                        )
+                        Efn[indices] -= data
+
+                    p_Etp = Etp[p_indices]
+                    p_Efp = Efp[p_indices]
+                    p_Efn = Efn[p_indices]
+
+                    p_Etpp = Etp[p_indices] + p_data
+                    p_Efpp = Efp[p_indices] + (1 - p_data)
+                    p_Efnn = Efn[p_indices] + p_data
+
+                    # Calculate gain and selection
+                    p_utility = utility_func(p_Etpp / ni, p_Efpp / ni, p_Efn / ni)
+                    n_utility = utility_func(p_Etp / ni, p_Efp / ni, p_Efnn / ni)
+
+                    # Update select labels with highest gain and update y_proba
+                    gains = p_utility - n_utility
+                    gains = np.asarray(gains).ravel()
+                    if gains.size > k:
+                        top_k = np.argpartition(-gains, k)[:k]
+                        y_pred_top_k[i] = np.sort(p_indices[top_k])
+                    else:
+                        p_indices = np.resize(p_indices, k)
+                        p_indices[gains.size :] = 0
+                        y_pred_top_k[i] = np.sort(p_indices)
+
+                    # Update Etp, Efp, Efn
                     data, indices = numba_sparse_vec_mul_vec(
                         r_data, r_indices, p_data, p_indices
                     )
-                    Etp[indices] -= data
+                    Etp[indices] += data
                     data, indices = numba_sparse_vec_mul_ones_minus_vec(
                         r_data, r_indices, p_data, p_indices
                     )
-                    Efp[indices] -= data
+                    Efp[indices] += data
                     data, indices = numba_sparse_vec_mul_ones_minus_vec(
                         p_data, p_indices, r_data, r_indices
                     )
-                    Efn[indices] -= data
-
-                p_Etp = Etp[p_indices]
-                p_Efp = Efp[p_indices]
-                p_Efn = Efn[p_indices]
-
-                p_Etpp = Etp[p_indices] + p_data
-                p_Efpp = Efp[p_indices] + (1 - p_data)
-                p_Efnn = Efn[p_indices] + p_data
-
-                # Calculate gain and selection
-                p_utility = utility_func(p_Etpp / ni, p_Efpp / ni, p_Efn / ni)
-                n_utility = utility_func(p_Etp / ni, p_Efp / ni, p_Efnn / ni)
-
-                # Update select labels with highest gain and update y_proba
-                gains = p_utility - n_utility
-                gains = np.asarray(gains).ravel()
-                if gains.size > k:
-                    top_k = np.argpartition(-gains, k)[:k]
-                    y_pred.indices[r_start:r_end] = sorted(p_indices[top_k])
-                else:
-                    p_indices = np.resize(p_indices, k)
-                    p_indices[gains.size :] = 0
-                    y_pred.indices[r_start:r_end] = sorted(p_indices)
-
-                # Update Etp, Efp, Efn
-                data, indices = numba_sparse_vec_mul_vec(
-                    r_data, r_indices, p_data, p_indices
-                )
-                Etp[indices] += data
-                data, indices = numba_sparse_vec_mul_ones_minus_vec(
-                    r_data, r_indices, p_data, p_indices
-                )
-                Efp[indices] += data
-                data, indices = numba_sparse_vec_mul_ones_minus_vec(
-                    p_data, p_indices, r_data, r_indices
-                )
-                Efn[indices] += data
+                    Efn[indices] += data
+
+        # Each instance removes and adds its contribution, bound the rounding error of these updates
+        # (Kahan summation keeps the error independent of the number of updates up to the second order)
+        stats_exact = n_threads > 1 and batch_size <= 1
+        eps = np.finfo(stats_dtype).eps
+        updates = 2 * y_proba.nnz
+        drift_bound += (
+            (2 + updates * eps if compensated else updates)
+            * eps
+            * max(Etp.max(), Efp.max(), Efn.max())
+            / ni
+        )
+        if check_drift and not SLOW:
+            exact_stats = numba_calculate_0approx_stats(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                ni,
+                nl,
+                k,
+                np.float64,
+            )
+            meta["drifts"].append(
+                stats_drift((Etp, Efp, Efn), (Ctp, Cfp, Cfn), exact_stats, ni)
+            )
+            print(f"  Drift: {meta['drifts'][-1]}, bound: {drift_bound}")
 
         new_utility = np.mean(utility_func(Etp / ni, Efp / ni, Efn / ni))
         meta["utilities"].append(new_utility)
+        meta["times"].append(time.time() - start_time)
         print(
-            f"  Iteration {j + 1} finished, expected score: {old_utility} -> {new_utility}"
+            f"  Iteration {j + 1} finished in {meta['times'][-1]:.2f}s, expected score: {old_utility} -> {new_utility}"
         )
         if new_utility <= old_utility + tolerance:
             break
@@ -333,9 +1617,12 @@ def bca_with_0approx_csr(
             save_npz(f"{filename}_pred_iter_{j + 1}.npz", y_pred)
 
     meta["iters"] = j
+    if return_top_k:
+        return y_pred_top_k, meta
     return y_pred, meta
 
 
+@restores_num_threads
 def bca_coverage_csr(
     y_proba: csr_matrix,
     k: int,
@@ -346,89 +1633,223 @@ def bca_coverage_csr(
     shuffle_order: bool = True,
     seed: int = None,
     filename: str = None,
+    n_threads: int = 1,
+    active_set: bool = False,
+    batch_size: int = 1,
+    return_top_k: bool = False,
+    init_y_pred: Union[np.ndarray, csr_matrix] = None,
     **kwargs,
 ):
     """
-    An efficient implementation of the block coordinate-descent for coverage
+    An efficient implementation of the block coordinate-descent for coverage.
+    With n_threads > 1, blocks of instances are processed in parallel,
+    trading some of the final expected coverage for speed, see meta["times"] and meta["utilities"].
+    With active_set, instances whose top-k cannot change since their last visit are skipped,
+    see numba_bca_coverage_csr_active_sweep, the number of updated instances is reported in meta["active"].
+    With batch_size > 1, batches of instances are updated at once against frozen probabilities of failure,
+    see numba_bca_coverage_csr_batch_sweep, gains within a batch are calculated using n_threads.
+    With return_top_k, the predictions are returned as (ni, k) array of labels instead of a sparse matrix.
+    init_y_pred warm starts the optimization from the given predictions instead of random ones, see as_top_k.
+    The probabilities of not covering each label are kept in log domain (see numba_update_log_failure_prob),
+    so they are updated without division, y_proba is not modified and there is no need to recalculate them every pass.
     """
     if seed is not None:
         print(f"  Using seed: {seed}")
         np.random.seed(seed)
 
-    # Initialize the prediction variable with some feasible value
+    # Initialize the prediction variable with some feasible value or warm start from the given one
     ni, nl = y_proba.shape
-    y_pred_data, y_pred_indices, y_pred_indptr = numba_random_at_k(
-        y_proba.indices, y_proba.indptr, ni, nl, k, seed=seed
-    )
+    if init_y_pred is not None:
+        y_pred_top_k = as_top_k(init_y_pred, k)
+    else:
+        _, y_pred_indices, _ = numba_random_at_k(
+            y_proba.indices, y_proba.indptr, ni, nl, k, seed=seed
+        )
 
-    # For debug set it to first k labels
-    # y_pred_data, y_pred_indices, y_pred_indptr = numba_first_k(y_proba.data, y_proba.indices, y_proba.indptr, ni, nl, k)
+        # For debug set it to first k labels
+        # y_pred_data, y_pred_indices, y_pred_indptr = numba_first_k(y_proba.data, y_proba.indices, y_proba.indptr, ni, nl, k)
 
-    y_pred = construct_csr_matrix(
-        y_pred_data, y_pred_indices, y_pred_indptr, shape=(ni, nl), sort_indices=True
-    )
-    y_proba.data = np.minimum(y_proba.data, 1 - 1e-5)
+        y_pred_top_k = np.sort(y_pred_indices.reshape(ni, k), axis=1)
 
-    meta = {"utilities": []}
+    # Predictions are kept as (ni, k) array of sorted labels,
+    # y_pred is a sparse view of it (sharing the indices) used only by the slow path and for saving
+    y_pred = top_k_to_csr(y_pred_top_k, nl)
+
+    def calculate_log_failure_prob():
+        return numba_calculate_log_failure_prob(
+            y_proba.data,
+            y_proba.indices,
+            y_proba.indptr,
+            y_pred_top_k.ravel(),
+            ni,
+            nl,
+            k,
+        )
+
+    def calculate_failure_prob():
+        return np.where(n_certain > 0, 0, np.exp(log_failure))
+
+    meta = {"utilities": [], "times": [], "n_threads": n_threads}
+    if n_threads > 1:
+        set_num_threads(min(n_threads, max_num_threads()))
+
+    if batch_size > 1:
+        if SLOW or active_set:
+            raise ValueError("batch_size > 1 requires no active_set")
+        set_num_threads(min(n_threads, max_num_threads()))
+
+    if active_set:
+        if SLOW or n_threads > 1:
+            raise ValueError("active_set requires n_threads = 1")
+        meta["active"] = []
+        label_version = np.zeros(nl, dtype=np.int64)
+        row_version = np.full(ni, -1, dtype=np.int64)
 
     for j in range(max_iter):
+        start_time = time.time()
         order = np.arange(ni)
         if shuffle_order:
             np.random.shuffle(order)
 
         if greedy_start and j == 0:
-            failure_prob = np.ones(nl, dtype=FLOAT_TYPE)
-        else:
-            failure_prob = numba_calculate_prod_1_sparse_mat_mul_ones_minus_mat(
-                *unpack_csr_matrices(y_pred, y_proba), ni, nl
+            log_failure = np.zeros(nl, dtype=np.float64)
+            n_certain = np.zeros(nl, dtype=np.int64)
+        elif j == 0:
+            log_failure, n_certain = calculate_log_failure_prob()
+
+        old_cov = 1 - np.mean(calculate_failure_prob())
+        if alpha < 1:
+            old_cov = (
+                alpha * old_cov
+                + (1 - alpha)
+                * np.asarray(calculate_tp_csr(y_proba, y_pred) / ni / k).ravel().mean()
             )
 
-        old_cov = 1 - np.mean(failure_prob)
-        if(alpha < 1):
-            old_cov = alpha * old_cov + (1 - alpha) * np.asarray(calculate_tp_csr(y_proba, y_pred) / ni / k).ravel().mean()
+        if batch_size > 1:
+            numba_bca_coverage_csr_batch_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                log_failure,
+                n_certain,
+                order,
+                k,
+                alpha,
+                not (greedy_start and j == 0),
+                batch_size,
+            )
+        elif n_threads > 1:
+            numba_bca_coverage_csr_parallel_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                log_failure,
+                n_certain,
+                order,
+                k,
+                alpha,
+                not (greedy_start and j == 0),
+                n_threads,
+            )
+            # Concurrent updates of log_failure and n_certain may be lost, so recalculate them
+            log_failure, n_certain = calculate_log_failure_prob()
+        elif active_set:
+            visited = numba_bca_coverage_csr_active_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                log_failure,
+                n_certain,
+                order,
+                k,
+                alpha,
+                not (greedy_start and j == 0),
+                label_version,
+                row_version,
+            )
+            meta["active"].append(visited)
+            print(f"  Updated {visited} / {ni} instances")
+        elif not SLOW:
+            numba_bca_coverage_csr_sweep(
+                y_proba.data,
+                y_proba.indices,
+                y_proba.indptr,
+                y_pred_top_k.ravel(),
+                log_failure,
+                n_certain,
+                order,
+                k,
+                alpha,
+                not (greedy_start and j == 0),
+            )
+        else:
+            # The slow loop divides by 1 - p, so both the probabilities of failure
+            # and their updates are calculated from the same clamped probabilities
+            p_clamped = np.minimum(y_proba.data, 1 - 1e-5)
+            if greedy_start and j == 0:
+                failure_prob = np.ones(nl, dtype=np.float64)
+            else:
+                failure_prob = np.exp(
+                    numba_calculate_log_failure_prob(
+                        p_clamped,
+                        y_proba.indices,
+                        y_proba.indptr,
+                        y_pred_top_k.ravel(),
+                        ni,
+                        nl,
+                        k,
+                    )[0]
+                )
+            for i in tqdm(order):
+                # for i in order:
+                p_start, p_end = y_proba.indptr[i], y_proba.indptr[i + 1]
 
-        for i in tqdm(order):
-            # for i in order:
-            r_start, r_end = y_pred.indptr[i], y_pred.indptr[i + 1]
-            p_start, p_end = y_proba.indptr[i], y_proba.indptr[i + 1]
+                r_data = np.ones(k, dtype=FLOAT_TYPE)
+                r_indices = y_pred_top_k[i]
 
-            r_data = y_pred.data[r_start:r_end]
-            r_indices = y_pred.indices[r_start:r_end]
+                p_data = p_clamped[p_start:p_end]
+                p_indices = y_proba.indices[p_start:p_end]
 
-            p_data = y_proba.data[p_start:p_end]
-            p_indices = y_proba.indices[p_start:p_end]
+                if not (greedy_start and j == 0):
+                    # Adjust local probablity of the failure (not covering the label)
+                    data, indices = numba_sparse_vec_mul_ones_minus_vec(
+                        r_data, r_indices, p_data, p_indices
+                    )
+                    failure_prob[indices] /= data
 
-            if not (greedy_start and j == 0):
-                # Adjust local probablity of the failure (not covering the label)
+                # Calculate gain and selectio
+                gains = failure_prob[p_indices] * p_data
+                if alpha < 1:
+                    gains = alpha * gains + (1 - alpha) * p_data / k
+                if gains.size > k:
+                    top_k = np.argpartition(-gains, k)[:k]
+                    y_pred_top_k[i] = np.sort(p_indices[top_k])
+                else:
+                    p_indices = np.resize(p_indices, k)
+                    p_indices[gains.size :] = 0
+                    y_pred_top_k[i] = np.sort(p_indices)
+
+                # Update probablity of the failure (not covering the label)
                 data, indices = numba_sparse_vec_mul_ones_minus_vec(
                     r_data, r_indices, p_data, p_indices
                 )
-                failure_prob[indices] /= data
-
-            # Calculate gain and selectio
-            gains = failure_prob[p_indices] * p_data
-            if alpha < 1:
-                gains = alpha * gains + (1 - alpha) * p_data / k
-            if gains.size > k:
-                top_k = np.argpartition(-gains, k)[:k]
-                y_pred.indices[r_start:r_end] = sorted(p_indices[top_k])
-            else:
-                p_indices = np.resize(p_indices, k)
-                p_indices[gains.size :] = 0
-                y_pred.indices[r_start:r_end] = sorted(p_indices)
-
-            # Update probablity of the failure (not covering the label)
-            data, indices = numba_sparse_vec_mul_ones_minus_vec(
-                r_data, r_indices, p_data, p_indices
+                failure_prob[indices] *= data
+            log_failure, n_certain = calculate_log_failure_prob()
+
+        new_cov = 1 - np.mean(calculate_failure_prob())
+        if alpha < 1:
+            new_cov = (
+                alpha * new_cov
+                + (1 - alpha)
+                * np.asarray(calculate_tp_csr(y_proba, y_pred) / ni / k).ravel().mean()
             )
-            failure_prob[indices] *= data
-
-        new_cov = 1 - np.mean(failure_prob)
-        if(alpha < 1):
-            new_cov = alpha * new_cov + (1 - alpha) * np.asarray(calculate_tp_csr(y_proba, y_pred) / ni / k).ravel().mean()
         meta["utilities"].append(new_cov)
+        meta["times"].append(time.time() - start_time)
         print(
-            f"  Iteration {j + 1} finished, expected coverage: {old_cov} -> {new_cov}"
+            f"  Iteration {j + 1} finished in {meta['times'][-1]:.2f}s, expected coverage: {old_cov} -> {new_cov}"
         )
         if new_cov <= old_cov + tolerance:
             break
@@ -437,6 +1858,8 @@ def bca_coverage_csr(
             save_npz(f"{filename}_pred_iter_{j + 1}.npz", y_pred)
 
     meta["iters"] = j
+    if return_top_k:
+        return y_pred_top_k, meta
     return y_pred, meta
 
 
@@ -469,8 +1892,15 @@ def bca_with_0approx(
     tolerance: float = 1e-6,
     max_iter: int = 100,
     seed: int = None,
+    gain_func: callable = None,
     **kwargs,
 ):
+    """
+    If gain_func is not given, the closed-form gain of utility_func is looked up in GAIN_FUNCS.
+    """
+    if gain_func is None:
+        gain_func = GAIN_FUNCS.get(utility_func)
+
     if isinstance(y_proba, np.ndarray):
         # Invoke original dense implementation of Erik
         return bca_with_0approx_np(
@@ -480,6 +1910,7 @@ def bca_with_0approx(
             tolerance=tolerance,
             max_iter=max_iter,
             seed=seed,
+            gain_func=gain_func,
             **kwargs,
         )
     elif isinstance(y_proba, csr_matrix):
@@ -491,15 +1922,74 @@ def bca_with_0approx(
             tolerance=tolerance,
             max_iter=max_iter,
             seed=seed,
+            gain_func=gain_func,
             **kwargs,
         )
     else:
         raise ValueError("y_proba must be either np.ndarray or csr_matrix")
 
 
+def bca_path(
+    method: callable,
+    y_proba: Union[np.ndarray, csr_matrix],
+    k: int,
+    param: str = "alpha",
+    values: list = (),
+    **kwargs,
+):
+    """
+    Runs method (one of block_coordinate_* functions) for each value of param, one after another,
+    warm starting each run from the predictions of the previous one.
+    Values are visited in decreasing order: for tolerance each run continues from a less converged solution,
+    for alpha each run starts from the solution with a larger weight of the macro measure (or coverage),
+    which is harder to reach from a random start than from the solution of a close alpha.
+    Yields (value, y_pred, meta) after each run.
+    """
+    values = sorted(values, reverse=True)
+    y_pred_top_k = None
+    for value in values:
+        print(f"  Running with {param}={value}")
+        y_pred_top_k, meta = method(
+            y_proba,
+            k=k,
+            init_y_pred=y_pred_top_k,
+            return_top_k=True,
+            **{param: value},
+            **kwargs,
+        )
+        yield value, top_k_to_y_pred(y_pred_top_k, y_proba), meta
+
+
+def bca_multi_k(
+    method: callable,
+    y_proba: Union[np.ndarray, csr_matrix],
+    ks: list = (),
+    **kwargs,
+):
+    """
+    Runs method (one of block_coordinate_* functions) for each k in ks in increasing order,
+    warm starting each run from the predictions for the previous k extended
+    with the labels of the highest probabilities that are not yet predicted.
+    Yields (k, y_pred, meta) after each run.
+    """
+    y_pred_top_k = None
+    for k in sorted(ks):
+        print(f"  Running with k={k}")
+        if y_pred_top_k is not None:
+            y_pred_top_k = extend_top_k(y_pred_top_k, y_proba, k)
+        y_pred_top_k, meta = method(
+            y_proba,
+            k=k,
+            init_y_pred=y_pred_top_k,
+            return_top_k=True,
+            **kwargs,
+        )
+        yield k, top_k_to_y_pred(y_pred_top_k, y_proba), meta
+
 
 # Implementations of functions for optimizing specific measures
 
+
 def instance_precision_at_k_on_conf_matrix(tp, fp, fn, k):
     return np.asarray(tp / k).ravel()
 
@@ -515,12 +2005,77 @@ def macro_recall_on_conf_matrix(tp, fp, fn, epsilon=EPS):
 def macro_fmeasure_on_conf_matrix(tp, fp, fn, beta=1.0, epsilon=EPS):
     precision = macro_precision_on_conf_matrix(tp, fp, fn, epsilon=epsilon)
     recall = macro_recall_on_conf_matrix(tp, fp, fn, epsilon=epsilon)
-    return (
-        (1 + beta**2)
-        * precision
-        * recall
-        / (beta**2 * precision + recall + epsilon)
-    )
+    return (1 + beta**2) * precision * recall / (beta**2 * precision + recall + epsilon)
+
+
+# Closed-form gains of the above functions, used to calculate gains inside numba sweeps
+# Gain functions follow the signature (tp, fp, fn, eta, ni, k, alpha) where tp, fp, fn are not normalized
+# and return utility(tp + eta, fp + 1 - eta, fn) - utility(tp, fp, fn + eta) (on normalized values)
+# simplified to a single fraction, see GAIN_FUNCS
+
+
+@njit
+def numba_macro_precision_gain(tp, fp, fn, eta, ni, k, alpha, epsilon=EPS):
+    # (t + h) / (D + d) - t / D with D = t + f + epsilon
+    t, h, d = tp / ni, eta / ni, 1 / ni
+    D = t + fp / ni + epsilon
+    return (h * D - t * d) / (D * (D + d))
+
+
+@njit
+def numba_macro_recall_gain(tp, fp, fn, eta, ni, k, alpha, epsilon=EPS):
+    # Both states have the same denominator t + n + h + epsilon
+    return (eta / ni) / ((tp + fn + eta) / ni + epsilon)
+
+
+@njit
+def numba_macro_fmeasure_gain(tp, fp, fn, eta, ni, k, alpha, beta=1.0, epsilon=EPS):
+    # macro_fmeasure_on_conf_matrix with precision t / a and recall t / c is equal to
+    # (1 + beta^2) t^2 / (t (beta^2 c + a) + epsilon a c)
+    b2 = beta**2
+    t, f, n, h = tp / ni, fp / ni, fn / ni, eta / ni
+    p_t = t + h
+    p_a = p_t + f + 1 / ni - h + epsilon
+    p_c = p_t + n + epsilon
+    p_den = p_t * (b2 * p_c + p_a) + epsilon * p_a * p_c
+    n_a = t + f + epsilon
+    n_c = t + n + h + epsilon
+    n_den = t * (b2 * n_c + n_a) + epsilon * n_a * n_c
+    return (1 + b2) * (p_t * p_t * n_den - t * t * p_den) / (p_den * n_den)
+
+
+@njit
+def numba_instance_precision_at_k_gain(tp, fp, fn, eta, ni, k, alpha):
+    return eta / ni / k
+
+
+@njit
+def numba_mixed_instance_prec_macro_prec_gain(tp, fp, fn, eta, ni, k, alpha):
+    return (1 - alpha) * numba_instance_precision_at_k_gain(
+        tp, fp, fn, eta, ni, k, alpha
+    ) + alpha * numba_macro_precision_gain(tp, fp, fn, eta, ni, k, alpha)
+
+
+@njit
+def numba_mixed_instance_prec_macro_f1_gain(tp, fp, fn, eta, ni, k, alpha):
+    return (1 - alpha) * numba_instance_precision_at_k_gain(
+        tp, fp, fn, eta, ni, k, alpha
+    ) + alpha * numba_macro_fmeasure_gain(tp, fp, fn, eta, ni, k, alpha)
+
+
+@njit
+def numba_mixed_instance_prec_macro_recall_gain(tp, fp, fn, eta, ni, k, alpha):
+    return (1 - alpha) * numba_instance_precision_at_k_gain(
+        tp, fp, fn, eta, ni, k, alpha
+    ) + alpha * numba_macro_recall_gain(tp, fp, fn, eta, ni, k, alpha)
+
+
+# Gain functions used by bca_with_0approx for the known utility functions if no gain_func is given
+GAIN_FUNCS = {
+    macro_precision_on_conf_matrix: numba_macro_precision_gain,
+    macro_recall_on_conf_matrix: numba_macro_recall_gain,
+    macro_fmeasure_on_conf_matrix: numba_macro_fmeasure_gain,
+}
 
 
 def block_coordinate_coverage(
@@ -533,7 +2088,10 @@ def block_coordinate_macro_precision(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, **kwargs
 ):
     return bca_with_0approx(
-        y_proba, k=k, utility_func=macro_precision_on_conf_matrix, **kwargs
+        y_proba,
+        k=k,
+        utility_func=macro_precision_on_conf_matrix,
+        **kwargs,
     )
 
 
@@ -541,7 +2099,10 @@ def block_coordinate_macro_recall(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, **kwargs
 ):
     return bca_with_0approx(
-        y_proba, k=k, utility_func=macro_recall_on_conf_matrix, **kwargs
+        y_proba,
+        k=k,
+        utility_func=macro_recall_on_conf_matrix,
+        **kwargs,
     )
 
 
@@ -549,7 +2110,10 @@ def block_coordinate_macro_f1(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, **kwargs
 ):
     return bca_with_0approx(
-        y_proba, k=k, utility_func=macro_fmeasure_on_conf_matrix, **kwargs
+        y_proba,
+        k=k,
+        utility_func=macro_fmeasure_on_conf_matrix,
+        **kwargs,
     )
 
 
@@ -557,10 +2121,17 @@ def block_coordinate_mixed_instance_prec_macro_prec(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, alpha: float = 0.5, **kwargs
 ):
     def mixed_precision_alpha_fn(tp, fp, fn):
-        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(tp, fp, fn, k) + alpha * macro_precision_on_conf_matrix(tp, fp, fn)
+        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(
+            tp, fp, fn, k
+        ) + alpha * macro_precision_on_conf_matrix(tp, fp, fn)
 
     return bca_with_0approx(
-        y_proba, k=k, utility_func=mixed_precision_alpha_fn, **kwargs
+        y_proba,
+        k=k,
+        utility_func=mixed_precision_alpha_fn,
+        gain_func=numba_mixed_instance_prec_macro_prec_gain,
+        alpha=alpha,
+        **kwargs,
     )
 
 
@@ -568,10 +2139,17 @@ def block_coordinate_mixed_instance_prec_macro_f1(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, alpha: float = 0.5, **kwargs
 ):
     def mixed_precision_alpha_fn(tp, fp, fn):
-        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(tp, fp, fn, k) + alpha * macro_fmeasure_on_conf_matrix(tp, fp, fn)
+        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(
+            tp, fp, fn, k
+        ) + alpha * macro_fmeasure_on_conf_matrix(tp, fp, fn)
 
     return bca_with_0approx(
-        y_proba, k=k, utility_func=mixed_precision_alpha_fn, **kwargs
+        y_proba,
+        k=k,
+        utility_func=mixed_precision_alpha_fn,
+        gain_func=numba_mixed_instance_prec_macro_f1_gain,
+        alpha=alpha,
+        **kwargs,
     )
 
 
@@ -579,9 +2157,26 @@ def block_coordinate_mixed_instance_prec_macro_recall(
     y_proba: Union[np.ndarray, csr_matrix], k: int = 5, alpha: float = 0.5, **kwargs
 ):
     def mixed_precision_alpha_fn(tp, fp, fn):
-        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(tp, fp, fn, k) + alpha * macro_recall_on_conf_matrix(tp, fp, fn)
+        return (1 - alpha) * instance_precision_at_k_on_conf_matrix(
+            tp, fp, fn, k
+        ) + alpha * macro_recall_on_conf_matrix(tp, fp, fn)
 
     return bca_with_0approx(
-        y_proba, k=k, utility_func=mixed_precision_alpha_fn, **kwargs
+        y_proba,
+        k=k,
+        utility_func=mixed_precision_alpha_fn,
+        gain_func=numba_mixed_instance_prec_macro_recall_gain,
+        alpha=alpha,
+        **kwargs,
     )
 
+
+# Methods that run out-of-core with chunk_size on sparse predictions, see bca_with_0approx_csr_chunked
+CHUNKED_METHODS = (
+    block_coordinate_macro_precision,
+    block_coordinate_macro_recall,
+    block_coordinate_macro_f1,
+    block_coordinate_mixed_instance_prec_macro_prec,
+    block_coordinate_mixed_instance_prec_macro_f1,
+    block_coordinate_mixed_instance_prec_macro_recall,
+)
@@ -6,8 +6,15 @@ from typing import Union
 from math import log2, log
 from tqdm import tqdm
 import pickle
+import glob
+import json
+import hashlib
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from numba import njit
 
 from utils_sparse import construct_csr_matrix
+from utils_misc import content_hash, atomic_save, save_json, default_n_jobs
 
 
 def load_dataset(path: Path) -> np.ndarray:
@@ -39,7 +46,48 @@ def load_npy_dataset(path: str, num_ins, num_lbl):
     return label_matrix
 
 
-def load_txt_labels(
+def parse_txt_labels_lines(
+    lines, labels_delimiter=",", labels_features_delimiter=" ", labels_map=None
+):
+    """
+    Parses lines of labels, returns data, indices and indptr of the CSR matrix and whether its indices require sorting
+    """
+    data = []
+    indices = []
+    indptr = [0]
+    requires_sort = False
+
+    for i, line in enumerate(lines):
+        labels = line
+        if labels_features_delimiter is not None:
+            labels = line.split(labels_features_delimiter)[0]
+        labels = labels.split(labels_delimiter)
+        if len(labels) == 1 and labels[0] == "":
+            indptr.append(len(indices))
+            continue
+
+        prev = -1
+        for l in labels:
+            if labels_map is not None:
+                ind = labels_map[l.strip()]
+            else:
+                ind = int(l)
+            indices.append(ind)
+            data.append(1.0)
+            if prev > ind:
+                requires_sort = True
+            prev = ind
+        indptr.append(len(indices))
+
+    return (
+        np.array(data, dtype=np.float32),
+        np.array(indices, dtype=np.int64),
+        np.array(indptr, dtype=np.int64),
+        requires_sort,
+    )
+
+
+def load_txt_labels_slow(
     path: str,
     header=True,
     labels_delimiter=",",
@@ -47,38 +95,15 @@ def load_txt_labels(
     labels_map: dict = None,
 ):
     """
-    Loads the sparse label matrix from the XMC repository dataset or similar text format
+    Python implementation of load_txt_labels, used with labels_map or delimiters longer than a single character
     """
     with open(path, "r") as file:
-        data = []
-        indices = []
-        indptr = [0]
-        requires_sort = False
-
         if header:
             num_ins, num_ftr, num_lbl = file.readline().split(" ")
 
-        for i, line in enumerate(file):
-            labels = line
-            if labels_features_delimiter is not None:
-                labels = line.split(labels_features_delimiter)[0]
-            labels = labels.split(labels_delimiter)
-            if len(labels) == 1 and labels[0] == "":
-                indptr.append(len(indices))
-                continue
-
-            prev = -1
-            for l in labels:
-                if labels_map is not None:
-                    ind = labels_map[l.strip()]
-                else:
-                    ind = int(l)
-                indices.append(ind)
-                data.append(1.0)
-                if prev > ind:
-                    requires_sort = True
-                prev = ind
-            indptr.append(len(indices))
+        data, indices, indptr, requires_sort = parse_txt_labels_lines(
+            file, labels_delimiter, labels_features_delimiter, labels_map
+        )
 
     if requires_sort:
         print(
@@ -90,10 +115,9 @@ def load_txt_labels(
     )
 
 
-def load_txt_sparse_pred(path: str):
+def load_txt_sparse_pred_slow(path: str):
     """
-    Loads the sparse prediction matrix from libsvm like format:
-    <label>:<value> <label>:<value> ...
+    Python implementation of load_txt_sparse_pred
     """
     with open(path, "r") as file:
         data = []
@@ -118,6 +142,564 @@ def load_txt_sparse_pred(path: str):
     )
 
 
+NEWLINE = ord("\n")
+COLON = ord(":")
+
+
+@njit
+def numba_is_space(c):
+    return c == 32 or c == 9 or c == 13
+
+
+@njit
+def numba_count_lines(buf: np.ndarray):
+    n = 0
+    for c in buf:
+        if c == NEWLINE:
+            n += 1
+    if buf.size > 0 and buf[-1] != NEWLINE:
+        n += 1
+    return n
+
+
+@njit
+def numba_skip_line(buf: np.ndarray, pos: int):
+    while pos < buf.size and buf[pos] != NEWLINE:
+        pos += 1
+    return pos + 1
+
+
+@njit
+def numba_parse_labels(buf: np.ndarray, labels_delimiter: int, features_delimiter: int):
+    """
+    Parses label lines (labels separated by labels_delimiter, optionally followed by features after features_delimiter,
+    -1 if there are no features) from the bytes of a text file. Whitespace around labels is ignored,
+    other characters raise ValueError. Returns indices, indptr of the CSR matrix and whether its indices require sorting.
+    """
+    n_lines = numba_count_lines(buf)
+    max_nnz = n_lines
+    for c in buf:
+        if c == labels_delimiter:
+            max_nnz += 1
+    indices = np.empty(max_nnz, dtype=np.int64)
+    indptr = np.zeros(n_lines + 1, dtype=np.int64)
+    requires_sort = False
+
+    pos = nnz = row = 0
+    while pos < buf.size:
+        in_labels = True
+        has_digit = has_space = False
+        value = 0
+        prev = -1
+        while pos < buf.size and buf[pos] != NEWLINE:
+            c = buf[pos]
+            pos += 1
+            if not in_labels:
+                continue
+            if 48 <= c <= 57:
+                if has_digit and has_space:
+                    raise ValueError("Unexpected whitespace inside a label")
+                value = value * 10 + c - 48
+                has_digit = True
+            elif c == labels_delimiter or c == features_delimiter:
+                if has_digit:
+                    indices[nnz] = value
+                    nnz += 1
+                    if prev > value:
+                        requires_sort = True
+                    prev = value
+                value = 0
+                has_digit = has_space = False
+                if c == features_delimiter:
+                    in_labels = False
+            elif numba_is_space(c):
+                has_space = True
+            else:
+                raise ValueError("Unexpected character in labels")
+        if in_labels and has_digit:
+            indices[nnz] = value
+            nnz += 1
+            if prev > value:
+                requires_sort = True
+        pos += 1
+        row += 1
+        indptr[row] = nnz
+
+    return indices[:nnz], indptr, requires_sort
+
+
+@njit
+def numba_tokenize_labels(
+    buf: np.ndarray, labels_delimiter: int, features_delimiter: int
+):
+    """
+    Finds the labels (tokens) in label lines, see numba_parse_labels. Whitespace around tokens is stripped
+    and empty tokens are skipped. With a whitespace labels_delimiter, tokens are separated by any whitespace,
+    like str.split(). Returns starts and ends of the tokens in buf and indptr of the rows.
+    """
+    split_on_space = numba_is_space(labels_delimiter)
+    n_lines = numba_count_lines(buf)
+    max_tokens = n_lines
+    for c in buf:
+        if c == labels_delimiter or (split_on_space and numba_is_space(c)):
+            max_tokens += 1
+    starts = np.empty(max_tokens, dtype=np.int64)
+    ends = np.empty(max_tokens, dtype=np.int64)
+    indptr = np.zeros(n_lines + 1, dtype=np.int64)
+
+    pos = n = row = 0
+    while pos < buf.size:
+        in_labels = True
+        token_start = pos
+        while True:
+            at_end = pos >= buf.size or buf[pos] == NEWLINE
+            c = NEWLINE if at_end else buf[pos]
+            if in_labels and (
+                at_end
+                or c == labels_delimiter
+                or c == features_delimiter
+                or (split_on_space and numba_is_space(c))
+            ):
+                s, e = token_start, pos
+                while s < e and numba_is_space(buf[s]):
+                    s += 1
+                while e > s and numba_is_space(buf[e - 1]):
+                    e -= 1
+                if e > s:
+                    starts[n] = s
+                    ends[n] = e
+                    n += 1
+                token_start = pos + 1
+                if c == features_delimiter:
+                    in_labels = False
+            if at_end:
+                break
+            pos += 1
+        pos += 1
+        row += 1
+        indptr[row] = n
+
+    return starts[:n], ends[:n], indptr
+
+
+@njit
+def numba_gather_tokens(
+    buf: np.ndarray, starts: np.ndarray, ends: np.ndarray, width: int
+):
+    out = np.zeros((starts.size, width), dtype=np.uint8)
+    for i in range(starts.size):
+        out[i, : ends[i] - starts[i]] = buf[starts[i] : ends[i]]
+    return out
+
+
+@njit
+def numba_parse_float(buf: np.ndarray, pos: int):
+    """
+    Parses a decimal number (with optional sign, fraction and exponent) starting at pos,
+    returns its value and the position after it.
+    """
+    sign = 1.0
+    if pos < buf.size and (buf[pos] == 45 or buf[pos] == 43):  # - or +
+        if buf[pos] == 45:
+            sign = -1.0
+        pos += 1
+    mantissa = 0.0
+    exponent = 0
+    while pos < buf.size and 48 <= buf[pos] <= 57:
+        mantissa = mantissa * 10 + (buf[pos] - 48)
+        pos += 1
+    if pos < buf.size and buf[pos] == 46:  # .
+        pos += 1
+        while pos < buf.size and 48 <= buf[pos] <= 57:
+            mantissa = mantissa * 10 + (buf[pos] - 48)
+            exponent -= 1
+            pos += 1
+    if pos < buf.size and (buf[pos] == 101 or buf[pos] == 69):  # e or E
+        pos += 1
+        exp_sign = 1
+        if pos < buf.size and (buf[pos] == 45 or buf[pos] == 43):
+            if buf[pos] == 45:
+                exp_sign = -1
+            pos += 1
+        e = 0
+        while pos < buf.size and 48 <= buf[pos] <= 57:
+            e = e * 10 + buf[pos] - 48
+            pos += 1
+        exponent += exp_sign * e
+    if exponent < 0:
+        return sign * mantissa / 10.0 ** (-exponent), pos
+    return sign * mantissa * 10.0**exponent, pos
+
+
+@njit
+def numba_parse_sparse_pred(buf: np.ndarray):
+    """
+    Parses prediction lines in <label>:<value> <label>:<value> ... format from the bytes of a text file.
+    Returns data, indices, indptr of the CSR matrix and whether its indices require sorting.
+    """
+    n_lines = numba_count_lines(buf)
+    max_nnz = 0
+    for c in buf:
+        if c == COLON:
+            max_nnz += 1
+    data = np.empty(max_nnz, dtype=np.float64)
+    indices = np.empty(max_nnz, dtype=np.int64)
+    indptr = np.zeros(n_lines + 1, dtype=np.int64)
+    requires_sort = False
+
+    pos = nnz = row = 0
+    while pos < buf.size:
+        prev = -1
+        while pos < buf.size and buf[pos] != NEWLINE:
+            c = buf[pos]
+            if numba_is_space(c):
+                pos += 1
+                continue
+            ind = 0
+            label_start = pos
+            while pos < buf.size and 48 <= buf[pos] <= 57:
+                ind = ind * 10 + buf[pos] - 48
+                pos += 1
+            if pos == label_start or pos >= buf.size or buf[pos] != COLON:
+                raise ValueError("Expected <label>:<value>")
+            data[nnz], pos = numba_parse_float(buf, pos + 1)
+            indices[nnz] = ind
+            nnz += 1
+            if prev > ind:
+                requires_sort = True
+            prev = ind
+        pos += 1
+        row += 1
+        indptr[row] = nnz
+
+    return data[:nnz], indices[:nnz], indptr, requires_sort
+
+
+def read_bytes(path: str):
+    """
+    Returns the content of the file as a memory-mapped array of bytes, which is read from the disk in pages while parsing.
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+def single_byte(delimiter: str):
+    """
+    Returns the byte of a single character delimiter, -1 for None, or None if it cannot be parsed by numba parsers.
+    """
+    if delimiter is None:
+        return -1
+    encoded = delimiter.encode()
+    if len(encoded) != 1 or encoded.isdigit():
+        return None
+    return encoded[0]
+
+
+# Files larger than this are parsed in parallel by default, files are parsed in chunks of at most MAX_CHUNK_BYTES
+PARALLEL_MIN_BYTES = 1 << 26
+MAX_CHUNK_BYTES = 1 << 28
+
+
+def newline_chunks(path: str, n_chunks: int, offset: int = 0):
+    """
+    Splits the file from offset to its end into about n_chunks byte ranges (start, end) that end after a newline.
+    """
+    size = os.path.getsize(path)
+    bounds = [offset]
+    with open(path, "rb") as file:
+        for i in range(1, n_chunks):
+            pos = max(offset + (size - offset) * i // n_chunks, bounds[-1])
+            file.seek(pos)
+            # Move the boundary after the next newline
+            while True:
+                block = file.read(1 << 16)
+                if not block:
+                    pos = size
+                    break
+                j = block.find(b"\n")
+                if j >= 0:
+                    pos += j + 1
+                    break
+                pos += len(block)
+            bounds.append(pos)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def read_lines(path: str, start: int, end: int):
+    """
+    Returns the lines of the byte range of the file (ending with a newline) as strings, like iterating over a text file.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode()
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def parse_labels_chunk(path, start, end, labels_byte, features_byte):
+    indices, indptr, requires_sort = numba_parse_labels(
+        read_bytes(path)[start:end], labels_byte, features_byte
+    )
+    return np.ones(indices.size, dtype=np.float32), indices, indptr, requires_sort
+
+
+def parse_labels_chunk_slow(
+    path, start, end, labels_delimiter, labels_features_delimiter, labels_map
+):
+    return parse_txt_labels_lines(
+        read_lines(path, start, end),
+        labels_delimiter,
+        labels_features_delimiter,
+        labels_map,
+    )
+
+
+def parse_sparse_pred_chunk(path, start, end):
+    return numba_parse_sparse_pred(read_bytes(path)[start:end])
+
+
+def collect_tokens_chunk(path, start, end):
+    tokens = set()
+    for line in read_lines(path, start, end):
+        tokens.update(line.split())
+    return tokens
+
+
+# Arguments shared by all chunks, set once per worker by init_chunk_worker
+CHUNK_ARGS = ()
+
+
+def init_chunk_worker(args):
+    global CHUNK_ARGS
+    CHUNK_ARGS = args
+
+
+def parse_chunk_in_worker(parse_chunk, path, start, end):
+    return parse_chunk(path, start, end, *CHUNK_ARGS)
+
+
+def parse_chunks(
+    path: str, parse_chunk: callable, args=(), offset: int = 0, n_jobs: int = None
+):
+    """
+    Splits the file from offset at newline boundaries and returns the results of parse_chunk(path, start, end, *args)
+    for all the chunks, in the order of the file. With n_jobs > 1, the chunks are parsed in a pool of n_jobs processes.
+    By default, files larger than PARALLEL_MIN_BYTES are parsed using all available cores.
+    """
+    size = os.path.getsize(path)
+    if n_jobs is None:
+        n_jobs = default_n_jobs() if size >= PARALLEL_MIN_BYTES else 1
+    n_chunks = -(-(size - offset) // MAX_CHUNK_BYTES)
+    if n_jobs > 1:
+        n_chunks = max(n_chunks, 4 * n_jobs)
+    chunks = newline_chunks(path, max(n_chunks, 1), offset)
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        return [parse_chunk(path, start, end, *args) for start, end in chunks]
+
+    print(f"  Parsing {len(chunks)} chunks with {n_jobs} processes ...")
+    # Workers are not forked from this process, which may already run numba threads (see run_jobs)
+    context = multiprocessing.get_context("forkserver")
+    with context.Pool(n_jobs, initializer=init_chunk_worker, initargs=(args,)) as pool:
+        return pool.starmap(
+            parse_chunk_in_worker,
+            [(parse_chunk, path, start, end) for start, end in chunks],
+        )
+
+
+def concat_csr_chunks(chunks: list):
+    """
+    Concatenates (data, indices, indptr, requires_sort) of consecutive row chunks of a CSR matrix.
+    """
+    if not chunks:
+        return (
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(1, dtype=np.int64),
+            False,
+        )
+    offsets = np.cumsum([0] + [chunk[2][-1] for chunk in chunks])
+    data = np.concatenate([chunk[0] for chunk in chunks])
+    indices = np.concatenate([chunk[1] for chunk in chunks])
+    indptr = np.concatenate(
+        [chunks[0][2][:1]]
+        + [chunk[2][1:] + offset for chunk, offset in zip(chunks, offsets)]
+    )
+    requires_sort = any(chunk[3] for chunk in chunks)
+    return data, indices, indptr, requires_sort
+
+
+def tokenize_labels_chunk(path, start, end, labels_byte, features_byte):
+    """
+    Returns the labels of the byte range of the file as an array of byte strings and indptr of its rows.
+    """
+    buf = read_bytes(path)[start:end]
+    starts, ends, indptr = numba_tokenize_labels(buf, labels_byte, features_byte)
+    width = max(int((ends - starts).max(initial=1)), 1)
+    tokens = numba_gather_tokens(buf, starts, ends, width)
+    return tokens.view(f"S{width}").reshape(-1), indptr
+
+
+def vocabulary_chunk(path, start, end, labels_byte, features_byte):
+    tokens, _ = tokenize_labels_chunk(path, start, end, labels_byte, features_byte)
+    return np.unique(tokens)
+
+
+def encode_labels(vocabulary: np.ndarray, tokens: np.ndarray):
+    """
+    Returns the indices of the tokens in the sorted vocabulary of labels (see build_label_vocabulary).
+    """
+    indices = np.searchsorted(vocabulary, tokens)
+    missing = vocabulary[np.minimum(indices, vocabulary.size - 1)] != tokens
+    if missing.any():
+        raise KeyError(tokens[missing][0].decode())
+    return indices
+
+
+def parse_labels_chunk_vocabulary(
+    path, start, end, labels_byte, features_byte, vocabulary
+):
+    tokens, indptr = tokenize_labels_chunk(path, start, end, labels_byte, features_byte)
+    indices = encode_labels(vocabulary, tokens)
+
+    # Indices require sorting if they decrease within any row
+    decreasing = np.diff(indices) < 0
+    row_starts = indptr[1:-1]
+    decreasing[row_starts[(row_starts > 0) & (row_starts < indices.size)] - 1] = False
+    requires_sort = bool(decreasing.any())
+    return np.ones(indices.size, dtype=np.float32), indices, indptr, requires_sort
+
+
+def build_label_vocabulary(
+    paths: list,
+    header=False,
+    labels_delimiter=" ",
+    labels_features_delimiter=None,
+    n_jobs: int = None,
+):
+    """
+    Returns the sorted array of unique labels (as byte strings) found in the label files, in a single pass over them.
+    The index of a label in the vocabulary is its index in the label matrix, the same as in calculate_lightxml_labels.
+    """
+    labels_byte = single_byte(labels_delimiter)
+    features_byte = single_byte(labels_features_delimiter)
+    if labels_byte in (None, -1) or features_byte is None:
+        raise ValueError("Label vocabulary requires single character delimiters")
+
+    chunks = []
+    for path in paths:
+        offset = numba_skip_line(read_bytes(path), 0) if header else 0
+        chunks += parse_chunks(
+            path,
+            vocabulary_chunk,
+            (labels_byte, features_byte),
+            offset=offset,
+            n_jobs=n_jobs,
+        )
+    return np.unique(np.concatenate(chunks))
+
+
+def load_label_vocabulary(
+    paths: list,
+    header=False,
+    labels_delimiter=" ",
+    labels_features_delimiter=None,
+    cache_dir: str = None,
+    n_jobs: int = None,
+):
+    """
+    Returns the vocabulary of build_label_vocabulary, cached in the dataset cache directory of the first path
+    (see load_cache_file) under the hash of the content of the files and the delimiters.
+    """
+    print(f"Loading label vocabulary of {paths} ...")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(paths[0]), CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    key = content_hash(
+        [file_hash(path, cache_dir) for path in paths],
+        header,
+        labels_delimiter,
+        labels_features_delimiter,
+    )
+    cache_path = os.path.join(cache_dir, f"labels-vocabulary-{key}.npy")
+    if not os.path.exists(cache_path):
+        print(f"  Creating label vocabulary under {cache_path} ...")
+        vocabulary = build_label_vocabulary(
+            paths,
+            header=header,
+            labels_delimiter=labels_delimiter,
+            labels_features_delimiter=labels_features_delimiter,
+            n_jobs=n_jobs,
+        )
+        atomic_save(np.save, cache_path, vocabulary)
+
+    return np.load(cache_path)
+
+
+def load_txt_labels(
+    path: str,
+    header=True,
+    labels_delimiter=",",
+    labels_features_delimiter=" ",
+    labels_map: dict = None,
+    labels_vocabulary: np.ndarray = None,
+    n_jobs: int = None,
+):
+    """
+    Loads the sparse label matrix from the XMC repository dataset or similar text format.
+    Labels are mapped to indices with labels_vocabulary (see load_label_vocabulary) in bulk or with labels_map dict.
+    Large files are parsed in parallel, see parse_chunks.
+    """
+    offset = numba_skip_line(read_bytes(path), 0) if header else 0
+    labels_byte = single_byte(labels_delimiter)
+    features_byte = single_byte(labels_features_delimiter)
+    single_bytes = labels_byte not in (None, -1) and features_byte is not None
+    if labels_vocabulary is not None and single_bytes:
+        parse_chunk = parse_labels_chunk_vocabulary
+        args = (labels_byte, features_byte, labels_vocabulary)
+    elif labels_vocabulary is not None:
+        raise ValueError("Label vocabulary requires single character delimiters")
+    elif labels_map is not None or not single_bytes:
+        parse_chunk = parse_labels_chunk_slow
+        args = (labels_delimiter, labels_features_delimiter, labels_map)
+    else:
+        parse_chunk = parse_labels_chunk
+        args = (labels_byte, features_byte)
+
+    data, indices, indptr, requires_sort = concat_csr_chunks(
+        parse_chunks(path, parse_chunk, args, offset=offset, n_jobs=n_jobs)
+    )
+    if requires_sort:
+        print(
+            "  Sorting of the matrix's indices is required. This may take a while ..."
+        )
+
+    return construct_csr_matrix(
+        data, indices, indptr, dtype=np.float32, sort_indices=requires_sort
+    )
+
+
+def load_txt_sparse_pred(path: str, n_jobs: int = None):
+    """
+    Loads the sparse prediction matrix from libsvm like format:
+    <label>:<value> <label>:<value> ...
+    Large files are parsed in parallel, see parse_chunks.
+    """
+    data, indices, indptr, requires_sort = concat_csr_chunks(
+        parse_chunks(path, parse_sparse_pred_chunk, n_jobs=n_jobs)
+    )
+    return construct_csr_matrix(
+        data, indices, indptr, dtype=np.float32, sort_indices=requires_sort
+    )
+
+
 def load_npy_sparse_pred(path: str):
     indices = np.load(path + "-labels.npy", allow_pickle=True)
     data = np.load(path + "-scores.npy", allow_pickle=True)
@@ -127,33 +709,188 @@ def load_npy_sparse_pred(path: str):
     )
 
 
-def load_npy_full_pred(path: str, keep_top_k: int = 0, **kwargs):
-    dense_data = np.load(path, allow_pickle=True)
+def sigmoid(x: np.ndarray):
+    return 1.0 / (1.0 + np.exp(-x))
 
-    if keep_top_k < 0:
-        k = dense_data.shape[1] - k - 1
 
-    data = -np.partition(-dense_data, keep_top_k, axis=1)[:, :keep_top_k]
-    indices = np.argpartition(-dense_data, keep_top_k, axis=1)[:, :keep_top_k]
-    indptr = np.arange(0, indices.shape[0] + 1, 1, dtype=np.int32) * indices.shape[1]
-    return construct_csr_matrix(
-        data.flatten(), indices.flatten(), indptr, dtype=np.float32, sort_indices=True
-    )
+def load_npy_full_pred(
+    path: str,
+    keep_top_k: int = 0,
+    apply_sigmoid: bool = False,
+    chunk_bytes: int = 1 << 26,
+    **kwargs,
+):
+    """
+    Loads the dense prediction matrix saved as .npy and keeps keep_top_k labels with the highest scores in each row
+    (for keep_top_k < 0, all but -keep_top_k labels, 0 keeps no labels). The file is memory-mapped and processed in chunks of rows
+    of about chunk_bytes, so the whole matrix is never loaded into memory.
+    With apply_sigmoid, scores are transformed to probabilities with the sigmoid function.
+    """
+    dense_data = np.load(path, mmap_mode="r")
+    ni, nl = dense_data.shape
+    k = keep_top_k if keep_top_k >= 0 else nl + keep_top_k
+    k = min(max(k, 0), nl)
+
+    data = np.empty((ni, k), dtype=np.float32)
+    indices = np.empty((ni, k), dtype=np.int32)
+    chunk_size = max(1, chunk_bytes // max(1, nl * dense_data.itemsize))
+    for start in range(0, ni, chunk_size):
+        chunk = np.asarray(dense_data[start : start + chunk_size])
+        if k == nl:
+            top_k = np.broadcast_to(np.arange(nl), chunk.shape)
+        elif k == 0:
+            top_k = np.zeros((chunk.shape[0], 0), dtype=np.intp)
+        else:
+            # A single argpartition, the values are gathered for the selected labels only
+            top_k = np.argpartition(-chunk, k - 1, axis=1)[:, :k]
+            top_k.sort(axis=1)
+        values = np.take_along_axis(chunk, top_k, axis=1)
+        if apply_sigmoid:
+            values = sigmoid(values.astype(np.float64))
+        data[start : start + chunk_size] = values
+        indices[start : start + chunk_size] = top_k
+
+    indptr = np.arange(0, ni + 1, dtype=np.int64) * k
+    return csr_matrix((data.reshape(-1), indices.reshape(-1), indptr), shape=(ni, nl))
+
+
+def save_npy_csr(path: Union[str, Path], matrix: csr_matrix):
+    """
+    Saves the sparse matrix as separate uncompressed .npy files that can be memory-mapped by load_npy_csr.
+    """
+    # Each file is saved atomically and the shape is saved last, so its presence marks a complete matrix
+    atomic_save(np.save, path + "-data.npy", matrix.data)
+    atomic_save(np.save, path + "-indices.npy", matrix.indices)
+    atomic_save(np.save, path + "-indptr.npy", matrix.indptr)
+    atomic_save(np.save, path + "-shape.npy", np.array(matrix.shape))
 
 
-def load_cache_npz_file(path: Union[str, Path], load_func: callable, **load_func_args):
+def load_npy_csr(path: Union[str, Path], mmap_mode: str = "r"):
     """
-    Loads a npz file from the given path. If the file does not exist, it is created using the given load_func.
+    Loads the sparse matrix saved by save_npy_csr. By default its arrays are memory-mapped,
+    so they are read from the disk only when accessed.
     """
-    print(f"Loading {path} ...")
-    if not os.path.exists(path + ".npz"):
-        print(f"  Creating cache under {path}.npz for faster loading ...")
-        data = load_func(path, **load_func_args)
-        save_npz(path + ".npz", data)
-    else:
-        data = load_npz(path + ".npz")
+    data = np.load(path + "-data.npy", mmap_mode=mmap_mode)
+    indices = np.load(path + "-indices.npy", mmap_mode=mmap_mode)
+    indptr = np.load(path + "-indptr.npy", mmap_mode=mmap_mode)
+    shape = tuple(np.load(path + "-shape.npy"))
+    return csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+CACHE_DIR = ".cache"
+# Part of the keys of cached datasets, load functions are identified only by their name,
+# so bump it when the code of a load function changes to recreate the cached datasets
+CACHE_VERSION = 1
 
-    return data
+
+def source_files(path: Union[str, Path]):
+    """
+    Returns the files a loader reads for path: path itself or, for loaders of split files
+    such as load_npy_sparse_pred, all path-*.npy files.
+    """
+    if os.path.isfile(path):
+        return [path]
+    files = sorted(glob.glob(glob.escape(path) + "-*.npy"))
+    if not files:
+        raise FileNotFoundError(f"No such file: {path}")
+    return files
+
+
+def file_hash(path: Union[str, Path], cache_dir: str = None):
+    """
+    Returns the hash of the content of the file. The hash is remembered in cache_dir
+    (by default, the .cache directory next to the file) together with the file's size and modification time,
+    so unchanged files are not read again.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(path)
+    stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    hash_path = os.path.join(cache_dir, os.path.basename(path) + ".hash.json")
+    if os.path.exists(hash_path):
+        with open(hash_path) as file:
+            saved = json.load(file)
+        if {k: saved.get(k) for k in stamp} == stamp:
+            return saved["hash"]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 24), b""):
+            h.update(block)
+    stamp["hash"] = h.hexdigest()
+    atomic_save(save_json, hash_path, stamp)
+    return stamp["hash"]
+
+
+def load_cache_file(
+    path: Union[str, Path],
+    load_func: callable,
+    mmap_mode: str = None,
+    cache_dir: str = None,
+    return_key: bool = False,
+    **load_func_args,
+):
+    """
+    Loads a sparse matrix from the given path using load_func and caches it as uncompressed .npy files (see save_npy_csr).
+    The cache is addressed by the content of the source file(s), the name of load_func, its arguments (e.g. labels_map)
+    and CACHE_VERSION, changes of the code of load_func are not detected.
+    By default, the cache is stored in the .cache directory next to the source file.
+    With mmap_mode="r" the arrays are memory-mapped instead of read.
+    With return_key, the key of the cache is also returned, it identifies the loaded matrix without hashing it.
+    """
+    print(f"Loading {path} ...")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    source_hashes = [file_hash(source, cache_dir) for source in source_files(path)]
+    key = content_hash(CACHE_VERSION, source_hashes, load_func, load_func_args)
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}-{key}")
+    if not os.path.exists(cache_path + "-shape.npy"):
+        print(f"  Creating cache under {cache_path}-*.npy for faster loading ...")
+        save_npy_csr(cache_path, load_func(path, **load_func_args))
+
+    if return_key:
+        return load_npy_csr(cache_path, mmap_mode=mmap_mode), key
+    return load_npy_csr(cache_path, mmap_mode=mmap_mode)
+
+
+def to_shared_memory(obj: Union[np.ndarray, csr_matrix], shms: list):
+    """
+    Copies the arrays of obj to new shared memory blocks, which are appended to shms
+    (the caller is responsible for closing and unlinking them).
+    Memory-mapped arrays are not copied, their files are mapped again instead.
+    Returns a picklable description of obj that can be attached by from_shared_memory in other processes.
+    """
+    if isinstance(obj, csr_matrix):
+        arrays = [
+            to_shared_memory(a, shms) for a in (obj.data, obj.indices, obj.indptr)
+        ]
+        return ("csr", obj.shape, arrays)
+    if isinstance(obj, np.memmap) and obj.filename is not None:
+        return ("memmap", obj.filename, obj.dtype.str, obj.shape, obj.offset)
+    shm = SharedMemory(create=True, size=max(obj.nbytes, 1))
+    shms.append(shm)
+    np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+    return ("shm", shm.name, obj.dtype.str, obj.shape)
+
+
+def from_shared_memory(desc: tuple, shms: list):
+    """
+    Attaches the object described by to_shared_memory without copying its arrays.
+    The attached shared memory blocks are appended to shms and have to be kept alive while the object is used.
+    """
+    if desc[0] == "csr":
+        _, shape, arrays = desc
+        arrays = [from_shared_memory(a, shms) for a in arrays]
+        return csr_matrix(tuple(arrays), shape=shape, copy=False)
+    if desc[0] == "memmap":
+        _, filename, dtype, shape, offset = desc
+        return np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=offset)
+    _, name, dtype, shape = desc
+    shm = SharedMemory(name=name)
+    shms.append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
 
 def count_labels(Y: Union[np.ndarray, csr_matrix]):
@@ -201,28 +938,25 @@ def load_weights_file(filepath):
         return v
 
 
-def calculate_lightxml_labels(train_data_path, test_data_path):
+def calculate_lightxml_labels(train_data_path, test_data_path, n_jobs: int = None):
     print("Creating lightxml label map ...")
-    label_map = {}
-
-    with open(train_data_path) as f:
-        for i in tqdm(f):
-            for l in i.replace("\n", "").split():
-                label_map[l.strip()] = 0
+    tokens = set()
+    for path in (train_data_path, test_data_path):
+        for chunk_tokens in parse_chunks(path, collect_tokens_chunk, n_jobs=n_jobs):
+            tokens.update(chunk_tokens)
 
-    with open(test_data_path) as f:
-        for i in tqdm(f):
-            for l in i.replace("\n", "").split():
-                label_map[l.strip()] = 0
-
-    for i, k in enumerate(sorted(label_map.keys())):
+    label_map = {}
+    for i, k in enumerate(sorted(tokens)):
         label_map[k] = i
 
     return label_map
 
 
-def load_npz_wrapper(path: Union[str, Path], **kwargs):
-    return load_npz(path)
+def load_npz_wrapper(path: Union[str, Path], apply_sigmoid: bool = False, **kwargs):
+    matrix = load_npz(path)
+    if apply_sigmoid:
+        matrix.data = sigmoid(matrix.data)
+    return matrix
 
 
 def save_npz_wrapper(path: Union[str, Path], data: csr_matrix, **kwargs):
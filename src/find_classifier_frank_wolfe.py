@@ -38,23 +38,21 @@ def select_top_k_np(y_proba, G, k):
     return top_k
 
 
-def predict_top_k_csr(y_proba, G, k):
+def predict_top_k_csr(y_proba, G, k, return_top_k=False):
     """
     Predicts the labels for a given gradient matrix G and probability estimates y_proba in dense format
+    With return_top_k, the predictions are returned as (ni, k) array of sorted labels instead of a sparse matrix
     """
     ni = y_proba.shape[0]
-    result_data = np.ones(ni * k, dtype=FLOAT_TYPE)
-    result_indices = np.zeros(ni * k, dtype=IND_TYPE)
-    result_indptr = np.zeros(ni + 1, dtype=IND_TYPE)
+    result = np.zeros((ni, k), dtype=IND_TYPE)
     for i in range(ni):
         eta_i = y_proba[i]
         top_k = select_top_k_csr(eta_i, G, k)
-        result_indices[i * k : (i + 1) * k] = sorted(eta_i.indices[top_k])
-        result_indptr[i + 1] = result_indptr[i] + k
+        result[i] = np.sort(eta_i.indices[top_k])
 
-    return csr_matrix(
-        (result_data, result_indices, result_indptr), shape=(ni, G.shape[0])
-    )
+    if return_top_k:
+        return result
+    return top_k_to_csr(result, G.shape[0])
 
 
 def predict_top_k_np(y_proba, G, k):
@@ -95,6 +93,30 @@ def calculate_confusion_matrix_csr(y_true, y_pred, C_shape):
     return C
 
 
+def calculate_confusion_matrix_top_k(y_true, y_pred, C_shape):
+    """
+    Calculate normalized confusion matrix for true labels in sparse format and predicted labels as (ni, k) array of sorted labels
+    """
+    # True negatives are not used in the utility function, so we can ignore them here
+    if not y_true.has_sorted_indices:
+        y_true = y_true.sorted_indices()
+    ni, k = y_pred.shape
+    C = np.zeros(C_shape)
+    C[:, 0], C[:, 1], C[:, 2] = numba_calculate_0approx_stats(
+        y_true.data,
+        y_true.indices,
+        y_true.indptr,
+        y_pred.reshape(-1),
+        ni,
+        C_shape[0],
+        k,
+        np.float64,
+    )
+    C = C / ni
+
+    return C
+
+
 def calculate_confusion_matrix_np(y_true, y_pred, C_shape):
     """
     Calculate normalized confusion matrix for true labels and predicted labels in dense format
@@ -161,8 +183,11 @@ def find_classifier_frank_wolfe(
         func_calculate_confusion_matrix = calculate_confusion_matrix_np
         func_predict_top_k = predict_top_k_np
     elif isinstance(y_true, csr_matrix) and isinstance(y_proba, csr_matrix):
-        func_calculate_confusion_matrix = calculate_confusion_matrix_csr
-        func_predict_top_k = predict_top_k_csr
+        # Predictions are kept as (ni, k) arrays of labels, which are cheaper to build and evaluate
+        func_calculate_confusion_matrix = calculate_confusion_matrix_top_k
+        func_predict_top_k = lambda y_proba, G, k: predict_top_k_csr(
+            y_proba, G, k, return_top_k=True
+        )
     else:
         raise ValueError(
             f"y_true and y_proba have unsuported combination of types {type(y_true)}, {type(y_proba)}"
@@ -245,26 +270,23 @@ def find_classifier_frank_wolfe(
 
 
 def predict_top_k_for_classfiers_csr(
-    y_proba, classifiers, classifier_weights, k=5, seed=0
+    y_proba, classifiers, classifier_weights, k=5, seed=0, return_top_k=False
 ):
     if seed is not None:
         np.random.seed(seed)
 
     ni = y_proba.shape[0]
-    result_data = np.ones(ni * k, dtype=FLOAT_TYPE)
-    result_indices = np.zeros(ni * k, dtype=IND_TYPE)
-    result_indptr = np.zeros(ni + 1, dtype=IND_TYPE)
+    result = np.zeros((ni, k), dtype=IND_TYPE)
     for i in range(ni):
         c = np.random.choice(classifiers.shape[0], p=classifier_weights)
         G = classifiers[c]
         eta_i = y_proba[i]
         top_k = select_top_k_csr(eta_i, G, k)
-        result_indices[i * k : (i + 1) * k] = sorted(eta_i.indices[top_k])
-        result_indptr[i + 1] = result_indptr[i] + k
+        result[i] = np.sort(eta_i.indices[top_k])
 
-    return csr_matrix(
-        (result_data, result_indices, result_indptr), shape=(ni, G.shape[0])
-    )
+    if return_top_k:
+        return result
+    return top_k_to_csr(result, G.shape[0])
 
 
 def predict_top_k_for_classfiers_np(
@@ -0,0 +1,90 @@
+import os
+import json
+import multiprocessing
+
+from data import to_shared_memory, from_shared_memory
+from utils_sparse import limit_num_threads
+from utils_misc import NpEncoder, content_hash, atomic_save, default_n_jobs
+
+
+def save_json_atomic(path: str, data: dict):
+    def save(tmp_path, data):
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, cls=NpEncoder, indent=4, sort_keys=True)
+
+    atomic_save(save, path, data)
+
+
+def load_cached_results(path: str, cache_key: str):
+    """
+    Returns results saved under path if they were calculated for cache_key, otherwise None.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as file:
+            results = json.load(file)
+    except (OSError, ValueError):
+        print(f"  Ignoring unreadable results {path}")
+        return None
+    if results.get("cache_key") != cache_key:
+        return None
+    return results
+
+
+# State of the workers, set by init_worker
+WORKER = {}
+
+
+def init_worker(shared_data, kwargs, n_threads):
+    # Workers share the cores, so each of them runs parallel numba functions on its part of them
+    limit_num_threads(n_threads)
+    shms = []
+    WORKER["data"] = tuple(from_shared_memory(d, shms) for d in shared_data)
+    WORKER["kwargs"] = kwargs
+    WORKER["shms"] = shms
+
+
+def run_worker_job(job):
+    func, args = job
+    func(WORKER["data"], *args, **WORKER["kwargs"])
+    return job
+
+
+def run_jobs(stages: list, data: tuple, n_jobs: int = None, **kwargs):
+    """
+    Runs stages of jobs, each being a list of (func, args) called as func(data, *args, **kwargs).
+    Jobs of a stage are run in any order on a pool of n_jobs processes (by default, one per available core),
+    but the stages are run one after another. The arrays of data are shared with the workers through shared memory.
+    Parallel numba functions of each worker are limited to its share of the available cores (see limit_num_threads).
+    With n_jobs = 1, the jobs are run in this process.
+    """
+    if n_jobs is None:
+        n_jobs = default_n_jobs()
+    n_all = sum(len(stage) for stage in stages)
+
+    if n_jobs == 1:
+        for stage in stages:
+            for func, args in stage:
+                func(data, *args, **kwargs)
+        return
+
+    shms = []
+    try:
+        shared_data = [to_shared_memory(d, shms) for d in data]
+        n_threads = max(1, default_n_jobs() // n_jobs)
+        # Forking a process that already runs numba threads (e.g. after parallel loading) can deadlock the workers,
+        # so they are started from a clean forkserver process, the data is shared through shared memory anyway
+        context = multiprocessing.get_context("forkserver")
+        with context.Pool(
+            n_jobs, initializer=init_worker, initargs=(shared_data, kwargs, n_threads)
+        ) as pool:
+            n_done = 0
+            for stage in stages:
+                for func, args in pool.imap_unordered(run_worker_job, stage):
+                    n_done += 1
+                    print(f"Finished job {n_done}/{n_all}: {func.__name__} {args}")
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
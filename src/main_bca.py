@@ -5,12 +5,17 @@ from data import *
 from weighted_prediction import *
 from bca_prediction import *
 from utils_misc import *
+from jobs import *
 
 import sys
+import time
 import click
 
 RECALCULATE_RESUTLS = False
 RECALCULATE_PREDICTION = False
+# Part of the keys of cached results, methods are identified only by their name,
+# so bump it when the code of a method changes to recalculate its cached results
+RESULTS_VERSION = 1
 K = (1, 3, 5, 10)
 
 METRICS = {
@@ -153,6 +158,21 @@ METHODS = {
     "block-coord-cov-tol=1e-7": (block_coordinate_coverage,{"tolerance": 1e-7}),
     #"block-coord-cov-tol=1e-8": (block_coordinate_coverage,{"tolerance": 1e-8}),
 
+    # Parallel block coordinate, compare time and expected utility with the sequential variants above
+    # (the number of threads is set with --threads, see method_kwargs)
+    "block-coord-macro-prec-tol=1e-7-parallel": (block_coordinate_macro_precision,{"tolerance": 1e-7, "parallel": True}),
+    "block-coord-macro-f1-tol=1e-7-parallel": (block_coordinate_macro_f1,{"tolerance": 1e-7, "parallel": True}),
+    "block-coord-cov-tol=1e-7-parallel": (block_coordinate_coverage,{"tolerance": 1e-7, "parallel": True}),
+
+    # Active set block coordinate, skips instances whose top-k cannot change
+    "block-coord-macro-prec-tol=1e-7-active-set": (block_coordinate_macro_precision,{"tolerance": 1e-7, "active_set": True}),
+    "block-coord-macro-f1-tol=1e-7-active-set": (block_coordinate_macro_f1,{"tolerance": 1e-7, "active_set": True}),
+    "block-coord-cov-tol=1e-7-active-set": (block_coordinate_coverage,{"tolerance": 1e-7, "active_set": True}),
+
+    # Mini-batch block coordinate, batch size trades speed for fidelity of each update
+    "block-coord-macro-f1-tol=1e-7-batch=1024": (block_coordinate_macro_f1,{"tolerance": 1e-7, "batch_size": 1024, "parallel": True}),
+    "block-coord-cov-tol=1e-7-batch=1024": (block_coordinate_coverage,{"tolerance": 1e-7, "batch_size": 1024, "parallel": True}),
+
     # Mixed precision with cov
     "block-coord-mixed-prec-cov-alpha=0.001-tol=1e-7": (block_coordinate_coverage,{"alpha": 0.001, "tolerance": 1e-7}),
     "block-coord-mixed-prec-cov-alpha=0.01-tol=1e-7": (block_coordinate_coverage,{"alpha": 0.01, "tolerance": 1e-7}),
@@ -172,26 +192,55 @@ METHODS = {
 }
 
 
-def report_metrics(data, predictions, k):
+def group_paths(methods, param):
+    """
+    Groups methods that differ only by the value of param into paths that can be run with bca_path.
+    Returns a list of (func, kwargs, {value: method}) for groups with more than one method.
+    """
+    groups = {}
+    for method, (func, kwargs) in methods.items():
+        if param not in kwargs:
+            continue
+        other_kwargs = {k: v for k, v in kwargs.items() if k != param}
+        key = (func, tuple(sorted(other_kwargs.items())))
+        groups.setdefault(key, (func, other_kwargs, {}))[2][kwargs[param]] = method
+    return [group for group in groups.values() if len(group[2]) > 1]
+
+
+def predict_multi_k(func, y_proba, ks, **kwargs):
+    """
+    Yields (k, y_pred, meta) for all ks in increasing order.
+    Methods of MULTI_K_METHODS rank the labels once for max(ks) (returned as ranked_top_k in meta),
+    other methods (block coordinate ones) are chained with bca_multi_k.
+    """
+    if func in MULTI_K_METHODS:
+        y_preds, meta = func(y_proba, max(ks), ks=ks, **kwargs)
+        for k in sorted(ks):
+            yield k, y_preds[k], meta
+    else:
+        yield from bca_multi_k(func, y_proba, ks, **kwargs)
+
+
+def report_metrics(data, predictions, k, values=None):
     results = {}
+    if values is None:
+        values = evaluate_metrics(data, predictions)
     for metric, func in METRICS.items():
-        value = func(data, predictions)
+        value = values[func] if func in values else func(data, predictions)
         results[f"{metric}@{k}"] = value
         print(f"  {metric}: {100 * value:>5.2f}")
 
     return results
 
 
-@click.command()
-@click.argument("experiment", type=str, required=True)
-@click.option("-k", type=int, required=False, default=None)
-@click.option("-s", "--seed", type=int, required=False, default=None)
-def main(experiment, k, seed):
+def load_experiment(experiment: str, chunk_size: int = None):
+    """
+    Loads true labels and predictions of the experiment, and calculates marginals and propensities.
+    Returns (y_true, eta_pred, marginals, inv_ps) and the key of this data,
+    derived from the keys of the cached files (see load_cache_file).
+    """
     print(experiment)
 
-    if k is not None:
-        K = (k,)
-
     true_as_pred = "true_as_pred" in experiment
     lightxml_data = "lightxml" in experiment
 
@@ -370,6 +419,7 @@ def main(experiment, k, seed):
             "path": "predictions/eurlex/eurlex4k_full_plain-scores.npy",
             "load_func": load_npy_full_pred,
             "keep_top_k": 100,
+            # LightXML predictions aren't probabilities, sigmoid is applied by the loader
             "apply_sigmoid": True,
         }
         train_y_true_path = {
@@ -475,26 +525,33 @@ def main(experiment, k, seed):
     # Remap labels for LightXML predictions and use it when loading data
     if lightxml_data:
         with Timer():
-            labels_map = calculate_lightxml_labels(
-                train_y_true_path["path"], y_true_path["path"]
+            labels_vocabulary = load_label_vocabulary(
+                [train_y_true_path["path"], y_true_path["path"]],
+                **lightxml_data_load_config,
             )
         train_y_true_path.update(lightxml_data_load_config)
         y_true_path.update(lightxml_data_load_config)
-        train_y_true_path["labels_map"] = labels_map
-        y_true_path["labels_map"] = labels_map
+        train_y_true_path["labels_vocabulary"] = labels_vocabulary
+        y_true_path["labels_vocabulary"] = labels_vocabulary
     else:
         train_y_true_path.update(xmlc_data_load_config)
         y_true_path.update(xmlc_data_load_config)
 
     # Create binary files for faster loading
     with Timer():
-        y_true = load_cache_npz_file(**y_true_path)
+        y_true, y_true_key = load_cache_file(**y_true_path, return_key=True)
 
     with Timer():
-        eta_pred = load_cache_npz_file(**eta_pred_path)
+        # Memory-map predictions for the out-of-core block coordinate
+        mmap_mode = "r" if chunk_size is not None else None
+        eta_pred, eta_pred_key = load_cache_file(
+            **eta_pred_path, mmap_mode=mmap_mode, return_key=True
+        )
 
     with Timer():
-        train_y_true = load_cache_npz_file(**train_y_true_path)
+        train_y_true, train_y_true_key = load_cache_file(
+            **train_y_true_path, return_key=True
+        )
 
     # For some sparse format this resize might be necessary
     if y_true.shape != eta_pred.shape:
@@ -511,10 +568,6 @@ def main(experiment, k, seed):
         # marginals = labels_priors(y_true)
         inv_ps = jpv_inverse_propensity(train_y_true)
 
-    if "apply_sigmoid" in eta_pred_path and eta_pred_path["apply_sigmoid"]:
-        # LightXML predictions aren't probabilities
-        eta_pred.data = 1.0 / (1.0 + np.exp(-eta_pred.data))
-
     # Use true labels as predictions with 1.0 score (probability)
     if true_as_pred:
         eta_pred = y_true
@@ -530,43 +583,513 @@ def main(experiment, k, seed):
     # y_true = y_true.todense() # As np.matrix
     # eta_pred = eta_pred.todense() # As np.matrix
 
-    output_path_prefix = f"results_bca/{experiment}/"
-    os.makedirs(output_path_prefix, exist_ok=True)
-    for k in K:
-        for method, func in METHODS.items():
-            print(f"{experiment} - {method} @ {k}: ")
-
-            output_path = f"{output_path_prefix}{method}_k={k}_s={seed}"
-            results_path = f"{output_path}_results.json"
-            pred_path = f"{output_path}_pred.npz"
-
-            if not os.path.exists(results_path) or RECALCULATE_RESUTLS:
-                results = {}
-                if not os.path.exists(pred_path) or RECALCULATE_PREDICTION:
-                    with Timer() as t:
-                        # y_pred = func[0](eta_pred, k, marginals=marginals, inv_ps=inv_ps, filename=output_path, **func[1])
-                        y_pred, meta = func[0](
-                            eta_pred,
-                            k,
-                            marginals=marginals,
-                            inv_ps=inv_ps,
-                            seed=seed,
-                            **func[1],
-                        )
-                        results["iters"] = meta["iters"]
-                        results["time"] = t.get_time()
-                        print("  Iters: ", meta["iters"])
-                    save_npz_wrapper(pred_path, y_pred)
-                    save_json(results_path, results)
-                else:
-                    y_pred = load_npz_wrapper(pred_path)
-                    results = load_json(results_path)
-
-                print("  Calculating metrics:")
-                results.update(report_metrics(y_true, y_pred, k))
-                save_json(results_path, results)
-
-            print("  Done")
+    data_key = content_hash(y_true_key, eta_pred_key, train_y_true_key, true_as_pred)
+    return (y_true, eta_pred, marginals, inv_ps), data_key
+
+
+def chunk_kwargs(func: callable, eta_pred, chunk_size: int = None):
+    """
+    Returns chunk_size as keyword arguments of a method that can run out-of-core (see CHUNKED_METHODS),
+    other methods load the memory-mapped predictions into memory, which is reported.
+    """
+    if chunk_size is None:
+        return {}
+    if func in CHUNKED_METHODS and isinstance(eta_pred, csr_matrix):
+        return {"chunk_size": chunk_size}
+    print(
+        f"  Warning: {func.__name__} does not support chunk_size, predictions are loaded into memory"
+    )
+    return {}
+
+
+def method_kwargs(kwargs: dict, n_threads: int = None):
+    """
+    Returns the keyword arguments of a method of METHODS to call it with.
+    "parallel": True is replaced by n_threads (by default, all available cores, which limit_num_threads
+    shares between the workers of run_jobs), the number of threads is a setting of the run,
+    it is not a part of names and keys of results.
+    """
+    kwargs = dict(kwargs)
+    if kwargs.pop("parallel", False):
+        kwargs["n_threads"] = default_n_jobs() if n_threads is None else n_threads
+    return kwargs
+
+
+def get_output_path(experiment: str, method: str, k: int, seed: int, start: str = None):
+    """
+    Returns the path of the results of a method without the suffix,
+    warm started results (see run_path and run_multi_k) are saved under their start, next to the cold ones.
+    """
+    output_path = f"results_bca/{experiment}/{method}_k={k}_s={seed}"
+    if start is not None:
+        output_path += f"_start={start}"
+    return output_path
+
+
+def get_cache_key(
+    data_key: str,
+    method: str,
+    k: int,
+    seed: int,
+    chunk_size=None,
+    start: str = None,
+    start_key: str = None,
+):
+    """
+    Returns the key of the results of a method, based on the content of the data, all the parameters
+    and RESULTS_VERSION (changes of the code of methods are not detected).
+    Warm started results also depend on their start and the key of the results they were started from.
+    """
+    return content_hash(
+        RESULTS_VERSION,
+        data_key,
+        METHODS[method],
+        k,
+        seed,
+        chunk_size,
+        start,
+        start_key,
+    )
+
+
+def has_results(results: dict, k: int):
+    return (
+        results is not None
+        and not RECALCULATE_RESUTLS
+        and all(f"{metric}@{k}" in results for metric in METRICS)
+    )
+
+
+def save_results(output_path: str, y_pred, results: dict, cache_key: str):
+    """
+    Commits the prediction and then the results, both atomically, so the results are valid only if both were saved.
+    """
+    atomic_save(save_npz_wrapper, f"{output_path}_pred.npz", y_pred)
+    results["cache_key"] = cache_key
+    save_json_atomic(f"{output_path}_results.json", results)
+
+
+def run_multi_k(
+    data,
+    experiment,
+    method,
+    ks,
+    seed=None,
+    chunk_size=None,
+    data_key=None,
+    n_threads=None,
+):
+    """
+    Runs a method of METHODS for all ks at once (see predict_multi_k) and saves the results for each k,
+    the chained ones under their start.
+    """
+    y_true, eta_pred, marginals, inv_ps = data
+    func = METHODS[method]
+
+    # Nested predictions of a single ranking are the same as for a single k,
+    # chained predictions are keyed by the result they were warm started from
+    chained = func[0] not in MULTI_K_METHODS
+    starts = {}
+    cache_keys = {}
+    prev_k = None
+    for k in sorted(ks):
+        starts[k] = (
+            f"multi-k-from={'init' if prev_k is None else prev_k}" if chained else None
+        )
+        cache_keys[k] = get_cache_key(
+            data_key,
+            method,
+            k,
+            seed,
+            chunk_size,
+            start=starts[k],
+            start_key=None if prev_k is None or not chained else cache_keys[prev_k],
+        )
+        prev_k = k
+
+    # Skip k that already have results, a chain is run whole if any of them is missing
+    missing_ks = [
+        k
+        for k in ks
+        if not has_results(
+            load_cached_results(
+                f"{get_output_path(experiment, method, k, seed, starts[k])}_results.json",
+                cache_keys[k],
+            ),
+            k,
+        )
+    ]
+    if not missing_ks:
+        return
+    if not chained:
+        ks = missing_ks
+
+    print(f"{experiment} - {method} @ {ks}: ")
+    prev_k = None
+    multi_k_values = None
+    start_time = time.time()
+    for k, y_pred, meta in predict_multi_k(
+        func[0],
+        eta_pred,
+        ks,
+        marginals=marginals,
+        inv_ps=inv_ps,
+        seed=seed,
+        **chunk_kwargs(func[0], eta_pred, chunk_size),
+        **method_kwargs(func[1], n_threads),
+    ):
+        results = {
+            "iters": meta["iters"],
+            "time": time.time() - start_time,
+            "multi_k": prev_k,
+        }
+        if "utilities" in meta:
+            results["expected_utilities"] = meta["utilities"]
+            results["iter_times"] = meta.get("times")
+        prev_k = k
+        print(f"  k={k} iters: ", meta["iters"])
+        print("  Calculating metrics:")
+        # Nested predictions of a single ranking are evaluated for all ks at once
+        if "ranked_top_k" in meta and multi_k_values is None:
+            multi_k_values = evaluate_metrics_multi_k(y_true, meta["ranked_top_k"], ks)
+        values = multi_k_values[k] if multi_k_values is not None else None
+        results.update(report_metrics(y_true, y_pred, k, values))
+        save_results(
+            get_output_path(experiment, method, k, seed, starts[k]),
+            y_pred,
+            results,
+            cache_keys[k],
+        )
+        start_time = time.time()
+
+
+def run_multi_weight(
+    data, experiment, k, seed=None, chunk_size=None, data_key=None, n_threads=None
+):
+    """
+    Runs all the weighted methods of METHODS (see WEIGHTS_FUNCS) at once with weighted_per_instance_multi
+    and saves the results of each method.
+    """
+    y_true, eta_pred, marginals, inv_ps = data
+
+    # Skip methods that already have results
+    cache_keys = {
+        method: get_cache_key(data_key, method, k, seed, chunk_size)
+        for method, func in METHODS.items()
+        if func[0] in WEIGHTS_FUNCS
+    }
+    methods = [
+        method
+        for method in cache_keys
+        if not has_results(
+            load_cached_results(
+                f"{get_output_path(experiment, method, k, seed)}_results.json",
+                cache_keys[method],
+            ),
+            k,
+        )
+    ]
+    if not methods:
+        return
+
+    print(f"{experiment} - {methods} @ {k}: ")
+    with Timer() as t:
+        weights = np.stack(
+            [
+                WEIGHTS_FUNCS[METHODS[method][0]](
+                    eta_pred.shape[1],
+                    marginals=marginals,
+                    inv_ps=inv_ps,
+                    **METHODS[method][1],
+                )
+                for method in methods
+            ]
+        )
+        y_preds, meta = weighted_per_instance_multi(
+            eta_pred, weights, k, n_threads=n_threads
+        )
+        elapsed = t.get_time()
+
+    for method, y_pred in zip(methods, y_preds):
+        results = {
+            "iters": meta["iters"],
+            "time": elapsed / len(methods),
+            "multi_weight": methods,
+        }
+        print(f"  {method}")
+        print("  Calculating metrics:")
+        results.update(report_metrics(y_true, y_pred, k))
+        save_results(
+            get_output_path(experiment, method, k, seed),
+            y_pred,
+            results,
+            cache_keys[method],
+        )
+
+
+def run_path(
+    data,
+    experiment,
+    param,
+    group,
+    k,
+    seed=None,
+    chunk_size=None,
+    data_key=None,
+    n_threads=None,
+):
+    """
+    Runs a group of methods (the group-th group returned by group_paths for param)
+    as a warm started path (see bca_path) and saves the results of each method under its start.
+    """
+    y_true, eta_pred, marginals, inv_ps = data
+    func, kwargs, path = group_paths(METHODS, param)[group]
+
+    # Each result is keyed by the one it was warm started from, in the order of bca_path
+    starts = {}
+    cache_keys = {}
+    prev_value = None
+    for value in sorted(path, reverse=True):
+        method = path[value]
+        starts[method] = (
+            f"path-{param}-from={'init' if prev_value is None else prev_value}"
+        )
+        cache_keys[method] = get_cache_key(
+            data_key,
+            method,
+            k,
+            seed,
+            chunk_size,
+            start=starts[method],
+            start_key=None if prev_value is None else cache_keys[path[prev_value]],
+        )
+        prev_value = value
+
+    # Skip the path if all methods already have results, otherwise run all of it to warm start each method the same way
+    if all(
+        has_results(
+            load_cached_results(
+                f"{get_output_path(experiment, method, k, seed, starts[method])}_results.json",
+                cache_keys[method],
+            ),
+            k,
+        )
+        for method in path.values()
+    ):
+        return
+
+    print(f"{experiment} - {param} path of {list(path.values())} @ {k}: ")
+    prev_method = None
+    start_time = time.time()
+    for value, y_pred, meta in bca_path(
+        func,
+        eta_pred,
+        k,
+        param,
+        list(path.keys()),
+        marginals=marginals,
+        inv_ps=inv_ps,
+        seed=seed,
+        **chunk_kwargs(func, eta_pred, chunk_size),
+        **method_kwargs(kwargs, n_threads),
+    ):
+        method = path[value]
+        results = {
+            "iters": meta["iters"],
+            "time": time.time() - start_time,
+            "expected_utilities": meta["utilities"],
+            "iter_times": meta.get("times"),
+            "warm_start": prev_method,
+        }
+        prev_method = method
+        print(f"  {method} iters: ", meta["iters"])
+        print("  Calculating metrics:")
+        results.update(report_metrics(y_true, y_pred, k))
+        save_results(
+            get_output_path(experiment, method, k, seed, starts[method]),
+            y_pred,
+            results,
+            cache_keys[method],
+        )
+        start_time = time.time()
+
+
+def run_method(
+    data,
+    experiment,
+    method,
+    k,
+    seed=None,
+    chunk_size=None,
+    data_key=None,
+    n_threads=None,
+):
+    """
+    Runs a method of METHODS and saves its predictions and results,
+    unless they already exist for the same data and parameters.
+    """
+    y_true, eta_pred, marginals, inv_ps = data
+    func = METHODS[method]
+    print(f"{experiment} - {method} @ {k}: ")
+
+    output_path = get_output_path(experiment, method, k, seed)
+    results_path = f"{output_path}_results.json"
+    pred_path = f"{output_path}_pred.npz"
+    cache_key = get_cache_key(data_key, method, k, seed, chunk_size)
+    results = load_cached_results(results_path, cache_key)
+
+    if not has_results(results, k):
+        if results is None or not os.path.exists(pred_path) or RECALCULATE_PREDICTION:
+            results = {}
+            with Timer() as t:
+                # y_pred = func[0](eta_pred, k, marginals=marginals, inv_ps=inv_ps, filename=output_path, **func[1])
+                y_pred, meta = func[0](
+                    eta_pred,
+                    k,
+                    marginals=marginals,
+                    inv_ps=inv_ps,
+                    seed=seed,
+                    **chunk_kwargs(func[0], eta_pred, chunk_size),
+                    **method_kwargs(func[1], n_threads),
+                )
+                results["iters"] = meta["iters"]
+                results["time"] = t.get_time()
+                if "utilities" in meta:
+                    results["expected_utilities"] = meta["utilities"]
+                    results["iter_times"] = meta.get("times")
+                print("  Iters: ", meta["iters"])
+            save_results(output_path, y_pred, results, cache_key)
+        else:
+            y_pred = load_npz_wrapper(pred_path)
+
+        print("  Calculating metrics:")
+        results.update(report_metrics(y_true, y_pred, k))
+        save_json_atomic(results_path, results)
+
+    print("  Done")
+
+
+def experiment_jobs(
+    experiment, ks, seeds, warm_start=False, multi_k=False, multi_weight=False
+):
+    """
+    Returns the jobs of an experiment as a list of stages, each being a list of (func, args), see run_jobs.
+    Later stages skip the methods that have results from the earlier ones,
+    but warm started results are saved under their start (see get_output_path) and do not replace cold runs.
+    """
+    stages = []
+    if multi_weight:
+        stages.append(
+            [(run_multi_weight, (experiment, k, seed)) for seed in seeds for k in ks]
+        )
+    if multi_k and len(ks) > 1:
+        stages.append(
+            [
+                (run_multi_k, (experiment, method, ks, seed))
+                for seed in seeds
+                for method in METHODS
+            ]
+        )
+    if warm_start:
+        for param in ("alpha", "tolerance"):
+            stages.append(
+                [
+                    (run_path, (experiment, param, group, k, seed))
+                    for seed in seeds
+                    for k in ks
+                    for group in range(len(group_paths(METHODS, param)))
+                ]
+            )
+    stages.append(
+        [
+            (run_method, (experiment, method, k, seed))
+            for seed in seeds
+            for k in ks
+            for method in METHODS
+        ]
+    )
+    return stages
+
+
+@click.command()
+@click.argument("experiment", type=str, required=True)
+@click.option("-k", type=int, required=False, default=None)
+@click.option(
+    "-s",
+    "--seed",
+    type=int,
+    multiple=True,
+    help="Seed, can be given multiple times to run all the seeds with the data loaded once",
+)
+@click.option(
+    "-c",
+    "--chunk-size",
+    type=int,
+    required=False,
+    default=None,
+    help="Memory-map predictions and run block coordinate out-of-core in chunks of this many instances",
+)
+@click.option(
+    "-w",
+    "--warm-start",
+    is_flag=True,
+    default=False,
+    help="Run methods that differ only by alpha or tolerance as warm started paths (see bca_path)",
+)
+@click.option(
+    "-m",
+    "--multi-k",
+    is_flag=True,
+    default=False,
+    help="Predict all k at once, from a single ranking or a chain of warm starts (see predict_multi_k)",
+)
+@click.option(
+    "-W",
+    "--multi-weight",
+    is_flag=True,
+    default=False,
+    help="Run all the weighted methods at once, in a single pass over predictions (see weighted_per_instance_multi)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    required=False,
+    default=None,
+    help="Number of worker processes sharing the loaded data, one per core by default, 1 runs in this process (see run_jobs)",
+)
+@click.option(
+    "-t",
+    "--threads",
+    type=int,
+    required=False,
+    default=None,
+    help="Number of threads of parallel methods, the cores of a worker by default (see method_kwargs and run_jobs)",
+)
+def main(
+    experiment, k, seed, chunk_size, warm_start, multi_k, multi_weight, jobs, threads
+):
+    ks = K if k is None else (k,)
+    seeds = seed if seed else (None,)
+
+    data, data_key = load_experiment(experiment, chunk_size=chunk_size)
+    os.makedirs(f"results_bca/{experiment}/", exist_ok=True)
+    stages = experiment_jobs(
+        experiment,
+        ks,
+        seeds,
+        warm_start=warm_start,
+        multi_k=multi_k,
+        multi_weight=multi_weight,
+    )
+    run_jobs(
+        stages,
+        data,
+        jobs,
+        chunk_size=chunk_size,
+        data_key=data_key,
+        n_threads=threads,
+    )
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ import scipy.sparse as sp
 from metrics import *
 from data import *
 from utils_misc import *
+from jobs import *
 from src.find_classifier_frank_wolfe import *
 from weighted_prediction import *
 from sklearn.model_selection import train_test_split
@@ -26,6 +27,9 @@ from tqdm import trange
 
 RECALCULATE_RESUTLS = False
 RECALCULATE_PREDICTION = False
+# Part of the keys of cached results, methods are identified only by their name,
+# so bump it when the code of a method changes to recalculate its cached results
+RESULTS_VERSION = 1
 RETRAIN_MODEL = False
 K = (1, 3, 5, 10)
 
@@ -127,12 +131,13 @@ def frank_wolfe_mixed_instance_prec_macro_prec(
 
 def report_metrics(data, predictions, k):
     results = {}
+    if not isinstance(predictions, (list, tuple)):
+        predictions = [predictions]
+    pred_values = [evaluate_metrics(data, pred) for pred in predictions]
     for metric, func in METRICS.items():
         values = []
-        if not isinstance(predictions, (list, tuple)):
-            predictions = [predictions]
-        for pred in predictions:
-            value = func(data, pred)
+        for pred, pred_value in zip(predictions, pred_values):
+            value = pred_value[func] if func in pred_value else func(data, pred)
             values.append(value)
         results[f"{metric}@{k}"] = values
         print(
@@ -403,18 +408,93 @@ class PytorchModel(ModelWrapper):
         return pred
 
 
+def get_output_path(experiment, method, k, seed, testsplit, reg):
+    return f"results/{experiment}/{method}_k={k}_s={seed}_t={testsplit}_r={reg}"
+
+
+def run_method(data, experiment, method, k, seed, testsplit, reg, data_key=None):
+    """
+    Runs a method of METHODS and saves its predictions and results,
+    unless they already exist for the same data and parameters.
+    """
+    Y_val, pred_val, pred_test, Y_test, marginals, inv_ps = data
+    func = METHODS[method]
+    print(f"{method} @ {k}: ")
+
+    output_path = get_output_path(experiment, method, k, seed, testsplit, reg)
+    results_path = f"{output_path}_results.json"
+    pred_path = f"{output_path}_pred.pkl"
+    cache_key = content_hash(RESULTS_VERSION, data_key, func, k, seed, testsplit, reg)
+    results = load_cached_results(results_path, cache_key)
+
+    if (
+        results is None
+        or RECALCULATE_RESUTLS
+        or not all(f"{metric}@{k}" in results for metric in METRICS)
+    ):
+        if results is None or not os.path.exists(pred_path) or RECALCULATE_PREDICTION:
+            # results["test_log_loss"] = log_loss(Y_test, pred_test)
+            # results["val_log_loss"] = log_loss(Y_val, pred_val)
+            results = {}
+            with Timer() as t:
+                y_pred, meta = func[0](
+                    Y_val,
+                    pred_val,
+                    pred_test,
+                    k=k,
+                    marginals=marginals,
+                    inv_ps=inv_ps,
+                    seed=seed,
+                    reg=reg,
+                    **func[1],
+                )
+                results["iters"] = meta["iters"]
+                results["time"] = t.get_time()
+            # save_npz_wrapper(pred_path, y_pred)
+            atomic_save(save_pickle, pred_path, y_pred)
+            results["cache_key"] = cache_key
+            save_json_atomic(results_path, results)
+        else:
+            # y_pred = load_npz_wrapper(pred_path)
+            y_pred = load_pickle(pred_path)
+
+        print("  Calculating metrics:")
+        results.update(report_metrics(Y_test, y_pred, k))
+        save_json_atomic(results_path, results)
+
+    print("  Done")
+
+
+def experiment_jobs(experiment, ks, seed, testsplit, reg):
+    """
+    Returns the jobs for all methods and ks as a single stage, see run_jobs.
+    """
+    return [
+        [
+            (run_method, (experiment, method, k, seed, testsplit, reg))
+            for k in ks
+            for method in METHODS
+        ]
+    ]
+
+
 @click.command()
 @click.argument("experiment", type=str, required=True)
 @click.option("-k", type=int, required=False, default=None)
 @click.option("-s", "--seed", type=int, required=False, default=None)
 @click.option("-t", "--testsplit", type=float, required=False, default=0)
 @click.option("-r", "--reg", type=float, required=False, default=0)
-def main(experiment, k, seed, testsplit, reg):
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    required=False,
+    default=None,
+    help="Number of worker processes sharing the loaded data, one per core by default, 1 runs in this process (see run_jobs)",
+)
+def main(experiment, k, seed, testsplit, reg, jobs):
     print(experiment)
 
-    if k is not None:
-        K = (k,)
-
     lightxml_data_load_config = {
         "labels_delimiter": " ",
         "labels_features_delimiter": None,
@@ -706,6 +786,8 @@ def main(experiment, k, seed, testsplit, reg):
         elif "asym" in experiment:
             model = PytorchModel(model_path, seed, loss="asym")
 
+    # The data is identified by the files it was loaded from, hashes of their content are remembered (see file_hash)
+    source_paths = [train_path["path"], test_path["path"]]
     if isinstance(model, ModelWrapper):
         if not os.path.exists(model_path) or RETRAIN_MODEL:
             with Timer():
@@ -742,6 +824,7 @@ def main(experiment, k, seed, testsplit, reg):
             pred_test = load_pickle(test_pred_path)
         print("  Done")
         del model
+        source_paths += [val_pred_path, test_pred_path]
 
     else:
         pred_val = Y_val.toarray()
@@ -752,51 +835,11 @@ def main(experiment, k, seed, testsplit, reg):
         pred_test = sp.csr_matrix(pred_test)
 
     print("Calculating metrics ...")
-    output_path_prefix = f"results/{experiment}/"
-    os.makedirs(output_path_prefix, exist_ok=True)
-    for k in K:
-        for method, func in METHODS.items():
-            print(f"{method} @ {k}: ")
-
-            output_path = (
-                f"{output_path_prefix}{method}_k={k}_s={seed}_t={testsplit}_r={reg}"
-            )
-            results_path = f"{output_path}_results.json"
-            pred_path = f"{output_path}_pred.pkl"
-
-            if not os.path.exists(results_path) or RECALCULATE_RESUTLS:
-                results = {}
-                if not os.path.exists(pred_path) or RECALCULATE_PREDICTION:
-                    # results["test_log_loss"] = log_loss(Y_test, pred_test)
-                    # results["val_log_loss"] = log_loss(Y_val, pred_val)
-
-                    with Timer() as t:
-                        y_pred, meta = func[0](
-                            Y_val,
-                            pred_val,
-                            pred_test,
-                            k=k,
-                            marginals=marginals,
-                            inv_ps=inv_ps,
-                            seed=seed,
-                            reg=reg,
-                            **func[1],
-                        )
-                        results["iters"] = meta["iters"]
-                        results["time"] = t.get_time()
-                    # save_npz_wrapper(pred_path, y_pred)
-                    save_pickle(pred_path, y_pred)
-                    save_json(results_path, results)
-                else:
-                    # y_pred = load_npz_wrapper(pred_path)
-                    y_pred = load_pickle(pred_path)
-                    results = load_json(results_path)
-
-                print("  Calculating metrics:")
-                results.update(report_metrics(Y_test, y_pred, k))
-                save_json(results_path, results)
-
-            print("  Done")
+    os.makedirs(f"results/{experiment}/", exist_ok=True)
+    data = (Y_val, pred_val, pred_test, Y_test, marginals, inv_ps)
+    data_key = content_hash([file_hash(path) for path in source_paths])
+    stages = experiment_jobs(experiment, K if k is None else (k,), seed, testsplit, reg)
+    run_jobs(stages, data, jobs, data_key=data_key)
 
 
 if __name__ == "__main__":
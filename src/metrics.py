@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.sparse import csr_matrix
 from typing import Union
+from numba import njit
 
 
 def _predicted_positives(
@@ -125,6 +126,193 @@ instance_f1 = make_average(fmeasure, axis=1)
 instance_abandonment = make_average(abandonment, axis=1)
 
 
+@njit
+def numba_confusion_counts(
+    true_data: np.ndarray,
+    true_indices: np.ndarray,
+    true_indptr: np.ndarray,
+    pred_data: np.ndarray,
+    pred_indices: np.ndarray,
+    pred_indptr: np.ndarray,
+    ni: int,
+    nl: int,
+):
+    """
+    Calculates true positives, predicted positives and positives per label and per instance
+    of the true and predicted labels in the CSR format, in a single pass over their rows.
+    """
+    label_counts = np.zeros((3, nl), dtype=np.float64)
+    instance_counts = np.zeros((3, ni), dtype=np.float64)
+    row_pred = np.zeros(nl, dtype=np.float64)
+
+    for i in range(ni):
+        for j in range(pred_indptr[i], pred_indptr[i + 1]):
+            l = pred_indices[j]
+            row_pred[l] += pred_data[j]
+            label_counts[1, l] += pred_data[j]
+            instance_counts[1, i] += pred_data[j]
+
+        for j in range(true_indptr[i], true_indptr[i + 1]):
+            l = true_indices[j]
+            tp = true_data[j] * row_pred[l]
+            label_counts[0, l] += tp
+            instance_counts[0, i] += tp
+            label_counts[2, l] += true_data[j]
+            instance_counts[2, i] += true_data[j]
+
+        for j in range(pred_indptr[i], pred_indptr[i + 1]):
+            row_pred[pred_indices[j]] = 0
+
+    return label_counts, instance_counts
+
+
+def confusion_counts(
+    y_true: Union[np.ndarray, csr_matrix], y_pred: Union[np.ndarray, csr_matrix]
+):
+    """
+    Given true and predicted labels, returns (3, nl) and (3, ni) arrays of true positives,
+    predicted positives and positives per label and per instance.
+    """
+    if isinstance(y_true, csr_matrix) and isinstance(y_pred, csr_matrix):
+        ni, nl = y_true.shape
+        return numba_confusion_counts(
+            y_true.data,
+            y_true.indices,
+            y_true.indptr,
+            y_pred.data,
+            y_pred.indices,
+            y_pred.indptr,
+            ni,
+            nl,
+        )
+
+    return tuple(
+        np.stack(
+            [
+                _true_positives(y_pred, y_true, axis=axis),
+                np.asarray(y_pred.sum(axis=axis)).ravel(),
+                np.asarray(y_true.sum(axis=axis)).ravel(),
+            ]
+        )
+        for axis in (0, 1)
+    )
+
+
+def metrics_from_counts(counts: np.ndarray, beta: float = 1, epsilon: float = 1e-5):
+    """
+    Given (3, n) array of true positives, predicted positives and positives (see confusion_counts),
+    calculates the average precision, recall, F-measure and abandonment, the same as the functions above.
+    """
+    true_positives, predicted_positives, positives = counts
+    precision = true_positives / np.maximum(predicted_positives, epsilon)
+    recall = true_positives / (positives + epsilon)
+    fmeasure = (
+        (1 + beta**2) * precision * recall / (beta**2 * precision + recall + epsilon)
+    )
+    return {
+        "precision": precision.mean(),
+        "recall": recall.mean(),
+        "fmeasure": fmeasure.mean(),
+        "abandonment": np.greater_equal(true_positives, 1.0).mean(),
+    }
+
+
+def _metric_values(label_counts: np.ndarray, instance_counts: np.ndarray):
+    macro = metrics_from_counts(label_counts)
+    instance = metrics_from_counts(instance_counts)
+    return {
+        macro_precision: macro["precision"],
+        macro_recall: macro["recall"],
+        macro_f1: macro["fmeasure"],
+        macro_abandonment: macro["abandonment"],
+        instance_precision: instance["precision"],
+        instance_recall: instance["recall"],
+        instance_f1: instance["fmeasure"],
+        instance_abandonment: instance["abandonment"],
+    }
+
+
+def evaluate_metrics(
+    y_true: Union[np.ndarray, csr_matrix], y_pred: Union[np.ndarray, csr_matrix]
+):
+    """
+    Calculates all the macro and instance metrics above at once, from the counts of a single pass
+    over true and predicted labels. Returns a dict with the values of the metric functions.
+    """
+    return _metric_values(*confusion_counts(y_true, y_pred))
+
+
+@njit
+def numba_multi_k_confusion_counts(
+    true_data: np.ndarray,
+    true_indices: np.ndarray,
+    true_indptr: np.ndarray,
+    ranked_top_k: np.ndarray,
+    ks: np.ndarray,
+    nl: int,
+):
+    """
+    Calculates true positives, predicted positives and positives per label and per instance
+    of the labels ranked at positions [ks[b - 1], ks[b]) for each b, in a single pass over the rows.
+    Counts for the top ks[b] labels are the cumulative sums of these counts up to b.
+    """
+    ni = ranked_top_k.shape[0]
+    nk = ks.shape[0]
+    label_counts = np.zeros((nk, 3, nl), dtype=np.float64)
+    instance_counts = np.zeros((nk, 3, ni), dtype=np.float64)
+    row_true = np.zeros(nl, dtype=np.float64)
+
+    for i in range(ni):
+        for j in range(true_indptr[i], true_indptr[i + 1]):
+            l = true_indices[j]
+            row_true[l] += true_data[j]
+            for b in range(nk):
+                label_counts[b, 2, l] += true_data[j]
+                instance_counts[b, 2, i] += true_data[j]
+
+        b = 0
+        for r in range(ks[nk - 1]):
+            while ks[b] <= r:
+                b += 1
+            l = ranked_top_k[i, r]
+            label_counts[b, 0, l] += row_true[l]
+            label_counts[b, 1, l] += 1
+            instance_counts[b, 0, i] += row_true[l]
+            instance_counts[b, 1, i] += 1
+
+        for j in range(true_indptr[i], true_indptr[i + 1]):
+            row_true[true_indices[j]] = 0
+
+    return label_counts, instance_counts
+
+
+def evaluate_metrics_multi_k(
+    y_true: Union[np.ndarray, csr_matrix], ranked_top_k: np.ndarray, ks: list = None
+):
+    """
+    Calculates all the macro and instance metrics above for the top k labels of (ni, K) array of labels
+    ordered by decreasing gain (nested predictions), for all ks <= K (by default, 1, ..., K) at once.
+    Returns a dict {k: values} with values as returned by evaluate_metrics.
+    """
+    ks = np.sort(np.asarray(range(1, ranked_top_k.shape[1] + 1) if ks is None else ks))
+    assert ks[-1] <= ranked_top_k.shape[1]
+    y_true = csr_matrix(y_true)
+    label_counts, instance_counts = numba_multi_k_confusion_counts(
+        y_true.data,
+        y_true.indices,
+        y_true.indptr,
+        np.ascontiguousarray(ranked_top_k),
+        ks,
+        y_true.shape[1],
+    )
+    label_counts[:, :2] = np.cumsum(label_counts[:, :2], axis=0)
+    instance_counts[:, :2] = np.cumsum(instance_counts[:, :2], axis=0)
+    return {
+        int(k): _metric_values(label_counts[b], instance_counts[b])
+        for b, k in enumerate(ks)
+    }
+
+
 __all__ = [
     "macro_precision",
     "instance_precision",
@@ -134,4 +322,6 @@ __all__ = [
     "instance_recall",
     "macro_f1",
     "instance_f1",
+    "evaluate_metrics",
+    "evaluate_metrics_multi_k",
 ]
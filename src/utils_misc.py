@@ -1,5 +1,7 @@
+import os
 import time
 import json
+import hashlib
 import numpy as np
 from scipy.sparse import csr_matrix
 
@@ -39,6 +41,10 @@ class NpEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def default_n_jobs():
+    return len(os.sched_getaffinity(0))
+
+
 def save_json(filepath, data):
     with open(filepath, "w") as file:
         json.dump(data, file, cls=NpEncoder, indent=4, sort_keys=True)
@@ -47,3 +53,65 @@ def save_json(filepath, data):
 def load_json(filepath):
     with open(filepath) as file:
         return json.load(file)
+
+
+HASH_CHUNK_SIZE = 1 << 24
+
+
+def update_hash(h, obj):
+    """
+    Updates hash h with the content of obj: arrays and sparse matrices are hashed by their content,
+    functions by their qualified name (not their code), containers recursively and other objects by their repr.
+    """
+    if isinstance(obj, csr_matrix):
+        h.update(b"csr")
+        update_hash(h, obj.shape)
+        for a in (obj.data, obj.indices, obj.indptr):
+            update_hash(h, a)
+    elif isinstance(obj, np.ndarray):
+        h.update(f"ndarray{obj.dtype.str}{obj.shape}".encode())
+        flat = obj.reshape(-1)
+        # Hash in chunks, so memory-mapped arrays are not read into memory at once
+        for i in range(0, flat.size, HASH_CHUNK_SIZE):
+            h.update(np.ascontiguousarray(flat[i : i + HASH_CHUNK_SIZE]).data)
+    elif isinstance(obj, dict):
+        h.update(f"dict{len(obj)}".encode())
+        for key in sorted(obj, key=str):
+            update_hash(h, key)
+            update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for x in obj:
+            update_hash(h, x)
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        h.update(f"callable{obj.__module__}.{obj.__qualname__}".encode())
+    else:
+        h.update(f"{type(obj).__name__}{obj!r}".encode())
+
+
+def content_hash(*objs):
+    """
+    Returns a hex digest of the content of objs (see update_hash).
+    """
+    h = hashlib.sha1()
+    for obj in objs:
+        update_hash(h, obj)
+    return h.hexdigest()
+
+
+def atomic_save(save_func: callable, path: str, data, **kwargs):
+    """
+    Saves data with save_func(path, data) to a temporary file first and then moves it to path,
+    so path either does not exist or contains complete data, even if the process is killed.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    root, ext = os.path.splitext(path)
+    if ext:
+        # Some save functions (e.g. np.save, save_npz) append the extension if it is missing
+        tmp_path = f"{root}.tmp-{os.getpid()}{ext}"
+    try:
+        save_func(tmp_path, data, **kwargs)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
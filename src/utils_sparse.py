@@ -1,7 +1,9 @@
 import numpy as np
+from typing import Union
 from scipy.sparse import csr_matrix
-from numba import njit
-
+from numba import njit, prange, set_num_threads, get_num_threads, config
+from contextlib import contextmanager
+from functools import wraps
 
 FLOAT_TYPE = np.float32
 INT_TYPE = np.int32
@@ -32,6 +34,80 @@ def construct_csr_matrix(
     return mat
 
 
+def top_k_to_csr(top_k: np.ndarray, nl: int):
+    """
+    Converts predictions stored as (ni, k) array of labels to a sparse matrix.
+    The returned matrix shares its indices with top_k.
+    """
+    ni, k = top_k.shape
+    return csr_matrix(
+        (
+            np.ones(ni * k, dtype=FLOAT_TYPE),
+            top_k.reshape(-1),
+            np.arange(0, ni * k + 1, k, dtype=INT_TYPE),
+        ),
+        shape=(ni, nl),
+        copy=False,
+    )
+
+
+def csr_to_top_k(y_pred: csr_matrix, k: int):
+    """
+    Converts a sparse matrix with exactly k labels in each row to (ni, k) array of labels.
+    """
+    if np.any(np.diff(y_pred.indptr) != k):
+        raise ValueError(f"Each row of y_pred must contain exactly {k} labels")
+    return y_pred.indices.astype(INT_TYPE).reshape(-1, k)
+
+
+def as_top_k(y_pred: Union[np.ndarray, csr_matrix], k: int):
+    """
+    Returns a sorted copy of predictions given as (ni, k) array of labels (of integer type)
+    or as sparse or dense matrix with k labels in each row.
+    """
+    if isinstance(y_pred, csr_matrix):
+        top_k = csr_to_top_k(y_pred, k)
+    elif np.issubdtype(y_pred.dtype, np.integer):
+        if y_pred.shape[1] != k:
+            raise ValueError(f"y_pred must contain exactly {k} labels in each row")
+        top_k = y_pred
+    else:
+        top_k = np.argpartition(-y_pred, k - 1, axis=1)[:, :k]
+    return np.sort(top_k, axis=1).astype(INT_TYPE)
+
+
+def top_k_to_y_pred(top_k: np.ndarray, y_proba: Union[np.ndarray, csr_matrix]):
+    """
+    Converts predictions stored as (ni, k) array of labels to a matrix of the same type as y_proba.
+    """
+    ni, nl = y_proba.shape
+    if isinstance(y_proba, csr_matrix):
+        return top_k_to_csr(top_k, nl)
+    y_pred = np.zeros((ni, nl), y_proba.dtype)
+    np.put_along_axis(y_pred, top_k, 1.0, axis=1)
+    return y_pred
+
+
+def extend_top_k(
+    y_pred_top_k: np.ndarray, y_proba: Union[np.ndarray, csr_matrix], k: int
+):
+    """
+    Extends predictions stored as (ni, k0) array of sorted labels to k >= k0 labels in each row,
+    by adding the labels with the highest probabilities that are not yet predicted.
+    """
+    ni, k0 = y_pred_top_k.shape
+    if k == k0:
+        return y_pred_top_k.copy()
+    if isinstance(y_proba, csr_matrix):
+        return numba_extend_top_k(
+            y_pred_top_k, y_proba.data, y_proba.indices, y_proba.indptr, k
+        )
+    g = y_proba.astype(np.float64)
+    np.put_along_axis(g, y_pred_top_k, -np.inf, axis=1)
+    new = np.argpartition(-g, k - k0 - 1, axis=1)[:, : k - k0]
+    return np.sort(np.hstack((y_pred_top_k, new)), axis=1).astype(INT_TYPE)
+
+
 @njit
 def numba_first_k(ni, k):
     y_pred_data = np.ones(ni * k, dtype=FLOAT_TYPE)
@@ -223,6 +299,376 @@ def numba_weighted_per_instance(
     return y_pred_data, y_pred_indices, y_pred_indptr
 
 
+@njit
+def numba_write_top_k(out: np.ndarray, top_k: np.ndarray):
+    """
+    Writes the top_k labels to out, if there are fewer of them than k,
+    the rest is filled with the lowest free labels (as in numba_select_top_k), so there are no duplicates.
+    """
+    n = top_k.size
+    out[:n] = top_k
+    if n < out.size:
+        numba_fill_lowest_free(out, n)
+        out.sort()
+
+
+@njit(parallel=True)
+def numba_weighted_per_instance_parallel(
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    weights: np.ndarray,
+    ni: int,
+    nl: int,
+    k: int,
+):
+    """
+    Parallel variant of numba_weighted_per_instance, rows are processed in parallel
+    and write to their own slices of the preallocated output.
+    """
+    y_pred_data = np.ones(ni * k, dtype=FLOAT_TYPE)
+    y_pred_indices = np.zeros(ni * k, dtype=INT_TYPE)
+    y_pred_indptr = np.arange(0, ni * k + 1, k).astype(INT_TYPE)
+
+    for i in prange(ni):
+        row_data = data[indptr[i] : indptr[i + 1]]
+        row_indices = indices[indptr[i] : indptr[i + 1]]
+        row_weights = weights[row_indices].reshape(-1) * row_data
+        top_k = numba_argtopk(row_weights, row_indices, k)
+        numba_write_top_k(y_pred_indices[i * k : (i + 1) * k], top_k)
+
+    return y_pred_data, y_pred_indices, y_pred_indptr
+
+
+@njit(parallel=True)
+def numba_weighted_per_instance_multi(
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    weights: np.ndarray,
+    ni: int,
+    k: int,
+):
+    """
+    Variant of numba_weighted_per_instance_parallel for many weight vectors (rows of weights),
+    all of them are applied to a row while it is in cache. Returns (W, ni * k) array of indices.
+    """
+    nw = weights.shape[0]
+    y_pred_indices = np.zeros((nw, ni * k), dtype=INT_TYPE)
+
+    for i in prange(ni):
+        row_data = data[indptr[i] : indptr[i + 1]]
+        row_indices = indices[indptr[i] : indptr[i + 1]]
+        for w in range(nw):
+            row_weights = weights[w][row_indices] * row_data
+            top_k = numba_argtopk(row_weights, row_indices, k)
+            numba_write_top_k(y_pred_indices[w, i * k : (i + 1) * k], top_k)
+
+    return y_pred_indices
+
+
+# Limit of the number of threads used by parallel numba functions in this process, set by limit_num_threads
+NUM_THREADS = {}
+
+
+def max_num_threads():
+    return NUM_THREADS.get("limit", config.NUMBA_NUM_THREADS)
+
+
+def limit_num_threads(n_threads: int):
+    """
+    Limits the number of threads used by parallel numba functions in this process,
+    also by the functions that set it themselves (e.g. with n_threads), for processes sharing the cores.
+    """
+    NUM_THREADS["limit"] = max(1, min(n_threads, config.NUMBA_NUM_THREADS))
+    set_num_threads(NUM_THREADS["limit"])
+
+
+@contextmanager
+def using_num_threads(n_threads: int = None):
+    """
+    Sets the number of threads used by parallel numba functions within the context
+    and restores the previous number afterwards. With n_threads = None, the current number is kept.
+    """
+    if n_threads is None:
+        yield
+        return
+    prev_n_threads = get_num_threads()
+    set_num_threads(min(n_threads, max_num_threads()))
+    try:
+        yield
+    finally:
+        set_num_threads(prev_n_threads)
+
+
+def restores_num_threads(func: callable):
+    """
+    Decorator that restores the number of threads used by parallel numba functions after func returns,
+    for functions that set it themselves.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        prev_n_threads = get_num_threads()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_num_threads(prev_n_threads)
+
+    return wrapper
+
+
+@njit
+def numba_fill_lowest_free(out: np.ndarray, n: int):
+    """
+    Fills out[n:] with the lowest labels that are not present in out[:n].
+    """
+    l = 0
+    while n < out.size:
+        if not np.any(out[:n] == l):
+            out[n] = l
+            n += 1
+        l += 1
+
+
+@njit
+def numba_linear_gain_ranked_top_k(
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    a: np.ndarray,
+    b: np.ndarray,
+    ni: int,
+    k: int,
+):
+    """
+    Returns (ni, k) array of labels with the k highest gains a * eta + b for each instance,
+    ordered by decreasing gain, so the first k' < k columns are the top k' labels.
+    Rows with fewer than k labels are padded with the lowest labels not present in the row.
+    """
+    y_pred_top_k = np.zeros((ni, k), dtype=INT_TYPE)
+    for i in range(ni):
+        row_data = data[indptr[i] : indptr[i + 1]]
+        row_indices = indices[indptr[i] : indptr[i + 1]]
+        row_gains = a[row_indices] * row_data + b[row_indices]
+        n = row_indices.size
+        if n > k:
+            top_k = np.argpartition(-row_gains, k)[:k]
+        else:
+            top_k = np.arange(n)
+        order = top_k[np.argsort(-row_gains[top_k], kind="mergesort")]
+        y_pred_top_k[i, : order.size] = row_indices[order]
+        numba_fill_lowest_free(y_pred_top_k[i], order.size)
+
+    return y_pred_top_k
+
+
+@njit
+def numba_extend_top_k(
+    y_pred_top_k: np.ndarray,
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    k: int,
+):
+    """
+    Extends sorted (ni, k0) array of labels to k labels in each row with the labels
+    of the highest probabilities that are not yet predicted, see extend_top_k.
+    """
+    ni, k0 = y_pred_top_k.shape
+    m = k - k0
+    out = np.zeros((ni, k), dtype=INT_TYPE)
+    for i in range(ni):
+        prev = y_pred_top_k[i]
+        row_data = data[indptr[i] : indptr[i + 1]]
+        row_indices = indices[indptr[i] : indptr[i + 1]]
+        pos = np.searchsorted(prev, row_indices)
+        free = np.ones(row_indices.size, dtype=np.bool_)
+        for j in range(row_indices.size):
+            if pos[j] < k0 and prev[pos[j]] == row_indices[j]:
+                free[j] = False
+        cand_data = row_data[free]
+        cand_indices = row_indices[free]
+
+        out[i, :k0] = prev
+        n = cand_indices.size
+        if n > m:
+            out[i, k0:] = cand_indices[np.argpartition(-cand_data, m)[:m]]
+        else:
+            out[i, k0 : k0 + n] = cand_indices
+            numba_fill_lowest_free(out[i], k0 + n)
+        out[i].sort()
+
+    return out
+
+
+@njit
+def numba_update_0approx_stats(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    r_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    sign: float,
+):
+    """
+    Adds (sign = 1) or removes (sign = -1) the contribution of a single instance
+    with probabilities p and predicted labels r to the expected confusion matrices.
+    Requires p_indices and r_indices to be sorted (in ascending order).
+    """
+    i = j = 0
+    while i < p_indices.size or j < r_indices.size:
+        if j >= r_indices.size or (i < p_indices.size and p_indices[i] < r_indices[j]):
+            Efn[p_indices[i]] += sign * p_data[i]
+            i += 1
+        elif i >= p_indices.size or r_indices[j] < p_indices[i]:
+            Efp[r_indices[j]] += sign
+            j += 1
+        else:
+            Etp[r_indices[j]] += sign * p_data[i]
+            Efp[r_indices[j]] += sign * (1 - p_data[i])
+            i += 1
+            j += 1
+
+
+@njit
+def numba_kahan_add(s: np.ndarray, c: np.ndarray, l: int, x: float):
+    """
+    Adds x to s[l] using Kahan summation with the running compensation c[l],
+    the compensated value of the sum is s[l] - c[l].
+    """
+    y = x - c[l]
+    old = s[l]
+    # Read back the stored value, so the rounding to the dtype of s is compensated as well
+    s[l] = old + y
+    c[l] = (s[l] - old) - y
+
+
+@njit
+def numba_update_0approx_stats_compensated(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    r_indices: np.ndarray,
+    Etp: np.ndarray,
+    Efp: np.ndarray,
+    Efn: np.ndarray,
+    Ctp: np.ndarray,
+    Cfp: np.ndarray,
+    Cfn: np.ndarray,
+    sign: float,
+):
+    """
+    Variant of numba_update_0approx_stats that uses Kahan summation with compensations Ctp, Cfp, Cfn.
+    """
+    i = j = 0
+    while i < p_indices.size or j < r_indices.size:
+        if j >= r_indices.size or (i < p_indices.size and p_indices[i] < r_indices[j]):
+            numba_kahan_add(Efn, Cfn, p_indices[i], sign * p_data[i])
+            i += 1
+        elif i >= p_indices.size or r_indices[j] < p_indices[i]:
+            numba_kahan_add(Efp, Cfp, r_indices[j], sign)
+            j += 1
+        else:
+            numba_kahan_add(Etp, Ctp, r_indices[j], sign * p_data[i])
+            numba_kahan_add(Efp, Cfp, r_indices[j], sign * (1 - p_data[i]))
+            i += 1
+            j += 1
+
+
+@njit
+def numba_calculate_0approx_stats(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    ni: int,
+    nl: int,
+    k: int,
+    dtype=FLOAT_TYPE,
+):
+    """
+    Calculates expected true positives, false positives and false negatives
+    for predictions stored as exactly k sorted labels per instance in a single pass.
+    """
+    Etp = np.zeros(nl, dtype=dtype)
+    Efp = np.zeros(nl, dtype=dtype)
+    Efn = np.zeros(nl, dtype=dtype)
+    for i in range(ni):
+        p_start, p_end = p_indptr[i], p_indptr[i + 1]
+        numba_update_0approx_stats(
+            p_data[p_start:p_end],
+            p_indices[p_start:p_end],
+            y_pred_indices[i * k : (i + 1) * k],
+            Etp,
+            Efp,
+            Efn,
+            1.0,
+        )
+    return Etp, Efp, Efn
+
+
+@njit
+def numba_update_log_failure_prob(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    r_indices: np.ndarray,
+    log_failure: np.ndarray,
+    n_certain: np.ndarray,
+    sign: int,
+):
+    """
+    Adds (sign = 1) or removes (sign = -1) factors 1 - p of a single instance with probabilities p
+    and predicted labels r to the probability of not covering each label kept in log domain,
+    as sums of log(1 - p) and counts of factors with p = 1 (that are equal to 0).
+    Requires p_indices and r_indices to be sorted (in ascending order).
+    """
+    i = j = 0
+    while i < p_indices.size and j < r_indices.size:
+        if p_indices[i] < r_indices[j]:
+            i += 1
+        elif r_indices[j] < p_indices[i]:
+            j += 1
+        else:
+            l = r_indices[j]
+            if p_data[i] >= 1:
+                n_certain[l] += sign
+            else:
+                log_failure[l] += sign * np.log1p(-p_data[i])
+            i += 1
+            j += 1
+
+
+@njit
+def numba_calculate_log_failure_prob(
+    p_data: np.ndarray,
+    p_indices: np.ndarray,
+    p_indptr: np.ndarray,
+    y_pred_indices: np.ndarray,
+    ni: int,
+    nl: int,
+    k: int,
+):
+    """
+    Calculates the probability of not covering each label (product of 1 - p over instances that predict the label)
+    in log domain, see numba_update_log_failure_prob,
+    for predictions stored as exactly k sorted labels per instance.
+    """
+    log_failure = np.zeros(nl, dtype=np.float64)
+    n_certain = np.zeros(nl, dtype=np.int64)
+    for i in range(ni):
+        p_start, p_end = p_indptr[i], p_indptr[i + 1]
+        numba_update_log_failure_prob(
+            p_data[p_start:p_end],
+            p_indices[p_start:p_end],
+            y_pred_indices[i * k : (i + 1) * k],
+            log_failure,
+            n_certain,
+            1,
+        )
+    return log_failure, n_certain
+
+
 def calculate_tp_csr_slow(y_proba: csr_matrix, y_pred: csr_matrix):
     return (y_pred.multiply(y_proba)).sum(axis=0)
 
@@ -312,4 +758,32 @@ def numba_balanced_accuracy(
         y_pred_indices[i * k : i * k + len(top_k)] = top_k
         y_pred_indptr[i + 1] = y_pred_indptr[i] + k
 
-    return y_pred_data, y_pred_indices, y_pred_indptr
\ No newline at end of file
+    return y_pred_data, y_pred_indices, y_pred_indptr
+
+
+@njit(parallel=True)
+def numba_balanced_accuracy_parallel(
+    data: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    marginals: np.ndarray,
+    ni: int,
+    nl: int,
+    k: int,
+):
+    """
+    Parallel variant of numba_balanced_accuracy, see numba_weighted_per_instance_parallel.
+    """
+    y_pred_data = np.ones(ni * k, dtype=FLOAT_TYPE)
+    y_pred_indices = np.zeros(ni * k, dtype=INT_TYPE)
+    y_pred_indptr = np.arange(0, ni * k + 1, k).astype(INT_TYPE)
+
+    for i in prange(ni):
+        row_data = data[indptr[i] : indptr[i + 1]]
+        row_indices = indices[indptr[i] : indptr[i + 1]]
+        row_marginals = marginals[row_indices].reshape(-1)
+        row_gains = row_data / row_marginals - (1 - row_data) / (1 - row_marginals)
+        top_k = numba_argtopk(row_gains, row_indices, k)
+        numba_write_top_k(y_pred_indices[i * k : (i + 1) * k], top_k)
+
+    return y_pred_data, y_pred_indices, y_pred_indptr
@@ -3,42 +3,237 @@ from scipy.sparse import csr_matrix
 from utils_sparse import *
 from typing import Union
 
-
 MARGINALS_EPS = 1e-6
 
 
-def weighted_per_instance_np(y_proba: np.ndarray, weights: np.ndarray, k: int):
+# Size of the blocks of rows processed at once by top_k_np, chosen so a block of gains fits in L2 cache
+BLOCK_BYTES = 1 << 20
+
+
+def top_k_np_multi(
+    y_proba: np.ndarray,
+    gain_funcs: list,
+    k: int,
+    return_top_k: bool = False,
+    block_bytes: int = BLOCK_BYTES,
+):
+    """
+    Selects k labels with the highest gains for each instance of dense y_proba, for each of gain_funcs.
+    Gains are calculated for blocks of rows, which are selected with a single 2-D argpartition
+    and written to the preallocated outputs, so each block is read once for all gain_funcs.
+    With return_top_k, the predictions are returned as (ni, k) arrays of labels instead of matrices.
+    """
     ni, nl = y_proba.shape
-    assert weights.shape == (nl,)
+    if return_top_k:
+        results = [np.zeros((ni, k), INT_TYPE) for _ in gain_funcs]
+    else:
+        results = [np.zeros((ni, nl), np.float32) for _ in gain_funcs]
+
+    block_size = max(1, block_bytes // (nl * 8))
+    for start in range(0, ni, block_size):
+        end = min(start + block_size, ni)
+        eta = y_proba[start:end]
+        for gain_func, result in zip(gain_funcs, results):
+            g = gain_func(eta)
+            top_k = np.argpartition(-g, min(k, nl - 1), axis=1)[:, :k]
+            if return_top_k:
+                result[start:end] = np.sort(top_k, axis=1)
+            else:
+                np.put_along_axis(result[start:end], top_k, 1.0, axis=1)
+    return results
+
+
+def top_k_np(
+    y_proba: np.ndarray,
+    gain_func: callable,
+    k: int,
+    return_top_k: bool = False,
+    block_bytes: int = BLOCK_BYTES,
+):
+    """
+    Selects k labels with the highest gains calculated with gain_func for each instance of dense y_proba,
+    see top_k_np_multi.
+    """
+    return top_k_np_multi(y_proba, [gain_func], k, return_top_k, block_bytes)[0]
+
 
-    result = np.zeros((ni, nl), np.float32)
+def weighted_per_instance_np(
+    y_proba: np.ndarray, weights: np.ndarray, k: int, return_top_k: bool = False
+):
+    ni, nl = y_proba.shape
+    assert weights.shape == (nl,)
 
-    for i in range(ni):
-        eta = y_proba[i, :]
-        g = eta * weights
-        top_k = np.argpartition(-g, k)[:k]
-        result[i, top_k] = 1.0
+    result = top_k_np(y_proba, lambda eta: eta * weights, k, return_top_k)
     return result, {"iters": 1}
 
 
-def weighted_per_instance_csr(y_proba: csr_matrix, weights: np.ndarray, k: int):
+def weighted_per_instance_csr(
+    y_proba: csr_matrix,
+    weights: np.ndarray,
+    k: int,
+    return_top_k: bool = False,
+    n_threads: int = None,
+):
     # Since many numpy functions are not supported for sparse matrices
+    # Rows are independent, so they are processed in parallel using n_threads (the current numba setting by default)
     ni, nl = y_proba.shape
-    data, indices, indptr = numba_weighted_per_instance(
-        y_proba.data, y_proba.indices, y_proba.indptr, weights, ni, nl, k
-    )
+    with using_num_threads(n_threads):
+        data, indices, indptr = numba_weighted_per_instance_parallel(
+            y_proba.data, y_proba.indices, y_proba.indptr, weights, ni, nl, k
+        )
+    if return_top_k:
+        return indices.reshape(ni, k), {"iters": 1}
     return csr_matrix((data, indices, indptr), shape=y_proba.shape), {"iters": 1}
 
 
+def linear_gain_ranked_top_k(
+    y_proba: Union[np.ndarray, csr_matrix], a: np.ndarray, b: np.ndarray, k: int
+):
+    """
+    Returns (ni, k) array of labels with the k highest gains a * eta + b for each instance,
+    ordered by decreasing gain.
+    """
+    ni, nl = y_proba.shape
+    a = np.broadcast_to(np.asarray(a, dtype=np.float64), (nl,))
+    b = np.broadcast_to(np.asarray(b, dtype=np.float64), (nl,))
+    if isinstance(y_proba, np.ndarray):
+        g = y_proba * a + b
+        top_k = np.argpartition(-g, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(g, top_k, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(top_k, order, axis=1).astype(INT_TYPE)
+    elif isinstance(y_proba, csr_matrix):
+        return numba_linear_gain_ranked_top_k(
+            y_proba.data,
+            y_proba.indices,
+            y_proba.indptr,
+            np.ascontiguousarray(a),
+            np.ascontiguousarray(b),
+            ni,
+            k,
+        )
+
+
+def nested_top_k_predictions(
+    y_proba: Union[np.ndarray, csr_matrix],
+    ranked_top_k: np.ndarray,
+    ks: list,
+    return_top_k: bool = False,
+):
+    """
+    Slices predictions for all ks from (ni, max(ks)) array of labels ordered by decreasing gain.
+    Returns a dict {k: y_pred}.
+    """
+    y_preds = {}
+    for k in ks:
+        top_k = np.sort(ranked_top_k[:, :k], axis=1)
+        y_preds[k] = top_k if return_top_k else top_k_to_y_pred(top_k, y_proba)
+    return y_preds
+
+
 def weighted_per_instance(
-    y_proba: Union[np.ndarray, csr_matrix], weights: np.ndarray, k: int
+    y_proba: Union[np.ndarray, csr_matrix],
+    weights: np.ndarray,
+    k: int,
+    return_top_k: bool = False,
+    ks: list = None,
+    n_threads: int = None,
+    **kwargs
 ):
+    """
+    Selects k labels with the highest weighted probability for each instance.
+    With return_top_k, the predictions are returned as (ni, k) array of labels instead of a matrix.
+    With ks, k is ignored and the predictions for all ks are returned as a dict {k: y_pred},
+    sliced from a single ranking of max(ks) labels, which is also returned as ranked_top_k in meta.
+    """
+    if ks is not None:
+        ranked_top_k = linear_gain_ranked_top_k(y_proba, weights, 0, max(ks))
+        y_preds = nested_top_k_predictions(y_proba, ranked_top_k, ks, return_top_k)
+        return y_preds, {"iters": 1, "ranked_top_k": ranked_top_k}
+
     if isinstance(y_proba, np.ndarray):
         # Invoke original dense implementation of Erik
-        return weighted_per_instance_np(y_proba, weights, k=k)
+        return weighted_per_instance_np(
+            y_proba, weights, k=k, return_top_k=return_top_k
+        )
     elif isinstance(y_proba, csr_matrix):
         # Invoke implementation for sparse matrices
-        return weighted_per_instance_csr(y_proba, weights, k=k)
+        return weighted_per_instance_csr(
+            y_proba, weights, k=k, return_top_k=return_top_k, n_threads=n_threads
+        )
+
+
+def weighted_per_instance_multi(
+    y_proba: Union[np.ndarray, csr_matrix],
+    weights: np.ndarray,
+    k: int,
+    return_top_k: bool = False,
+    n_threads: int = None,
+    **kwargs
+):
+    """
+    Selects k labels with the highest weighted probability for each instance and each row of weights (W x nl),
+    in a single pass over y_proba. Returns the list of W predictions, the same as W calls of weighted_per_instance.
+    """
+    ni, nl = y_proba.shape
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, nl)
+
+    if isinstance(y_proba, np.ndarray):
+        gain_funcs = [lambda eta, w=w: eta * w for w in weights]
+        return top_k_np_multi(y_proba, gain_funcs, k, return_top_k), {"iters": 1}
+
+    elif isinstance(y_proba, csr_matrix):
+        with using_num_threads(n_threads):
+            indices = numba_weighted_per_instance_multi(
+                y_proba.data, y_proba.indices, y_proba.indptr, weights, ni, k
+            )
+        if return_top_k:
+            return [w_indices.reshape(ni, k) for w_indices in indices], {"iters": 1}
+        data = np.ones(ni * k, dtype=FLOAT_TYPE)
+        indptr = np.arange(0, ni * k + 1, k, dtype=INT_TYPE)
+        y_preds = [
+            csr_matrix((data, w_indices, indptr), shape=y_proba.shape)
+            for w_indices in indices
+        ]
+        return y_preds, {"iters": 1}
+
+
+# Weights of the weighting schemes
+
+
+def macro_recall_weights(
+    nl: int, marginals: np.ndarray, epsilon: float = MARGINALS_EPS, **kwargs
+):
+    return 1.0 / (marginals + epsilon)
+
+
+def inv_propensity_weights(nl: int, inv_ps: np.ndarray, **kwargs):
+    return inv_ps
+
+
+def log_weights(
+    nl: int, marginals: np.ndarray, epsilon: float = MARGINALS_EPS, **kwargs
+):
+    return -np.log(marginals + epsilon)
+
+
+def sqrt_weights(
+    nl: int, marginals: np.ndarray, epsilon: float = MARGINALS_EPS, **kwargs
+):
+    return 1.0 / np.sqrt(marginals + epsilon)
+
+
+def power_law_weights(
+    nl: int,
+    marginals: np.ndarray,
+    epsilon: float = MARGINALS_EPS,
+    beta: float = 0.25,
+    **kwargs
+):
+    return 1.0 / (marginals + epsilon) ** beta
+
+
+def instance_precision_weights(nl: int, **kwargs):
+    return np.ones((nl,), dtype=np.float32)
 
 
 # Implementations of different weighting schemes
@@ -51,13 +246,15 @@ def optimal_macro_recall(  # (for population)
     epsilon: float = MARGINALS_EPS,
     **kwargs
 ):
-    return weighted_per_instance(y_proba, 1.0 / (marginals + epsilon), k=k)
+    weights = macro_recall_weights(y_proba.shape[1], marginals, epsilon)
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def inv_propensity_weighted_instance(
     y_proba: Union[np.ndarray, csr_matrix], k: int, inv_ps: np.ndarray, **kwargs
 ):
-    return weighted_per_instance(y_proba, inv_ps, k=k)
+    weights = inv_propensity_weights(y_proba.shape[1], inv_ps)
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def log_weighted_instance(
@@ -67,8 +264,8 @@ def log_weighted_instance(
     epsilon: float = MARGINALS_EPS,
     **kwargs
 ):
-    weights = -np.log(marginals + epsilon)
-    return weighted_per_instance(y_proba, weights, k=k)
+    weights = log_weights(y_proba.shape[1], marginals, epsilon)
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def sqrt_weighted_instance(
@@ -78,8 +275,8 @@ def sqrt_weighted_instance(
     epsilon: float = MARGINALS_EPS,
     **kwargs
 ):
-    weights = 1.0 / np.sqrt(marginals + epsilon)
-    return weighted_per_instance(y_proba, weights, k=k)
+    weights = sqrt_weights(y_proba.shape[1], marginals, epsilon)
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def power_law_weighted_instance(
@@ -90,16 +287,15 @@ def power_law_weighted_instance(
     beta: float = 0.25,
     **kwargs
 ):
-    weights = 1.0 / (marginals + epsilon) ** beta
-    return weighted_per_instance(y_proba, weights, k=k)
+    weights = power_law_weights(y_proba.shape[1], marginals, epsilon, beta)
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def optimal_instance_precision(
     y_proba: Union[np.ndarray, csr_matrix], k: int, **kwargs
 ):
-    ni, nl = y_proba.shape
-    weights = np.ones((nl,), dtype=np.float32)
-    return weighted_per_instance(y_proba, weights, k=k)
+    weights = instance_precision_weights(y_proba.shape[1])
+    return weighted_per_instance(y_proba, weights, k=k, **kwargs)
 
 
 def optimal_balanced_accuracy(  # (for population)
@@ -107,24 +303,52 @@ def optimal_balanced_accuracy(  # (for population)
     k: int,
     marginals: np.ndarray,
     epsilon: float = MARGINALS_EPS,
+    return_top_k: bool = False,
+    ks: list = None,
+    n_threads: int = None,
     **kwargs
 ):
     ni, nl = y_proba.shape
     assert marginals.shape == (nl,)
     marginals = marginals + epsilon
 
+    if ks is not None:
+        # eta / m - (1 - eta) / (1 - m) = eta * (1 / m + 1 / (1 - m)) - 1 / (1 - m)
+        a = 1 / marginals + 1 / (1 - marginals)
+        b = -1 / (1 - marginals)
+        ranked_top_k = linear_gain_ranked_top_k(y_proba, a, b, max(ks))
+        y_preds = nested_top_k_predictions(y_proba, ranked_top_k, ks, return_top_k)
+        return y_preds, {"iters": 1, "ranked_top_k": ranked_top_k}
+
     if isinstance(y_proba, np.ndarray):
-        result = np.zeros((ni, nl), np.float32)
-        for i in range(ni):
-            eta = y_proba[i, :]
-            g = eta / marginals - (1 - eta) / (1 - marginals)
-            top_k = np.argpartition(-g, k)[:k]
-            result[i, top_k] = 1.0
+        result = top_k_np(
+            y_proba,
+            lambda eta: eta / marginals - (1 - eta) / (1 - marginals),
+            k,
+            return_top_k,
+        )
         return result, {"iters": 1}
-    
+
     elif isinstance(y_proba, csr_matrix):
-        # Invoke implementation for sparse matrices
-        data, indices, indptr = numba_balanced_accuracy(
-            y_proba.data, y_proba.indices, y_proba.indptr, marginals, ni, nl, k
-        )
+        # Invoke implementation for sparse matrices, rows are processed in parallel
+        with using_num_threads(n_threads):
+            data, indices, indptr = numba_balanced_accuracy_parallel(
+                y_proba.data, y_proba.indices, y_proba.indptr, marginals, ni, nl, k
+            )
+        if return_top_k:
+            return indices.reshape(ni, k), {"iters": 1}
         return csr_matrix((data, indices, indptr), shape=y_proba.shape), {"iters": 1}
+
+
+# Weights of the weighting schemes, used to run many of them at once with weighted_per_instance_multi
+WEIGHTS_FUNCS = {
+    optimal_macro_recall: macro_recall_weights,
+    inv_propensity_weighted_instance: inv_propensity_weights,
+    log_weighted_instance: log_weights,
+    sqrt_weighted_instance: sqrt_weights,
+    power_law_weighted_instance: power_law_weights,
+    optimal_instance_precision: instance_precision_weights,
+}
+
+# Methods that return the predictions for all ks at once when called with ks, see weighted_per_instance
+MULTI_K_METHODS = (*WEIGHTS_FUNCS, optimal_balanced_accuracy)
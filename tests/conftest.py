@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+
+# Modules of src import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def random_proba(ni, nl, density, seed=0, power=1):
+    """
+    Returns random sparse probability estimates, power > 1 makes most of them small.
+    """
+    rng = np.random.default_rng(seed)
+    y_proba = sparse_random(
+        ni, nl, density=density, format="csr", random_state=seed, dtype=np.float32
+    )
+    y_proba.data = (rng.random(y_proba.data.size) ** power).astype(np.float32)
+    y_proba.sort_indices()
+    return y_proba
+
+
+@pytest.fixture
+def y_proba():
+    return random_proba(500, 100, 0.1, seed=1)
+
+
+@pytest.fixture
+def rare_y_proba():
+    # Many labels with a few small probabilities each, where the gains of macro measures change the most
+    return random_proba(1000, 2000, 0.005, seed=2, power=4)
+
+
+@pytest.fixture
+def long_rows_y_proba():
+    # Every row has more than 5 labels, so no predictions are padded
+    y_proba = random_proba(300, 100, 0.2, seed=4)
+    assert np.diff(y_proba.indptr).min() > 5
+    return y_proba
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+from numba import get_num_threads, set_num_threads
+
+import bca_prediction
+from bca_prediction import *
+from conftest import random_proba
+from data import load_npy_csr, save_npy_csr
+
+
+@pytest.mark.parametrize(
+    "utility_func",
+    [
+        macro_precision_on_conf_matrix,
+        macro_recall_on_conf_matrix,
+        macro_fmeasure_on_conf_matrix,
+    ],
+)
+def test_active_set_equals_full_sweep(rare_y_proba, utility_func):
+    kwargs = dict(
+        k=3, utility_func=utility_func, gain_func=GAIN_FUNCS[utility_func], seed=0
+    )
+    y_pred, _ = bca_with_0approx_csr(rare_y_proba, return_top_k=True, **kwargs)
+    active_y_pred, meta = bca_with_0approx_csr(
+        rare_y_proba, return_top_k=True, active_set=True, **kwargs
+    )
+    assert np.array_equal(active_y_pred, y_pred)
+    assert meta["active"][-1] < rare_y_proba.shape[0]
+
+
+def test_coverage_active_set_equals_full_sweep(rare_y_proba):
+    y_pred, _ = bca_coverage_csr(rare_y_proba, 3, seed=0, return_top_k=True)
+    active_y_pred, meta = bca_coverage_csr(
+        rare_y_proba, 3, seed=0, return_top_k=True, active_set=True
+    )
+    assert np.array_equal(active_y_pred, y_pred)
+    assert meta["active"][-1] < rare_y_proba.shape[0]
+
+
+def test_numba_threads_are_restored(y_proba):
+    prev_n_threads = get_num_threads()
+    set_num_threads(1)
+    try:
+        block_coordinate_macro_f1(y_proba, k=3, seed=0, n_threads=2, max_iter=2)
+        assert get_num_threads() == 1
+        block_coordinate_coverage(y_proba, k=3, seed=0, n_threads=2, max_iter=2)
+        assert get_num_threads() == 1
+    finally:
+        set_num_threads(prev_n_threads)
+
+
+@pytest.mark.parametrize(
+    "utility_func", [macro_precision_on_conf_matrix, macro_fmeasure_on_conf_matrix]
+)
+def test_dense_fast_equals_slow(monkeypatch, y_proba, utility_func):
+    y_proba = y_proba.toarray()
+    y_pred, _ = bca_with_0approx(y_proba, 3, utility_func, seed=5)
+    monkeypatch.setattr(bca_prediction, "SLOW", True)
+    slow_y_pred, _ = bca_with_0approx(y_proba, 3, utility_func, seed=5)
+    assert np.array_equal(y_pred, slow_y_pred)
+
+
+def test_coverage_slow_matches_fast_with_certain_labels(monkeypatch):
+    y_proba = random_proba(500, 300, 0.03, seed=1, power=2)
+    y_proba.data[::50] = 1.0
+    _, meta = bca_coverage_csr(y_proba, 3, seed=3)
+    monkeypatch.setattr(bca_prediction, "SLOW", True)
+    _, slow_meta = bca_coverage_csr(y_proba, 3, seed=3)
+    assert np.allclose(slow_meta["utilities"], meta["utilities"], atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "utility_func",
+    [
+        macro_precision_on_conf_matrix,
+        macro_recall_on_conf_matrix,
+        macro_fmeasure_on_conf_matrix,
+    ],
+)
+def test_compiled_sweep_equals_per_instance_loop(long_rows_y_proba, utility_func):
+    kwargs = dict(k=3, utility_func=utility_func, seed=0, return_top_k=True)
+    y_pred, meta = bca_with_0approx_csr(long_rows_y_proba, **kwargs)
+    compiled_y_pred, compiled_meta = bca_with_0approx_csr(
+        long_rows_y_proba, gain_func=GAIN_FUNCS[utility_func], **kwargs
+    )
+    assert np.array_equal(compiled_y_pred, y_pred)
+    assert np.allclose(compiled_meta["utilities"], meta["utilities"])
+
+
+def expected_utility(y_proba, y_pred, utility_func):
+    ni, nl = y_proba.shape
+    stats = numba_calculate_0approx_stats(
+        y_proba.data,
+        y_proba.indices,
+        y_proba.indptr,
+        y_pred.ravel(),
+        ni,
+        nl,
+        y_pred.shape[1],
+        np.float64,
+    )
+    return np.mean(utility_func(*(s / ni for s in stats)))
+
+
+def assert_sweep_matches_sequential(y_proba, **variant):
+    utility_func = macro_fmeasure_on_conf_matrix
+    kwargs = dict(
+        k=3,
+        utility_func=utility_func,
+        gain_func=GAIN_FUNCS[utility_func],
+        seed=0,
+        return_top_k=True,
+    )
+    y_pred, _ = bca_with_0approx_csr(y_proba, **kwargs)
+    variant_y_pred, _ = bca_with_0approx_csr(y_proba, **kwargs, **variant)
+    assert np.all(np.diff(variant_y_pred, axis=1) > 0)
+    assert np.isclose(
+        expected_utility(y_proba, variant_y_pred, utility_func),
+        expected_utility(y_proba, y_pred, utility_func),
+        atol=2e-3,
+    )
+
+
+def assert_coverage_matches_sequential(y_proba, **variant):
+    _, meta = bca_coverage_csr(y_proba, 3, seed=0)
+    _, variant_meta = bca_coverage_csr(y_proba, 3, seed=0, **variant)
+    assert np.isclose(variant_meta["utilities"][-1], meta["utilities"][-1], atol=2e-3)
+
+
+def test_parallel_sweep_matches_sequential_sweep(y_proba):
+    assert_sweep_matches_sequential(y_proba, n_threads=2)
+    assert_coverage_matches_sequential(y_proba, n_threads=2)
+
+
+def test_batch_sweep_matches_sequential_sweep(y_proba):
+    assert_sweep_matches_sequential(y_proba, batch_size=8)
+    assert_coverage_matches_sequential(y_proba, batch_size=8)
+
+
+def test_chunked_sweep_matches_sequential_sweep(tmp_path, y_proba):
+    # Out-of-core sweep over memory-mapped predictions
+    save_npy_csr(str(tmp_path / "y_proba"), y_proba)
+    y_proba = load_npy_csr(str(tmp_path / "y_proba"), mmap_mode="r")
+    assert_sweep_matches_sequential(y_proba, chunk_size=64)
+
+
+@pytest.mark.parametrize(
+    "variant",
+    [
+        dict(precision="float64", resync_every=3),
+        dict(precision="float32-kahan", resync_every=3),
+    ],
+)
+def test_running_sums_match_sequential_sweep(y_proba, variant):
+    assert_sweep_matches_sequential(y_proba, **variant)
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from data import *
+
+LABELS = "3 5 7\n2,5,1 1:0.5 2:1\n\n0 3:1\n4,4 \n10\n"
+PREDS = "1:0.5 3:0.25\n\n2:1e-3 0:1.5\n7:-2 \n"
+
+
+def assert_csr_equal(a, b):
+    assert a.shape == b.shape
+    assert (a != b).nnz == 0
+
+
+@pytest.fixture
+def labels_path(tmp_path):
+    path = tmp_path / "labels.txt"
+    path.write_text(LABELS.replace("\n\n", "\n5\n"))
+    return str(path)
+
+
+@pytest.fixture
+def preds_path(tmp_path):
+    path = tmp_path / "preds.txt"
+    path.write_text(PREDS.replace("\n\n", "\n4:0.5\n"))
+    return str(path)
+
+
+def test_labels_parser_equals_slow(labels_path):
+    assert_csr_equal(load_txt_labels(labels_path), load_txt_labels_slow(labels_path))
+
+
+def test_sparse_pred_parser_equals_slow(preds_path):
+    assert_csr_equal(
+        load_txt_sparse_pred(preds_path), load_txt_sparse_pred_slow(preds_path)
+    )
+
+
+@pytest.mark.parametrize("line", ["1 2,3", "1,a", "1,-2", "1;2"])
+def test_labels_parser_rejects_malformed_lines(tmp_path, line):
+    path = tmp_path / "labels.txt"
+    path.write_text(f"2 1 4\n0,1\n{line}\n")
+    with pytest.raises(ValueError):
+        load_txt_labels(str(path), labels_features_delimiter=None)
+
+
+@pytest.mark.parametrize("line", ["1:0.5 :0.5", ":1", "1:0.5 a:1", "1 0.5"])
+def test_sparse_pred_parser_rejects_malformed_lines(tmp_path, line):
+    path = tmp_path / "preds.txt"
+    path.write_text(f"0:1\n{line}\n")
+    with pytest.raises(ValueError):
+        load_txt_sparse_pred(str(path))
+
+
+def test_label_vocabulary_splits_on_any_whitespace(tmp_path):
+    path = tmp_path / "labels.txt"
+    lines = ["b\ta c\r", "", " a  b", "c\td"]
+    path.write_text("".join(f"{line}\n" for line in lines))
+    vocabulary = build_label_vocabulary([str(path)])
+    assert vocabulary.tolist() == [b"a", b"b", b"c", b"d"]
+
+    y = load_txt_labels(
+        str(path),
+        header=False,
+        labels_delimiter=" ",
+        labels_features_delimiter=None,
+        labels_vocabulary=vocabulary,
+    )
+    rows = [sorted(vocabulary[y[i].indices].tolist()) for i in range(y.shape[0])]
+    assert rows == [sorted(line.encode().split()) for line in lines]
+
+
+def test_parallel_parsing_equals_sequential(tmp_path, labels_path, preds_path):
+    # Many lines, so the files are split into several chunks
+    for path in (labels_path, preds_path):
+        with open(path) as file:
+            lines = file.read().splitlines()
+        with open(path, "w") as file:
+            file.write("\n".join(lines[:1] + 200 * lines[1:]) + "\n")
+
+    assert_csr_equal(
+        load_txt_labels(labels_path, n_jobs=2), load_txt_labels(labels_path, n_jobs=1)
+    )
+    assert_csr_equal(
+        load_txt_sparse_pred(preds_path, n_jobs=2),
+        load_txt_sparse_pred(preds_path, n_jobs=1),
+    )
+
+
+@pytest.mark.parametrize("keep_top_k", [0, 3, -2, 10])
+def test_full_pred_keeps_top_k(tmp_path, keep_top_k):
+    rng = np.random.default_rng(0)
+    dense = rng.random((50, 10)).astype(np.float32)
+    path = str(tmp_path / "pred.npy")
+    np.save(path, dense)
+    # Small chunks, so the rows are processed in several of them
+    y = load_npy_full_pred(path, keep_top_k=keep_top_k, chunk_bytes=200)
+
+    k = keep_top_k if keep_top_k >= 0 else 10 + keep_top_k
+    top_k = np.argsort(-dense, axis=1, kind="stable")[:, :k]
+    expected = np.zeros_like(dense)
+    np.put_along_axis(expected, top_k, np.take_along_axis(dense, top_k, axis=1), 1)
+    assert y.shape == dense.shape
+    assert np.array_equal(y.toarray(), expected)
+
+
+def test_cache_file_equals_loader_and_follows_source(tmp_path, labels_path):
+    cache_dir = str(tmp_path / "cache")
+    y, key = load_cache_file(
+        labels_path, load_txt_labels, cache_dir=cache_dir, return_key=True
+    )
+    assert_csr_equal(y, load_txt_labels(labels_path))
+    cached, cached_key = load_cache_file(
+        labels_path, load_txt_labels, cache_dir=cache_dir, return_key=True
+    )
+    assert_csr_equal(cached, y)
+    assert cached_key == key
+
+    with open(labels_path, "a") as file:
+        file.write("1,2\n")
+    changed, changed_key = load_cache_file(
+        labels_path, load_txt_labels, cache_dir=cache_dir, return_key=True
+    )
+    assert_csr_equal(changed, load_txt_labels(labels_path))
+    assert changed.shape[0] == y.shape[0] + 1
+    assert changed_key != key
@@ -0,0 +1,20 @@
+import numpy as np
+from numba import get_num_threads
+
+from jobs import *
+from utils_misc import default_n_jobs
+
+
+def save_num_threads(data, path):
+    x, y = data
+    np.save(path, [get_num_threads(), x.sum(), y.sum()])
+
+
+def test_workers_share_cores(tmp_path):
+    data = (np.arange(10), np.ones(5))
+    paths = [str(tmp_path / f"{i}.npy") for i in range(4)]
+    run_jobs([[(save_num_threads, (path,)) for path in paths]], data, n_jobs=2)
+    for path in paths:
+        n_threads, x_sum, y_sum = np.load(path)
+        assert n_threads == max(1, default_n_jobs() // 2)
+        assert (x_sum, y_sum) == (45, 5)
@@ -0,0 +1,72 @@
+import pytest
+
+import main_bca
+from main_bca import *
+
+
+def test_chunk_size_only_for_chunked_methods(y_proba):
+    assert chunk_kwargs(block_coordinate_macro_f1, y_proba, 100) == {"chunk_size": 100}
+    assert chunk_kwargs(block_coordinate_coverage, y_proba, 100) == {}
+    assert chunk_kwargs(log_weighted_instance, y_proba, 100) == {}
+    assert chunk_kwargs(block_coordinate_macro_f1, y_proba.toarray(), 100) == {}
+    assert chunk_kwargs(block_coordinate_macro_f1, y_proba, None) == {}
+
+
+def test_threads_set_by_run_not_by_method():
+    assert all("n_threads" not in kwargs for _, kwargs in METHODS.values())
+    kwargs = METHODS["block-coord-macro-f1-tol=1e-7-parallel"][1]
+    assert method_kwargs(kwargs, 4) == {"tolerance": 1e-7, "n_threads": 4}
+    assert method_kwargs(kwargs)["n_threads"] == default_n_jobs()
+    assert method_kwargs({"tolerance": 1e-7}, 4) == {"tolerance": 1e-7}
+
+
+@pytest.fixture
+def data(y_proba, tmp_path, monkeypatch):
+    # Results are saved relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("results_bca/exp")
+    y_true = y_proba.copy()
+    y_true.data[:] = 1
+    return y_true, y_proba, np.asarray(y_true.mean(axis=0)).ravel(), np.ones(100)
+
+
+def test_path_results_saved_under_their_start(data, monkeypatch):
+    run_path(data, "exp", "tolerance", 0, 3, data_key="data")
+    _, _, path = group_paths(METHODS, "tolerance")[0]
+    prev_value = "init"
+    for value in sorted(path, reverse=True):
+        start = f"path-tolerance-from={prev_value}"
+        assert os.path.exists(
+            f"{get_output_path('exp', path[value], 3, None, start)}_results.json"
+        )
+        assert not os.path.exists(
+            f"{get_output_path('exp', path[value], 3, None)}_results.json"
+        )
+        prev_value = value
+
+    # The path is not run again once all its results are saved
+    def fail(*args, **kwargs):
+        raise AssertionError("path was run again")
+
+    monkeypatch.setattr(main_bca, "bca_path", fail)
+    run_path(data, "exp", "tolerance", 0, 3, data_key="data")
+
+
+def test_chained_multi_k_results_saved_under_their_start(data):
+    run_multi_k(data, "exp", "block-coord-macro-f1-iter=1", [1, 3, 5], data_key="data")
+    for prev_k, k in ((None, 1), (1, 3), (3, 5)):
+        start = f"multi-k-from={'init' if prev_k is None else prev_k}"
+        output_path = get_output_path("exp", "block-coord-macro-f1-iter=1", k, None)
+        assert os.path.exists(f"{output_path}_start={start}_results.json")
+        assert not os.path.exists(f"{output_path}_results.json")
+
+    # Nested predictions of a single ranking are the same as the ones of single k runs
+    run_multi_k(data, "exp", "log", [1, 3, 5], data_key="data")
+    for k in (1, 3, 5):
+        assert has_results(
+            load_cached_results(
+                f"{get_output_path('exp', 'log', k, None)}_results.json",
+                get_cache_key("data", "log", k, None),
+            ),
+            k,
+        )
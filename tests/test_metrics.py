@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from conftest import random_proba
+from metrics import *
+
+METRICS = [
+    macro_precision,
+    macro_recall,
+    macro_f1,
+    macro_abandonment,
+    instance_precision,
+    instance_recall,
+    instance_f1,
+    instance_abandonment,
+]
+
+
+@pytest.fixture
+def y_true(y_proba):
+    y_true = random_proba(*y_proba.shape, 0.05, seed=5)
+    y_true.data[:] = 1
+    return y_true
+
+
+def ranked_top_k(y_proba, k):
+    return np.argsort(-y_proba.toarray(), axis=1, kind="stable")[:, :k]
+
+
+def top_k_to_matrix(top_k, nl):
+    ni, k = top_k.shape
+    return csr_matrix(
+        (
+            np.ones(ni * k, dtype=np.float32),
+            np.sort(top_k, axis=1).ravel(),
+            np.arange(0, ni * k + 1, k),
+        ),
+        shape=(ni, nl),
+    )
+
+
+@pytest.mark.parametrize("dense", [False, True])
+def test_fused_metrics_equal_metric_functions(y_true, y_proba, dense):
+    y_pred = top_k_to_matrix(ranked_top_k(y_proba, 3), y_proba.shape[1])
+    if dense:
+        y_true, y_pred = y_true.toarray(), y_pred.toarray()
+    values = evaluate_metrics(y_true, y_pred)
+    for metric in METRICS:
+        assert np.isclose(values[metric], metric(y_true, y_pred))
+
+
+def test_multi_k_metrics_equal_single_k(y_true, y_proba):
+    ranked = ranked_top_k(y_proba, 5)
+    values = evaluate_metrics_multi_k(y_true, ranked, ks=[1, 3, 5])
+    assert sorted(values) == [1, 3, 5]
+    for k, k_values in values.items():
+        y_pred = top_k_to_matrix(ranked[:, :k], y_proba.shape[1])
+        for metric in METRICS:
+            assert np.isclose(k_values[metric], metric(y_true, y_pred))
@@ -0,0 +1,70 @@
+import numpy as np
+from numba import get_num_threads, set_num_threads, config
+
+from conftest import random_proba
+from weighted_prediction import *
+
+
+def test_numba_threads_are_restored(y_proba):
+    weights = np.linspace(0.5, 2, y_proba.shape[1])
+    prev_n_threads = get_num_threads()
+    set_num_threads(1)
+    try:
+        weighted_per_instance(y_proba, weights, 3)
+        assert get_num_threads() == 1
+        weighted_per_instance(y_proba, weights, 3, n_threads=config.NUMBA_NUM_THREADS)
+        assert get_num_threads() == 1
+    finally:
+        set_num_threads(prev_n_threads)
+
+
+def test_multi_weights_match_single_weights_on_short_rows():
+    ni, nl, k = 200, 50, 5
+    y_proba = random_proba(ni, nl, 0.05, seed=3)
+    assert (np.diff(y_proba.indptr) < k).any()
+    weights = np.random.default_rng(0).uniform(0.5, 2, (3, nl))
+    y_preds, _ = weighted_per_instance_multi(y_proba, weights, k, return_top_k=True)
+    for w, y_pred in zip(weights, y_preds):
+        single, _ = weighted_per_instance(y_proba, w, k, return_top_k=True)
+        assert np.array_equal(y_pred, single)
+        assert all(len(np.unique(row)) == k for row in y_pred)
+
+
+def test_nested_predictions_equal_single_k(long_rows_y_proba):
+    weights = np.random.default_rng(1).uniform(0.5, 2, long_rows_y_proba.shape[1])
+    y_preds, _ = weighted_per_instance(
+        long_rows_y_proba, weights, 5, ks=[1, 3, 5], return_top_k=True
+    )
+    for k, y_pred in y_preds.items():
+        single, _ = weighted_per_instance(
+            long_rows_y_proba, weights, k, return_top_k=True
+        )
+        assert np.array_equal(y_pred, single)
+
+
+def test_blocked_dense_top_k_equals_argpartition():
+    nl, k = 100, 5
+    # Rows of several blocks of BLOCK_BYTES, the last one incomplete
+    ni = 2 * (BLOCK_BYTES // (nl * 8)) + 7
+    rng = np.random.default_rng(2)
+    # Probabilities of a few levels, so many gains tie, and some rows of only ties
+    y_proba = np.round(rng.random((ni, nl)) * 4) / 4
+    y_proba[::100] = 0.5
+    weights = rng.choice([0.5, 1, 2], nl)
+    gain_funcs = [lambda eta: eta, lambda eta: eta * weights]
+
+    top_ks = top_k_np_multi(y_proba, gain_funcs, k, return_top_k=True)
+    y_preds = top_k_np_multi(y_proba, gain_funcs, k)
+    for gain_func, top_k, y_pred in zip(gain_funcs, top_ks, y_preds):
+        g = gain_func(y_proba)
+        expected = np.argpartition(-g, k, axis=1)[:, :k]
+        # Tied labels may be selected differently, but the selected gains are the same
+        assert np.array_equal(
+            np.sort(np.take_along_axis(g, top_k, axis=1), axis=1),
+            np.sort(np.take_along_axis(g, expected, axis=1), axis=1),
+        )
+        assert all(len(np.unique(row)) == k for row in top_k)
+        y_pred_top_k = np.zeros_like(y_pred)
+        np.put_along_axis(y_pred_top_k, top_k, 1.0, axis=1)
+        assert np.array_equal(y_pred, y_pred_top_k)
+        assert np.array_equal(top_k_np(y_proba, gain_func, k, True), top_k)